@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Пакетный режим против N отдельных поисков: задержка и число вызовов Bot API.
+
+Использует поддельные Bot API и yt-dlp из bench_offline.py. Сначала один
+пользователь собирает подборку из N треков по одному (поиск -> клик -> аудио,
+один за другим), затем то же самое одной командой "найди N треков ..." и
+ссылкой на плейлист. Пример (сеть не нужна):
+    python benchmarks/bench_bulk.py --tracks 10 --download-latency 800
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_offline  # noqa: E402  (настраивает окружение бота до импорта main)
+from bench_offline import FakeBotApi, FakeYoutubeDL, click_update, text_update  # noqa: E402
+from telegram import Update  # noqa: E402
+
+main = bench_offline.main
+
+
+async def sequential(app, api: FakeBotApi, chat_id: int, tracks: int, update_ids, timeout: float):
+    """N обычных поисков подряд, в каждом выбирается первый трек"""
+    for i in range(tracks):
+        keyboard_future = api.wait_for(chat_id, 'keyboard')
+        await app.process_update(Update.de_json(text_update(next(update_ids), chat_id, f'найди single {i}'), app.bot))
+        keyboard = await asyncio.wait_for(keyboard_future, timeout)
+        audio_future = api.wait_for(chat_id, 'audio')
+        await app.process_update(Update.de_json(click_update(next(update_ids), chat_id, keyboard), app.bot))
+        await asyncio.wait_for(audio_future, timeout)
+
+
+async def bulk(app, chat_id: int, text: str, update_ids):
+    """Одна команда; обработчик завершается, когда отправлены все альбомы"""
+    await app.process_update(Update.de_json(text_update(next(update_ids), chat_id, text), app.bot))
+
+
+async def measure(name: str, api: FakeBotApi, coro) -> tuple:
+    api.calls.clear()
+    started_at = time.monotonic()
+    await coro
+    elapsed = time.monotonic() - started_at
+    calls = Counter(api.calls)
+    print(f"{name:<12} {elapsed:6.2f} с  вызовов Bot API: {sum(calls.values()):3d}  {dict(calls)}")
+    return elapsed, calls
+
+
+async def benchmark(args):
+    FakeYoutubeDL.search_latency = args.search_latency / 1000
+    FakeYoutubeDL.download_latency = args.download_latency / 1000
+    FakeYoutubeDL.file_size = args.file_size * 1024
+    main._new_youtube_dl = FakeYoutubeDL
+    main.BULK_MAX_TRACKS = max(main.BULK_MAX_TRACKS, args.tracks)
+    main.BULK_CONCURRENCY = args.concurrency
+
+    api = FakeBotApi(args.api_latency / 1000, args.file_size * 1024)
+    server = await asyncio.start_server(api.serve, '127.0.0.1', 0)
+    main.TELEGRAM_API_URL = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+    bot = main.UniversalMusicBot()
+    bot._create_application()
+    app = bot.app
+    await app.initialize()
+    await bot._on_startup(app)
+    await app.start()
+    await bot._warm_up_task
+
+    update_ids = iter(range(1, 1_000_000))
+    print(f"Треков: {args.tracks}, параллельно в пакете: {args.concurrency}, "
+          f"воркеров скачивания: {main.DOWNLOAD_WORKERS}\n")
+    single, _ = await measure('по одному', api, sequential(app, api, 1, args.tracks, update_ids, args.timeout))
+    grouped, _ = await measure('найди N', api, bulk(app, 2, f'найди {args.tracks} треков bulk', update_ids))
+    playlist, _ = await measure('плейлист', api, bulk(
+        app, 3, 'найди https://soundcloud.com/bench/sets/bench-set', update_ids
+    ))
+    print(f"\nУскорение: найди N x{single / grouped:.1f}, плейлист x{single / playlist:.1f}")
+
+    await app.stop()
+    await bot._on_stop(app)
+    await app.shutdown()
+    await bot._on_shutdown(app)
+    server.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=main.BULK_CONCURRENCY, help='BULK_CONCURRENCY')
+    parser.add_argument('--search-latency', type=float, default=300, help='мс на поиск')
+    parser.add_argument('--download-latency', type=float, default=800, help='мс на скачивание')
+    parser.add_argument('--api-latency', type=float, default=30, help='мс на вызов Bot API')
+    parser.add_argument('--file-size', type=int, default=4096, help='размер трека, КБ')
+    parser.add_argument('--timeout', type=float, default=120, help='таймаут ожидания ответа, с')
+    args = parser.parse_args()
+    asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    main_cli()
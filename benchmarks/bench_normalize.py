@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Сравнение нормализации названий: цикл re.sub по тегам против одного прохода.
+
+Запуск (сеть не нужна):
+    python benchmarks/bench_normalize.py --rounds 200
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+CORPUS_PATH = os.path.join(ROOT, 'benchmarks', 'data', 'soundcloud_titles.txt')
+
+
+def legacy_clean_title(title: str) -> str:
+    """Так бот чистил названия раньше: отдельный re.sub на каждый тег"""
+    if not title:
+        return 'Неизвестный трек'
+    title = re.sub(r"[^\w\s\-\.\(\)\[\]]", '', title)
+    tags = ['official video', 'official music video', 'lyric video', 'hd', '4k',
+            '1080p', '720p', 'official audio', 'audio', 'video', 'clip', 'mv']
+    for tag in tags:
+        title = re.sub(tag, '', title, flags=re.IGNORECASE)
+    return ' '.join(title.split()).strip()
+
+
+def load_corpus() -> list:
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def measure(func, corpus: list, rounds: int, before_round=None) -> float:
+    total = 0.0
+    for _ in range(rounds):
+        if before_round:
+            before_round()
+        started_at = time.perf_counter()
+        for title in corpus:
+            func(title)
+        total += time.perf_counter() - started_at
+    return total / (rounds * len(corpus))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--show-diff', action='store_true',
+                        help='показать названия, которые теперь чистятся иначе')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    print(f"Корпус: {len(corpus)} названий, раундов: {args.rounds}")
+
+    results = {
+        'legacy': measure(legacy_clean_title, corpus, args.rounds),
+        'cold': measure(main.normalize_title, corpus, args.rounds,
+                        before_round=main.normalize_title.cache_clear),
+        'cached': measure(main.normalize_title, corpus, args.rounds),
+    }
+    for name, per_title in results.items():
+        print(f"{name:>8}: {per_title * 1e6:.2f} us/title "
+              f"(x{results['legacy'] / per_title:.1f})")
+
+    if args.show_diff:
+        for title in corpus:
+            old, new = legacy_clean_title(title), main.normalize_title(title)
+            if old != new:
+                print(f"  {title!r}\n    было:  {old!r}\n    стало: {new!r}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""Офлайн-нагрузка на бота: поддельный SoundCloud (yt-dlp) и поддельный Bot API.
+
+Гоняет настоящие обработчики UniversalMusicBot через Application.process_update:
+пользователь пишет "найди ...", дожидается клавиатуры и нажимает первую кнопку,
+затем ждет sendAudio. Сеть и токены не нужны. Пример:
+    python benchmarks/bench_offline.py --rate 20 --sessions 200 --search-latency 300 --download-latency 800
+
+Режимы бота задаются его же переменными окружения, например
+STREAMING_UPLOAD=1 или PREFETCH_ENABLED=1.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+import statistics
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+# Настройки бота читаются при импорте main
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('DOWNLOAD_PROCESSES', '0')  # подмена yt-dlp работает только в этом процессе
+os.environ.setdefault('FILE_ID_CACHE_PATH', os.path.join(tempfile.mkdtemp(), 'file_ids.sqlite3'))
+os.environ.setdefault('AUDIO_CACHE_DIR', os.path.join(tempfile.mkdtemp(), 'audio'))
+for name in ('REQUESTS_PER_MINUTE', 'RANDOM_PER_MINUTE', 'DOWNLOAD_CLICKS_PER_MINUTE', 'CHAT_REQUESTS_PER_MINUTE'):
+    os.environ.setdefault(name, '1000000')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+
+QUERIES = [
+    'кино группа крови', 'coldplay viva la vida', 'daft punk get lucky', 'земфира хочешь',
+    'tame impala', 'lo fi beats', 'deep house', 'kavinsky nightcall', 'баста сансара',
+    'the weeknd blinding lights', 'skrillex', 'nujabes aruarian dance',
+]
+
+
+# ==================== ПОДДЕЛЬНЫЙ YT-DLP ====================
+class FakeExtractor:
+    def initialize(self):
+        pass
+
+
+class FakeYoutubeDL:
+    """Отвечает как yt-dlp, но с заданной задержкой и без сети"""
+    search_latency = 0.3
+    download_latency = 0.8
+    file_size = 4 * 1024 * 1024
+    stream_base_url = ''
+
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+        self.format_selector = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def get_info_extractor(self, name):
+        return FakeExtractor()
+
+    @staticmethod
+    def _sleep(latency: float):
+        time.sleep(latency * random.uniform(0.5, 1.5))
+
+    def extract_info(self, url: str, download: bool = False, **kwargs):
+        if url.startswith('scsearch'):
+            self._sleep(self.search_latency)
+            limit, query = url[len('scsearch'):].split(':', 1)
+            slug = re.sub(r'\W+', '-', query.lower())
+            return {'_type': 'playlist', 'entries': [
+                {
+                    'id': f'{slug}-{i}',
+                    'title': f'{query} (Official Audio)' if i == 0 else f'{query} part {i} (remix)',
+                    'webpage_url': f'https://soundcloud.com/bench/{slug}-{i}',
+                    'duration': 180 + i,
+                    'uploader': query.split()[0],
+                }
+                for i in range(int(limit or 1))
+            ]}
+
+        if '/sets/' in url:
+            # Плейлист: как у SoundcloudSetIE с extract_flat, только ссылки и id
+            self._sleep(self.search_latency)
+            slug = url.rstrip('/').rsplit('/', 1)[-1]
+            return {'_type': 'playlist', 'title': slug, 'entries': [
+                {'_type': 'url', 'ie_key': 'Soundcloud', 'id': f'{slug}-{i}',
+                 'url': f'https://soundcloud.com/bench/{slug}-{i}'}
+                for i in range(12)
+            ]}
+
+        track_id = url.rstrip('/').rsplit('/', 1)[-1]
+        info = {'id': track_id, 'title': track_id, 'ext': 'mp3', 'duration': 180, 'formats': [{
+            'format_id': 'http_mp3_128', 'protocol': 'http', 'ext': 'mp3', 'vcodec': 'none',
+            'filesize': self.file_size, 'url': f'{self.stream_base_url}/audio/{track_id}',
+        }]}
+        if not download:
+            # Метаданные: выбор формата и прямой mp3 для потоковой отправки
+            self._sleep(self.search_latency)
+            return info
+        return self.process_ie_result(info, download=True)
+
+    def process_ie_result(self, info: dict, download: bool = True, **kwargs):
+        self._sleep(self.download_latency)
+        home = (self.params.get('paths') or {}).get('home') or tempfile.gettempdir()
+        with open(os.path.join(home, f"{info['id']}.mp3"), 'wb') as f:
+            f.truncate(self.file_size)
+        return info
+
+
+# ==================== ПОДДЕЛЬНЫЙ BOT API ====================
+class FakeBotApi:
+    """HTTP-сервер с методами Bot API, которые вызывает бот"""
+
+    def __init__(self, latency: float, file_size: int):
+        self.latency = latency
+        self.file_size = file_size
+        self.message_ids = itertools.count(1)
+        self.calls = defaultdict(int)
+        self.waiters = {}  # (chat_id, событие) -> Future
+
+    def wait_for(self, chat_id: int, event: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[(chat_id, event)] = future
+        return future
+
+    def _notify(self, chat_id: int, event: str, value):
+        future = self.waiters.pop((chat_id, event), None)
+        if future and not future.done():
+            future.set_result(value)
+
+    @staticmethod
+    async def _read_body(reader: asyncio.StreamReader, headers: dict) -> bytes:
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).strip() or b'0', 16)
+                if not size:
+                    await reader.readline()
+                    return b''.join(chunks)
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+        length = int(headers.get('content-length') or 0)
+        return await reader.readexactly(length) if length else b''
+
+    @staticmethod
+    def _params(content_type: str, body: bytes) -> dict:
+        if content_type.startswith('multipart/form-data'):
+            boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+            params = {}
+            for part in body.split(b'--' + boundary):
+                head, _, value = part.partition(b'\r\n\r\n')
+                name = re.search(rb'name="([^"]+)"', head)
+                if name and b'filename=' not in head:
+                    params[name.group(1).decode()] = value[:-2].decode('utf-8', 'replace')
+            return params
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def _message(self, chat_id, text='', **extra) -> dict:
+        return {
+            'message_id': next(self.message_ids), 'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'},
+            'text': text, **extra,
+        }
+
+    def _handle(self, method: str, params: dict):
+        self.calls[method] += 1
+        chat_id = int(params.get('chat_id') or 0)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == 'sendMessage':
+            self._notify(chat_id, 'message', params.get('text', ''))
+            return self._message(chat_id, params.get('text', ''))
+        if method == 'editMessageText':
+            message = self._message(chat_id, params.get('text', ''))
+            message['message_id'] = int(params.get('message_id') or 0)
+            if params.get('reply_markup'):
+                message['reply_markup'] = json.loads(params['reply_markup'])
+                self._notify(chat_id, 'keyboard', message)
+            return message
+        if method == 'sendAudio':
+            audio = {'file_id': f'bench-{next(self.message_ids)}', 'file_unique_id': 'u', 'duration': 180}
+            self._notify(chat_id, 'audio', True)
+            return self._message(chat_id, audio=audio)
+        if method == 'sendMediaGroup':
+            media = params.get('media') or '[]'
+            media = json.loads(media) if isinstance(media, str) else media
+            self._notify(chat_id, 'media_group', len(media))
+            return [
+                self._message(chat_id, audio={
+                    'file_id': f'bench-{next(self.message_ids)}', 'file_unique_id': 'u', 'duration': 180,
+                })
+                for _ in media
+            ]
+        return True
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Соединения keep-alive: httpx переиспользует их
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await self._read_body(reader, headers)
+                path = request_line.split()[1].decode()
+
+                await asyncio.sleep(self.latency)
+                if path.startswith('/audio/'):
+                    status, content_type, payload = '200 OK', 'audio/mpeg', bytes(self.file_size)
+                else:
+                    method = path.rsplit('/', 1)[-1]
+                    result = self._handle(method, self._params(headers.get('content-type', ''), body))
+                    status, content_type = '200 OK', 'application/json'
+                    payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                    f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+# ==================== СЦЕНАРИЙ ====================
+def percentiles(values: list) -> str:
+    if not values:
+        return 'n=0'
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(len(values) * q))] * 1000
+
+    return (f"n={len(values):<5} p50={pick(0.50):8.1f} ms  p95={pick(0.95):8.1f} ms  "
+            f"p99={pick(0.99):8.1f} ms  mean={statistics.mean(values) * 1000:8.1f} ms")
+
+
+def text_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+    }}
+
+
+def click_update(update_id: int, chat_id: int, keyboard_message: dict) -> dict:
+    button = keyboard_message['reply_markup']['inline_keyboard'][0][0]
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': str(chat_id), 'data': button['callback_data'],
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+        'message': keyboard_message,
+    }}
+
+
+async def run_session(bot, api: FakeBotApi, chat_id: int, update_ids, timings: dict, timeout: float):
+    """Один пользователь: поиск -> клавиатура -> клик -> аудио"""
+    app = bot.app
+    started_at = time.monotonic()
+    try:
+        keyboard_future = api.wait_for(chat_id, 'keyboard')
+        query = random.choice(QUERIES)
+        await app.process_update(Update.de_json(text_update(next(update_ids), chat_id, f'найди {query}'), app.bot))
+        keyboard = await asyncio.wait_for(keyboard_future, timeout)
+        searched_at = time.monotonic()
+        timings['search'].append(searched_at - started_at)
+
+        audio_future = api.wait_for(chat_id, 'audio')
+        await app.process_update(Update.de_json(click_update(next(update_ids), chat_id, keyboard), app.bot))
+        await asyncio.wait_for(audio_future, timeout)
+        finished_at = time.monotonic()
+        timings['click_to_audio'].append(finished_at - searched_at)
+        timings['end_to_end'].append(finished_at - started_at)
+    except asyncio.TimeoutError:
+        timings['timeouts'].append(time.monotonic() - started_at)
+
+
+async def benchmark(args):
+    FakeYoutubeDL.search_latency = args.search_latency / 1000
+    FakeYoutubeDL.download_latency = args.download_latency / 1000
+    FakeYoutubeDL.file_size = args.file_size * 1024
+    main._new_youtube_dl = FakeYoutubeDL
+
+    api = FakeBotApi(args.api_latency / 1000, args.file_size * 1024)
+    server = await asyncio.start_server(api.serve, '127.0.0.1', 0)
+    api_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    FakeYoutubeDL.stream_base_url = api_url
+    main.TELEGRAM_API_URL = api_url
+
+    # Сырые значения этапов из метрик бота, чтобы считать перцентили точно
+    stage_samples = defaultdict(list)
+    original_observe = main.metrics.observe
+
+    def observe(name, value, **labels):
+        stage_samples[(name, tuple(sorted(labels.items())))].append(value)
+        original_observe(name, value, **labels)
+
+    main.metrics.observe = observe
+
+    bot = main.UniversalMusicBot()
+    bot._create_application()
+    await bot.app.initialize()
+    await bot._on_startup(bot.app)
+    await bot.app.start()
+    await bot._warm_up_task
+
+    timings = defaultdict(list)
+    update_ids = itertools.count(1)
+    tasks = []
+    started_at = time.monotonic()
+    for i in range(args.sessions):
+        # Открытая модель нагрузки: новые пользователи приходят с заданной частотой
+        delay = started_at + i / args.rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run_session(bot, api, 10_000 + i, update_ids, timings, args.timeout)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started_at
+
+    await bot.app.stop()
+    await bot._on_stop(bot.app)
+    await bot.app.shutdown()
+    await bot._on_shutdown(bot.app)
+    server.close()
+
+    completed = len(timings['end_to_end'])
+    print(f"Сессий: {args.sessions}, завершено: {completed}, таймаутов: {len(timings['timeouts'])}, "
+          f"за {elapsed:.1f} с -> {completed / elapsed:.2f} сессий/с")
+    print(f"Пиковый RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+    print("\nСквозные задержки:")
+    for name in ('search', 'click_to_audio', 'end_to_end'):
+        print(f"  {name:<16} {percentiles(timings[name])}")
+    print("\nЭтапы (метрики бота):")
+    for (name, labels), values in sorted(stage_samples.items()):
+        if not name.endswith('_seconds'):
+            continue
+        label = ','.join(f'{key}={value}' for key, value in labels)
+        print(f"  {name}{{{label}}}".ljust(44) + percentiles(values))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=10, help='новых пользователей в секунду')
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--search-latency', type=float, default=300, help='мс на поиск')
+    parser.add_argument('--download-latency', type=float, default=800, help='мс на скачивание')
+    parser.add_argument('--api-latency', type=float, default=30, help='мс на вызов Bot API')
+    parser.add_argument('--file-size', type=int, default=4096, help='размер трека, КБ')
+    parser.add_argument('--timeout', type=float, default=120, help='таймаут ожидания ответа, с')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Качество и скорость ранжирования: старые проверки подстрок против RelevanceScorer.
+
+Считает точность top-3 на размеченном наборе (benchmarks/data/relevance_labeled.json)
+и время ранжирования нескольких десятков кандидатов; время без кэшей признаков
+(новые названия, как в каждом поиске) сверяется с бюджетом. Запуск (сеть не нужна):
+    python benchmarks/bench_relevance.py --rounds 200 --candidates 36
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+LABELED_PATH = os.path.join(ROOT, 'benchmarks', 'data', 'relevance_labeled.json')
+
+
+def legacy_rank(tracks: list, query: str) -> list:
+    """Так бот ранжировал раньше: набор проверок `in` по названию"""
+    query_lower = query.lower()
+
+    def score(track):
+        title_lower = (track.title or '').lower()
+        relevance_score = 0
+        if query_lower in title_lower:
+            relevance_score += 10
+        if 'official' in title_lower:
+            relevance_score += 5
+        elif 'original' in title_lower:
+            relevance_score += 3
+        if 'cover' in title_lower and 'cover' not in query_lower:
+            relevance_score -= 2
+        if 'remix' in title_lower and 'remix' not in query_lower:
+            relevance_score -= 2
+        return relevance_score
+
+    return sorted(tracks, key=lambda track: (-score(track), -(track.duration or 0)))
+
+
+def new_rank(tracks: list, query: str) -> list:
+    return main.RelevanceScorer(query).rank(tracks)
+
+
+def load_cases() -> list:
+    with open(LABELED_PATH, encoding='utf-8') as f:
+        raw_cases = json.load(f)
+    cases = []
+    for case_number, case in enumerate(raw_cases):
+        tracks, relevant = [], set()
+        for i, candidate in enumerate(case['candidates']):
+            url = f"https://soundcloud.com/case{case_number}/track{i}"
+            tracks.append(main.TrackInfo(main.normalize_title(candidate['title']), url,
+                                         candidate['duration'], candidate['artist']))
+            if candidate['relevant']:
+                relevant.add(url)
+        cases.append((case['query'], tracks, relevant))
+    return cases
+
+
+def precision_at_3(rank, cases: list, verbose: bool = False) -> float:
+    precisions = []
+    for query, tracks, relevant in cases:
+        top = rank(tracks, query)[:3]
+        hits = sum(track.webpage_url in relevant for track in top)
+        precisions.append(hits / min(3, len(relevant)))
+        if verbose and hits < min(3, len(relevant)):
+            print(f"    {query!r}: {[track.title for track in top]}")
+    return statistics.mean(precisions)
+
+
+def clear_caches():
+    main.text_features.cache_clear()
+    main._candidate_features.cache_clear()
+    main._partial_match.cache_clear()
+    main._word_trigrams.cache_clear()
+
+
+def rank_latency(rank, cases: list, rounds: int, candidates: int, before_query=None) -> float:
+    """Время одного ранжирования `candidates` треков: лучшее из средних по раундам, как в timeit"""
+    pool = [track for _, tracks, _ in cases for track in tracks]
+    tracks = (pool * (candidates // len(pool) + 1))[:candidates]
+    queries = [query for query, _, _ in cases]
+    per_round = []
+    for _ in range(rounds):
+        total = 0.0
+        for query in queries:
+            if before_query:
+                before_query()
+            started_at = time.perf_counter()
+            rank(tracks, query)
+            total += time.perf_counter() - started_at
+        per_round.append(total / len(queries))
+    return min(per_round)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--candidates', type=int, default=36)
+    parser.add_argument('--budget-us', type=float, default=500,
+                        help='бюджет ранжирования без кэшей признаков, мкс')
+    parser.add_argument('--verbose', action='store_true', help='показать запросы с ошибками в top-3')
+    args = parser.parse_args()
+
+    cases = load_cases()
+    print(f"Размеченных запросов: {len(cases)}, кандидатов на ранжирование: {args.candidates}")
+    for name, rank in (('legacy', legacy_rank), ('fuzzy', new_rank)):
+        precision = precision_at_3(rank, cases, verbose=args.verbose)
+        latency = rank_latency(rank, cases, args.rounds, args.candidates)
+        print(f"{name:>8}: precision@3={precision:.3f} rank={latency * 1e6:.0f} us")
+    # Так ранжирует бот: каждый поиск приносит новые названия, кэши признаков пусты
+    cold = rank_latency(new_rank, cases, args.rounds, args.candidates, before_query=clear_caches)
+    print(f"{'cold':>8}: rank={cold * 1e6:.0f} us (бюджет {args.budget_us:.0f} us)")
+    assert cold * 1e6 <= args.budget_us, f"ранжирование без кэшей {cold * 1e6:.0f} us > {args.budget_us:.0f} us"
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Холодный старт бота: импорт, готовность приложения и первый ответ.
+
+Каждый замер идет в новом процессе интерпретатора, время считается от запуска
+процесса. Бот работает с поддельным Bot API из bench_offline.py и настоящим
+yt-dlp (прогрев не ходит в сеть). Отдельно сравнивается создание YoutubeDL со
+всеми экстракторами и только с SoundCloud. Запуск (сеть не нужна):
+    python benchmarks/bench_startup.py --rounds 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# ==================== ДОЧЕРНИЕ ПРОЦЕССЫ ====================
+def child_bot(spawned_at: float) -> dict:
+    """Импорт main -> initialize -> start -> ответ на /start -> прогретый yt-dlp"""
+    import asyncio
+
+    # Окружение как в bench_offline, но до импорта main, чтобы замерить его отдельно
+    import tempfile
+    os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('METRICS_PORT', '0')
+    os.environ.setdefault('FILE_ID_CACHE_PATH', os.path.join(tempfile.mkdtemp(), 'file_ids.sqlite3'))
+    os.environ.setdefault('AUDIO_CACHE_DIR', os.path.join(tempfile.mkdtemp(), 'audio'))
+    sys.path.insert(0, os.path.dirname(HERE))
+    sys.path.insert(0, HERE)
+
+    timings = {'interpreter': time.time() - spawned_at}
+    started_at = time.perf_counter()
+    import main
+    timings['import_main'] = time.perf_counter() - started_at
+    timings['ytdlp_imported_by_main'] = main.yt_dlp is not None
+
+    import bench_offline
+    from telegram import Update
+
+    async def run():
+        api = bench_offline.FakeBotApi(0, 0)
+        server = await asyncio.start_server(api.serve, '127.0.0.1', 0)
+        main.TELEGRAM_API_URL = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+        bot = main.UniversalMusicBot()
+        bot._create_application()
+        app = bot.app
+        await app.initialize()
+        await bot._on_startup(app)
+        await app.start()
+        timings['ready'] = time.time() - spawned_at
+
+        reply = api.wait_for(1, 'message')
+        update = bench_offline.text_update(1, 1, '/start')
+        update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+        await app.process_update(Update.de_json(update, app.bot))
+        await asyncio.wait_for(reply, 30)
+        timings['first_response'] = time.time() - spawned_at
+
+        await bot._warm_up_task
+        timings['ytdlp_warm'] = time.time() - spawned_at
+
+        await app.stop()
+        await bot._on_stop(app)
+        await app.shutdown()
+        await bot._on_shutdown(app)
+        server.close()
+
+    asyncio.run(run())
+    return timings
+
+
+def child_ytdlp(mode: str) -> dict:
+    """Импорт yt-dlp и создание одного экземпляра: все экстракторы или только SoundCloud"""
+    started_at = time.perf_counter()
+    import yt_dlp
+    imported_at = time.perf_counter()
+    if mode == 'full':
+        ydl = yt_dlp.YoutubeDL({'quiet': True})
+    else:
+        from yt_dlp.extractor.soundcloud import SoundcloudIE, SoundcloudSearchIE
+        ydl = yt_dlp.YoutubeDL({'quiet': True}, auto_init=False)
+        for extractor in (SoundcloudSearchIE, SoundcloudIE):
+            ydl.add_info_extractor(extractor())
+    ydl.get_info_extractor('SoundcloudSearch').initialize()
+    finished_at = time.perf_counter()
+    return {
+        'import': imported_at - started_at,
+        'instance': finished_at - imported_at,
+        'extractors': len(ydl._ies),
+    }
+
+
+# ==================== ЗАПУСК ====================
+def spawn(*args) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), '--child', *args]
+    output = subprocess.run(command, check=True, capture_output=True, text=True, cwd=os.path.dirname(HERE)).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def median_ms(samples: list, key: str) -> str:
+    return f"{statistics.median(sample[key] for sample in samples) * 1000:7.0f} ms"
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        kind, value = args.child
+        result = child_bot(float(value)) if kind == 'bot' else child_ytdlp(value)
+        print(json.dumps(result))
+        return
+
+    bot_samples = [spawn('bot', repr(time.time())) for _ in range(args.rounds)]
+    print(f"Бот, медиана из {args.rounds} запусков (от старта процесса):")
+    for key in ('interpreter', 'import_main', 'ready', 'first_response', 'ytdlp_warm'):
+        print(f"  {key:<16} {median_ms(bot_samples, key)}")
+    print(f"  yt-dlp импортирован при импорте main: {bot_samples[0]['ytdlp_imported_by_main']}")
+
+    print("\nyt-dlp, импорт + экземпляр:")
+    for mode in ('full', 'soundcloud'):
+        samples = [spawn('ytdlp', mode) for _ in range(args.rounds)]
+        print(f"  {mode:<11} import {median_ms(samples, 'import')}  "
+              f"instance {median_ms(samples, 'instance')}  extractors={samples[0]['extractors']}")
+
+
+if __name__ == '__main__':
+    main_cli()
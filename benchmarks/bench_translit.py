@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Сравнение транслитерации: посимвольный цикл против таблиц str.translate.
+
+Заодно проверяет, что английские названия ищутся одним вариантом, а транслит
+получает кириллический. Запуск (сеть не нужна):
+    python benchmarks/bench_translit.py --rounds 2000
+"""
+import os
+import sys
+import time
+import argparse
+
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+QUERIES = [
+    'кино группа крови', 'земфира хочешь', 'океан ельзи обійми', 'баста сансара',
+    'монеточка каждый раз', 'скриптонит положение', 'щедрик', 'би-2 полковнику никто не пишет',
+    'kino gruppa krovi', 'zemfira hochesh', 'coldplay viva la vida', 'daft punk',
+]
+# Английские исполнители и названия: второй (кириллический) поиск для них лишний
+ENGLISH_QUERIES = [
+    'ed sheeran shape of you', 'michael jackson thriller', 'the chainsmokers closer',
+    'charlie puth attention', 'billie eilish lovely', 'coldplay viva la vida', 'daft punk',
+    'dua lipa levitating', 'sia chandelier', 'imagine dragons believer', 'lana del rey',
+    'linkin park numb', 'bruno mars', 'shakira',
+]
+TRANSLIT_QUERIES = [
+    'kino gruppa krovi', 'zemfira hochesh', 'splin sakhar', 'mumiy troll vladivostok',
+    'monetochka kazhdyy raz', 'bi-2 polkovniku nikto ne pishet',
+]
+
+
+def legacy_variants(query: str) -> list:
+    """Так бот строил варианты раньше: поиск кириллицы и перевод по одному символу"""
+    variants = [query]
+    if any('а' <= char <= 'я' or char == 'ё' for char in query.lower()):
+        latin_version = ''.join(main.TRANSLIT_RU.get(char, char) for char in query.lower())
+        if latin_version and latin_version != query:
+            variants.append(latin_version)
+    return variants
+
+
+def measure(func, rounds: int, before_round=None) -> float:
+    total = 0.0
+    for _ in range(rounds):
+        if before_round:
+            before_round()
+        started_at = time.perf_counter()
+        for query in QUERIES:
+            func(query)
+        total += time.perf_counter() - started_at
+    return total / (rounds * len(QUERIES))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=1000)
+    args = parser.parse_args()
+
+    transliterator = main.Transliterator()
+    results = {
+        'legacy': measure(legacy_variants, args.rounds),
+        'cold': measure(transliterator.generate_search_variants, args.rounds,
+                        before_round=transliterator._variants.cache_clear),
+        'cached': measure(transliterator.generate_search_variants, args.rounds),
+    }
+    for name, per_query in results.items():
+        print(f"{name:>8}: {per_query * 1e6:.2f} us/query")
+
+    for query in QUERIES:
+        print(f"  {query!r} -> {transliterator.generate_search_variants(query)}")
+
+    extra = {query: variants for query in ENGLISH_QUERIES
+             if len(variants := transliterator.generate_search_variants(query)) != 1}
+    missing = [query for query in TRANSLIT_QUERIES if len(transliterator.generate_search_variants(query)) < 2]
+    print(f"\nАнглийские запросы с лишними вариантами: {len(extra)}/{len(ENGLISH_QUERIES)}, "
+          f"транслит без кириллического варианта: {len(missing)}/{len(TRANSLIT_QUERIES)}")
+    assert not extra, f"английские запросы дали лишние варианты: {extra}"
+    assert not missing, f"транслит без кириллического варианта: {missing}"
+
+
+if __name__ == '__main__':
+    main_cli()
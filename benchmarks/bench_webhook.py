@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Проверка режима webhook локальным HTTP-клиентом, без Telegram и SoundCloud.
+
+Поднимает поддельный Bot API и yt-dlp из bench_offline.py, запускает
+webhook-сервер бота с теми же параметрами, что и run_webhook, и шлет ему
+обновления по HTTP с заголовком X-Telegram-Bot-Api-Secret-Token. В конце
+отправляет пачку кликов и сразу останавливает бота, проверяя, что начатые
+скачивания доходят до пользователей. Пример:
+    python benchmarks/bench_webhook.py --rate 20 --sessions 100
+"""
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+import bench_offline  # noqa: E402  (настраивает окружение бота до импорта main)
+from bench_offline import FakeBotApi, FakeYoutubeDL, QUERIES, click_update, percentiles, text_update  # noqa: E402
+
+main = bench_offline.main
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def post_update(client: httpx.AsyncClient, url: str, payload: dict, timings: dict) -> int:
+    started_at = time.monotonic()
+    response = await client.post(url, json=payload, headers={'X-Telegram-Bot-Api-Secret-Token': main.WEBHOOK_SECRET})
+    timings['webhook_ack'].append(time.monotonic() - started_at)
+    return response.status_code
+
+
+async def run_session(client, url: str, api: FakeBotApi, chat_id: int, update_ids, timings: dict, timeout: float):
+    """Один пользователь: поиск -> клавиатура -> клик -> аудио, все через webhook"""
+    started_at = time.monotonic()
+    try:
+        keyboard_future = api.wait_for(chat_id, 'keyboard')
+        text = f'найди {random.choice(QUERIES)}'
+        await post_update(client, url, text_update(next(update_ids), chat_id, text), timings)
+        keyboard = await asyncio.wait_for(keyboard_future, timeout)
+        searched_at = time.monotonic()
+        timings['search'].append(searched_at - started_at)
+
+        audio_future = api.wait_for(chat_id, 'audio')
+        await post_update(client, url, click_update(next(update_ids), chat_id, keyboard), timings)
+        await asyncio.wait_for(audio_future, timeout)
+        timings['end_to_end'].append(time.monotonic() - started_at)
+    except asyncio.TimeoutError:
+        timings['timeouts'].append(time.monotonic() - started_at)
+
+
+async def benchmark(args):
+    FakeYoutubeDL.search_latency = args.search_latency / 1000
+    FakeYoutubeDL.download_latency = args.download_latency / 1000
+    main._new_youtube_dl = FakeYoutubeDL
+
+    api = FakeBotApi(args.api_latency / 1000, FakeYoutubeDL.file_size)
+    api_server = await asyncio.start_server(api.serve, '127.0.0.1', 0)
+    api_url = f"http://127.0.0.1:{api_server.sockets[0].getsockname()[1]}"
+    FakeYoutubeDL.stream_base_url = api_url
+    main.TELEGRAM_API_URL = api_url
+
+    port = free_port()
+    main.WEBHOOK_URL = f'http://127.0.0.1:{port}'
+    main.WEBHOOK_LISTEN = '127.0.0.1'
+    main.WEBHOOK_PORT = port
+    webhook_url = f'{main.WEBHOOK_URL}/{main.WEBHOOK_PATH}'
+
+    # Тот же порядок запуска и остановки, что и в Application.run_webhook
+    bot = main.UniversalMusicBot()
+    bot._create_application()
+    app = bot.app
+    await app.initialize()
+    await bot._on_startup(app)
+    await app.updater.start_webhook(**bot._webhook_options())
+    await app.start()
+    await bot._warm_up_task
+
+    timings = defaultdict(list)
+    update_ids = itertools.count(1)
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        rejected = await client.post(webhook_url, json=text_update(0, 1, 'найди test'),
+                                     headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+        print(f"Неверный секрет: HTTP {rejected.status_code} (ожидается 403)")
+
+        tasks = []
+        started_at = time.monotonic()
+        for i in range(args.sessions):
+            delay = started_at + i / args.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(
+                run_session(client, webhook_url, api, 10_000 + i, update_ids, timings, args.timeout)
+            ))
+        await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started_at
+
+        # Остановка под нагрузкой: клики приняты, скачивания еще идут
+        keyboards = []
+        for i in range(args.drain_clicks):
+            chat_id = 90_000 + i
+            future = api.wait_for(chat_id, 'keyboard')
+            await post_update(client, webhook_url, text_update(next(update_ids), chat_id, 'найди drain'), timings)
+            keyboards.append((chat_id, await asyncio.wait_for(future, args.timeout)))
+        audio_futures = []
+        for chat_id, keyboard in keyboards:
+            audio_futures.append(api.wait_for(chat_id, 'audio'))
+            await post_update(client, webhook_url, click_update(next(update_ids), chat_id, keyboard), timings)
+
+    stop_started_at = time.monotonic()
+    await app.updater.stop()
+    await app.stop()
+    await bot._on_stop(app)
+    await app.shutdown()
+    await bot._on_shutdown(app)
+    stop_elapsed = time.monotonic() - stop_started_at
+    delivered = sum(future.done() for future in audio_futures)
+    api_server.close()
+
+    completed = len(timings['end_to_end'])
+    print(f"Сессий: {args.sessions}, завершено: {completed}, таймаутов: {len(timings['timeouts'])}, "
+          f"за {elapsed:.1f} с -> {completed / elapsed:.2f} сессий/с")
+    print(f"Остановка: {stop_elapsed:.2f} с, доставлено аудио после остановки {delivered}/{len(audio_futures)}")
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+    print("\nЗадержки:")
+    for name in ('webhook_ack', 'search', 'end_to_end'):
+        print(f"  {name:<16} {percentiles(timings[name])}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=10, help='новых пользователей в секунду')
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--search-latency', type=float, default=300, help='мс на поиск')
+    parser.add_argument('--download-latency', type=float, default=800, help='мс на скачивание')
+    parser.add_argument('--api-latency', type=float, default=30, help='мс на вызов Bot API')
+    parser.add_argument('--drain-clicks', type=int, default=3, help='кликов перед остановкой')
+    parser.add_argument('--timeout', type=float, default=120, help='таймаут ожидания ответа, с')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Сравнение задержки поиска: новый YoutubeDL на каждый вызов против переиспользуемого.
+
+Запуск (нужен доступ к SoundCloud):
+    python benchmarks/bench_ytdlp_pool.py --rounds 5 --limit 6
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+QUERIES = ['coldplay', 'lo fi beats', 'daft punk', 'deep house', 'kino gruppa krovi']
+
+
+def cold_search(query: str, limit: int):
+    """Так бот искал раньше: новый экземпляр на каждый запрос"""
+    with main._load_yt_dlp().YoutubeDL(dict(main.SEARCH_YDL_OPTS)) as ydl:
+        return ydl.extract_info(f"scsearch{limit}:{query}", download=False)
+
+
+def pooled_search(query: str, limit: int):
+    """Экземпляр потока, как в пуле поиска"""
+    return main._search_in_worker(query, limit)
+
+
+def measure(func, rounds: int, limit: int) -> list:
+    timings = []
+    for _ in range(rounds):
+        for query in QUERIES:
+            started_at = time.perf_counter()
+            func(query, limit)
+            timings.append(time.perf_counter() - started_at)
+    return timings
+
+
+def report(name: str, timings: list):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:>8}: n={len(timings)} "
+          f"mean={statistics.mean(timings) * 1000:.0f} ms "
+          f"median={statistics.median(timings) * 1000:.0f} ms "
+          f"p95={p95 * 1000:.0f} ms")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--limit', type=int, default=6)
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    main._warm_up_worker('search')
+    print(f"Прогрев экземпляра: {(time.perf_counter() - started_at) * 1000:.0f} ms")
+
+    report('cold', measure(cold_search, args.rounds, args.limit))
+    report('pooled', measure(pooled_search, args.rounds, args.limit))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import abc
 import json
 import logging
 import tempfile
 import re
 import random
 import asyncio
+import atexit
+import bisect
+import contextlib
+import functools
+import hashlib
+import importlib.util
+import logging.handlers
+import multiprocessing
+import queue
 import shutil
+import signal
+import sqlite3
+import threading
 import time
-from datetime import datetime, timedelta
+import uuid
 from pathlib import Path
-from collections import defaultdict
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # ==================== CONFIG ====================
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
@@ -22,147 +36,2826 @@ if not BOT_TOKEN:
 
 print("🔧 Универсальный Music Bot запускается...")
 
+# Адрес Bot API (например, локальный telegram-bot-api сервер); по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '').rstrip('/')
+
 # Оптимизированные настройки
 MAX_FILE_SIZE_MB = int(os.environ.get('MAX_FILE_SIZE_MB', 50))
 DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', 120))
 SEARCH_TIMEOUT = int(os.environ.get('SEARCH_TIMEOUT', 20))
+# Досрочно завершать поиск по вариантам, когда набралось достаточно треков с такой оценкой
+EARLY_STOP_SCORE = float(os.environ.get('EARLY_STOP_SCORE', 10))
 REQUESTS_PER_MINUTE = int(os.environ.get('REQUESTS_PER_MINUTE', 10))
+RANDOM_PER_MINUTE = int(os.environ.get('RANDOM_PER_MINUTE', 5))
+DOWNLOAD_CLICKS_PER_MINUTE = int(os.environ.get('DOWNLOAD_CLICKS_PER_MINUTE', 10))
+BULK_PER_MINUTE = int(os.environ.get('BULK_PER_MINUTE', 2))
+# Общий лимит на групповой чат (все пользователи и команды вместе)
+CHAT_REQUESTS_PER_MINUTE = int(os.environ.get('CHAT_REQUESTS_PER_MINUTE', 30))
+RATE_LIMITS = {
+    'search': (REQUESTS_PER_MINUTE, 60),
+    'random': (RANDOM_PER_MINUTE, 60),
+    'download': (DOWNLOAD_CLICKS_PER_MINUTE, 60),
+    'bulk': (BULK_PER_MINUTE, 60),
+}
+CHAT_RATE_LIMIT = (CHAT_REQUESTS_PER_MINUTE, 60)
+
+# Очередь скачиваний
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 2))
+DOWNLOAD_QUEUE_MAX = int(os.environ.get('DOWNLOAD_QUEUE_MAX', 50))
+# Место в очереди в статусе одной задачи обновляется не чаще раза в столько секунд
+QUEUE_POSITION_INTERVAL = float(os.environ.get('QUEUE_POSITION_INTERVAL', 3))
+
+# Отдельные пулы для поиска и скачивания (скачивание можно вынести в процессы)
+SEARCH_THREADS = int(os.environ.get('SEARCH_THREADS', 3))
+DOWNLOAD_PROCESSES = os.environ.get('DOWNLOAD_PROCESSES', '').lower() in ('1', 'true', 'yes')
+
+# Потоковая отправка: байты трека идут из SoundCloud сразу в Telegram, без временного файла
+STREAMING_UPLOAD = os.environ.get('STREAMING_UPLOAD', '').lower() in ('1', 'true', 'yes')
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+STREAMABLE_EXTENSIONS = ('mp3', 'm4a')
+
+# Перекодирование ffmpeg треков, которые не помещаются в MAX_FILE_SIZE_MB или
+# есть только в неподдерживаемом формате: битрейт считается из длительности и лимита
+TRANSCODE_ENABLED = os.environ.get('TRANSCODE_ENABLED', '').lower() in ('1', 'true', 'yes')
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+TRANSCODE_CODEC = os.environ.get('TRANSCODE_CODEC', 'mp3').lower()  # mp3 | opus
+TRANSCODE_MIN_KBPS = int(os.environ.get('TRANSCODE_MIN_KBPS', 32))
+TRANSCODE_MAX_KBPS = int(os.environ.get('TRANSCODE_MAX_KBPS', 128))
+# Бюджет CPU: одновременных ffmpeg, потоков на каждый и nice-приоритет
+TRANSCODE_CONCURRENCY = int(os.environ.get('TRANSCODE_CONCURRENCY', 1))
+TRANSCODE_THREADS = int(os.environ.get('TRANSCODE_THREADS', 1))
+TRANSCODE_NICE = int(os.environ.get('TRANSCODE_NICE', 10))
+TRANSCODE_TIMEOUT = int(os.environ.get('TRANSCODE_TIMEOUT', 600))
+
+# Пакетный режим: "найди 5 треков coldplay" или "найди <ссылка на плейлист SoundCloud>".
+# Треки одного запроса качаются параллельно (не больше BULK_CONCURRENCY сразу)
+# и уходят альбомами sendMediaGroup, ход показывается в одном сообщении
+BULK_MAX_TRACKS = int(os.environ.get('BULK_MAX_TRACKS', 10))
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', 3))
+BULK_PROGRESS_INTERVAL = float(os.environ.get('BULK_PROGRESS_INTERVAL', 2))
+MEDIA_GROUP_SIZE = 10  # Больше треков в одном альбоме Bot API не принимает
+
+# Кэш Telegram file_id: SQLite по умолчанию, PostgreSQL если задан DATABASE_URL
+FILE_ID_CACHE_PATH = os.environ.get('FILE_ID_CACHE_PATH', os.path.join('data', 'file_ids.sqlite3'))
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
+# Дисковый кэш скачанных треков по id SoundCloud; AUDIO_CACHE_MAX_MB=0 отключает
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR', os.path.join('data', 'audio'))
+AUDIO_CACHE_MAX_MB = int(os.environ.get('AUDIO_CACHE_MAX_MB', 1024))
+
+# Кэш результатов поиска (TTL в секундах, отрицательные результаты живут меньше)
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 600))
+SEARCH_CACHE_NEGATIVE_TTL = int(os.environ.get('SEARCH_CACHE_NEGATIVE_TTL', 60))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 2000))
+SEARCH_CACHE_MAX_MB = int(os.environ.get('SEARCH_CACHE_MAX_MB', 16))
+
+# Поисковые сессии (клавиатуры с результатами)
+SEARCH_SESSION_TTL = int(os.environ.get('SEARCH_SESSION_TTL', 1800))
+SEARCH_SESSION_MAX = int(os.environ.get('SEARCH_SESSION_MAX', 5000))
+HOUSEKEEPING_INTERVAL = int(os.environ.get('HOUSEKEEPING_INTERVAL', 60))
+
+# Общее состояние воркеров (поисковые сессии, лимиты, кэш поиска): memory - только
+# в этом процессе, postgres - в DATABASE_URL, чтобы несколько воркеров обслуживали один токен
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory').lower()
+# Как часто накопленные записи уходят в общее хранилище и сводятся лимиты, секунды
+STATE_SYNC_INTERVAL = float(os.environ.get('STATE_SYNC_INTERVAL', 0.5))
+STATE_DB_CONNECTIONS = int(os.environ.get('STATE_DB_CONNECTIONS', 4))
+
+# Предзагрузка лучших результатов, пока пользователь выбирает трек
+PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', '').lower() in ('1', 'true', 'yes')
+PREFETCH_TOP_N = int(os.environ.get('PREFETCH_TOP_N', 1))
+PREFETCH_MAX_MB = int(os.environ.get('PREFETCH_MAX_MB', 200))
+PREFETCH_CONCURRENCY = int(os.environ.get('PREFETCH_CONCURRENCY', 1))
+
+# Транслитерация запросов
+TRANSLIT_MAX_VARIANTS = int(os.environ.get('TRANSLIT_MAX_VARIANTS', 3))
+TRANSLIT_CACHE_SIZE = int(os.environ.get('TRANSLIT_CACHE_SIZE', 2048))
+
+# Логирование: записи пишутся в отдельном потоке через очередь
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Уровни отдельных логгеров, например "httpx=WARNING,__main__=DEBUG"
+LOG_LEVELS = os.environ.get('LOG_LEVELS', 'httpx=WARNING')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()  # json | text
+# Доля записей о каждом сообщении/клике, которая попадает в лог
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.1))
+LOG_QUEUE_MAX = int(os.environ.get('LOG_QUEUE_MAX', 10000))
+
+# Метрики в текстовом формате Prometheus (GET /metrics); METRICS_PORT=0 отключает
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+# Режим webhook: если задан публичный адрес WEBHOOK_URL (https://bot.example.com),
+# Telegram сам присылает обновления на WEBHOOK_URL/WEBHOOK_PATH вместо long polling.
+# Несколько воркеров за балансировщиком должны иметь одинаковые путь и секрет
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', 8080)))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram').strip('/')
+# Заголовок X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена бота
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(f'webhook:{BOT_TOKEN}'.encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+# Сколько обновлений обрабатывается одновременно (1 - строго по очереди)
+CONCURRENT_UPDATES = max(1, int(os.environ.get('CONCURRENT_UPDATES', 64)))
+# Сколько секунд при остановке ждать начатые скачивания
+SHUTDOWN_DRAIN_TIMEOUT = int(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', 30))
+
+# Ускоренные настройки для SoundCloud
+SOUNDCLOUD_OPTS = {
+    'format': 'bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio/best',
+    'outtmpl': os.path.join(tempfile.gettempdir(), '%(id)s.%(ext)s'),
+    'quiet': True,
+    'no_warnings': True,
+    'retries': 2,
+    'fragment_retries': 2,
+    'skip_unavailable_fragments': True,
+    'noprogress': True,
+    'nopart': True,
+    'noplaylist': True,
+    'max_filesize': MAX_FILE_SIZE_MB * 1024 * 1024,
+    'socket_timeout': 20,
+    'extractaudio': True,
+    'audioformat': 'best',
+}
+
+# Настройки поиска (только метаданные, без скачивания)
+SEARCH_YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': True,
+    'ignoreerrors': True,
+    'noplaylist': True,
+    'socket_timeout': 15,
+}
+
+# Список для случайных треков
+RANDOM_SEARCHES = [
+    'lo fi beats', 'chillhop', 'deep house', 'synthwave', 'indie rock',
+    'electronic music', 'jazz lounge', 'ambient', 'study music',
+    'focus music', 'relaxing music', 'instrumental', 'acoustic',
+    'piano covers', 'guitar music', 'vocal trance', 'dubstep',
+    'tropical house', 'future bass', 'retro wave', 'city pop',
+    'latin music', 'reggaeton', 'k-pop', 'j-pop', 'classical piano',
+    'orchestral', 'film scores', 'video game music'
+]
+
+# ==================== IMPORT TELEGRAM & YT-DLP ====================
+try:
+    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio, Message
+    from telegram.ext import (
+        Application, CommandHandler, MessageHandler, 
+        filters, ContextTypes, CallbackQueryHandler
+    )
+    from telegram.error import BadRequest, Conflict, TimedOut, NetworkError, TelegramError
+    import httpx
+    # yt-dlp импортируется при первом поиске или фоновом прогреве (см. _load_yt_dlp):
+    # сам импорт занимает ~0.3 с, и боту он для старта не нужен
+    if importlib.util.find_spec('yt_dlp') is None:
+        raise ImportError("No module named 'yt_dlp'")
+    print("✅ Все зависимости загружены")
+except ImportError as exc:
+    print(f"❌ Ошибка импорта: {exc}")
+    print("   Установите зависимости: pip install -r requirements.txt")
+    sys.exit(1)
+
+yt_dlp = None  # Модуль yt-dlp после _load_yt_dlp()
+_yt_dlp_lock = threading.Lock()
+
+# ==================== ЛОГИРОВАНИЕ ====================
+# Атрибуты самой LogRecord; все остальное пришло через extra= и пишется как поля JSON
+_LOG_RECORD_FIELDS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sample'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra= (chat_id, url, duration_ms...) попадают в объект"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей, помеченных extra={'sample': True}"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not getattr(record, 'sample', False) or random.random() < self.rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет записи в ограниченную очередь и никогда не ждет.
+
+    Запись в stdout делает QueueListener в своем потоке, поэтому медленный
+    сборщик логов не блокирует event loop; при переполнении очереди записи
+    отбрасываются и считаются в dropped.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы и трейсбек превращаются в строки до передачи в другой поток,
+        # а поля extra остаются отдельными атрибутами записи
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def set_log_levels(spec: str):
+    """Применяет уровни без перезапуска: «DEBUG» для корня или «httpx=WARNING,__main__=DEBUG»"""
+    for item in spec.split(','):
+        name, _, level = item.strip().rpartition('=')
+        if level:
+            logging.getLogger(name.strip() or None).setLevel(level.strip().upper())
+
+
+def toggle_debug_logging():
+    """Переключает корневой логгер между DEBUG и LOG_LEVEL (по SIGUSR1)"""
+    root = logging.getLogger()
+    debug = root.level != logging.DEBUG
+    root.setLevel(logging.DEBUG if debug else LOG_LEVEL.upper())
+    logger.warning('Уровень логирования: %s', logging.getLevelName(root.level))
+
+
+def setup_logging() -> NonBlockingQueueHandler:
+    """Корневой логгер пишет в очередь, QueueListener выводит записи в stdout"""
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_MAX))
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL.upper())
+    set_log_levels(LOG_LEVELS)
+
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    # Дописываем очередь при выходе из процесса
+    atexit.register(listener.stop)
+    return handler
+
+
+log_handler = setup_logging()
+logger = logging.getLogger(__name__)
+
+# psutil нужен только для метрик процесса
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# ==================== МЕТРИКИ ====================
+# Границы гистограмм: секунды и байты
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.5, 1, 2, 5, 10, 20, 50))
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами (хранятся некумулятивные счетчики)"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Счетчики, гистограммы и снимки stats() компонентов в текстовом формате Prometheus.
+
+    Метки передаются именованными аргументами: inc('failures_total', reason='timeout').
+    Обновлять можно из любого потока (воркеры пулов тоже пишут сюда).
+    """
+
+    def __init__(self, prefix: str = 'musicbot'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._meta = {}        # имя -> (тип, описание, границы)
+        self._counters = {}    # (имя, метки) -> значение
+        self._histograms = {}  # (имя, метки) -> Histogram
+        self._collectors = []  # (имя, описание, функция -> dict или число)
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self._meta[name] = (kind, help_text, buckets)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._meta[name][2])
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Записывает длительность блока with в гистограмму name (и при исключении тоже)"""
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started_at, **labels)
+
+    def register(self, name: str, help_text: str, func):
+        """Gauge, который считается при каждом запросе: func() возвращает число или dict чисел"""
+        self._collectors.append((name, help_text, func))
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = '') -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items()
+            )
+
+        described = set()
+
+        def header(name: str, kind: str, help_text: str):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {self.prefix}_{name} {help_text}')
+                lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter', self._meta.get(name, ('', name))[1])
+            lines.append(f'{self.prefix}_{name}{self._labels(labels)} {value}')
+
+        for (name, labels), (counts, total, count) in histograms:
+            _, help_text, buckets = self._meta[name]
+            header(name, 'histogram', help_text)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = self._labels(labels, 'le="%s"' % bound)
+                lines.append(f'{self.prefix}_{name}_bucket{bucket_labels} {cumulative}')
+            bucket_labels = self._labels(labels, 'le="+Inf"')
+            lines.append(f'{self.prefix}_{name}_bucket{bucket_labels} {count}')
+            lines.append(f'{self.prefix}_{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{self.prefix}_{name}_count{self._labels(labels)} {count}')
+
+        for name, help_text, func in self._collectors:
+            try:
+                values = func()
+            except Exception as e:
+                logger.debug('Метрика %s недоступна: %s', name, e)
+                continue
+            if not isinstance(values, dict):
+                values = {'': values}
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                full_name = f'{name}_{key}' if key else name
+                header(full_name, 'gauge', help_text)
+                lines.append(f'{self.prefix}_{full_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def process_stats() -> dict:
+    """Память, CPU и файловые дескрипторы процесса бота"""
+    if psutil is None:
+        return {}
+    process = psutil.Process()
+    with process.oneshot():
+        cpu = process.cpu_times()
+        stats = {
+            'rss_bytes': process.memory_info().rss,
+            'cpu_seconds': cpu.user + cpu.system,
+            'threads': process.num_threads(),
+        }
+        if hasattr(process, 'num_fds'):
+            stats['open_fds'] = process.num_fds()
+    return stats
+
+
+async def start_metrics_server(registry: MetricsRegistry, host: str, port: int):
+    """Минимальный HTTP-сервер: GET /metrics отдает registry.render()"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса не нужны, но их надо дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug('Ошибка запроса метрик: %s', e)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+metrics = MetricsRegistry()
+metrics.describe('stage_seconds', 'histogram', 'Длительность этапов: поиск, транслитерация, скачивание, отправка')
+metrics.describe('executor_queue_seconds', 'histogram', 'Ожидание свободного воркера пула')
+metrics.describe('file_size_bytes', 'histogram', 'Размер скачанных файлов', SIZE_BUCKETS)
+metrics.describe('timeouts_total', 'counter', 'Таймауты по этапам')
+metrics.describe('failures_total', 'counter', 'Неудачи по причинам')
+metrics.register('process', 'Процесс бота (psutil)', process_stats)
+metrics.register('log_dropped', 'Записи лога, отброшенные при переполнении очереди', lambda: log_handler.dropped)
+
+# ==================== RATE LIMITER ====================
+class TokenBucket:
+    """Ведро токенов: capacity запросов подряд, затем capacity за period секунд"""
+    __slots__ = ('tokens', 'updated_at')
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, capacity: float, rate: float, now: float):
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+
+class RateLimiter:
+    """Ограничение частоты запросов по пользователю (для каждого типа команды) и по чату.
+
+    Ведра хранятся в одном словаре по ключу (тип, id) и удаляются sweep(),
+    как только снова заполнились: такое ведро ничем не отличается от нового.
+    При общем хранилище (shared) решения принимаются по локальным ведрам,
+    а sync() раз в STATE_SYNC_INTERVAL сводит их с ведрами других воркеров.
+    """
+
+    def __init__(self, limits: dict = None, chat_limit: tuple = None, shared: bool = False):
+        # тип команды -> (запросов, секунд)
+        self.limits = limits or RATE_LIMITS
+        self.chat_limit = chat_limit or CHAT_RATE_LIMIT
+        self.shared = shared
+        self.buckets = {}
+        self._spent = {}  # ключ ведра -> токенов списано с прошлой синхронизации
+        self.rejected = 0
+
+    def _limit(self, kind: str) -> tuple:
+        return self.chat_limit if kind == 'chat' else self.limits[kind]
+
+    def _bucket(self, key, capacity: float, rate: float, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(capacity, now)
+        else:
+            bucket.refill(capacity, rate, now)
+        return bucket
+
+    def retry_after(self, user_id: int, kind: str = 'search', chat_id: int = None) -> float:
+        """0, если запрос разрешен (токены списаны), иначе сколько секунд подождать"""
+        now = time.monotonic()
+        checks = [(kind, user_id, *self.limits[kind])]
+        if chat_id is not None and chat_id != user_id:
+            checks.append(('chat', chat_id, *self.chat_limit))
+
+        buckets = []
+        wait = 0.0
+        for bucket_kind, bucket_id, limit, period in checks:
+            rate = limit / period
+            key = (bucket_kind, bucket_id)
+            bucket = self._bucket(key, limit, rate, now)
+            if bucket.tokens < 1:
+                wait = max(wait, (1 - bucket.tokens) / rate)
+            buckets.append((key, bucket))
+
+        if wait:
+            self.rejected += 1
+            return wait
+        for key, bucket in buckets:
+            bucket.tokens -= 1
+            if self.shared:
+                self._spent[key] = self._spent.get(key, 0) + 1
+        return 0.0
+
+    def sweep(self) -> int:
+        """Удаляет ведра, которые успели заполниться; возвращает их количество"""
+        now = time.monotonic()
+        full = []
+        for key, bucket in self.buckets.items():
+            limit, period = self._limit(key[0])
+            if key not in self._spent and bucket.tokens + (now - bucket.updated_at) * limit / period >= limit:
+                full.append(key)
+        for key in full:
+            del self.buckets[key]
+        return len(full)
+
+    async def sync(self, backend: 'StateBackend'):
+        """Отправляет в общее хранилище токены, списанные с прошлого раза,
+        и заменяет остатки локальных ведер общими"""
+        spent, self._spent = self._spent, {}
+        rows = []
+        for key in self.buckets.keys() | spent.keys():
+            limit, period = self._limit(key[0])
+            rows.append((key, spent.get(key, 0), limit, limit / period))
+        try:
+            shared = await backend.sync_rate_limits(rows)
+        except Exception:
+            for key, count in spent.items():
+                self._spent[key] = self._spent.get(key, 0) + count
+            raise
+
+        now = time.monotonic()
+        for key, tokens in shared.items():
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                # Списанное во время запроса еще не учтено в общем ведре
+                bucket.tokens = tokens - self._spent.get(key, 0)
+                bucket.updated_at = now
+
+    def stats(self) -> dict:
+        return {'buckets': len(self.buckets), 'rejected': self.rejected}
+
+# ==================== ТРАНСЛИТЕРАЦИЯ ====================
+# Основная схема (как раньше) плюс украинские буквы
+TRANSLIT_RU = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'і': 'i', 'ї': 'yi', 'є': 'ye', 'ґ': 'g',
+}
+# Альтернативная схема, которой часто пишут названия на SoundCloud
+TRANSLIT_ALT = dict(TRANSLIT_RU, **{
+    'ё': 'e', 'й': 'j', 'х': 'kh', 'ц': 'c', 'щ': 'shch', 'ю': 'ju', 'я': 'ja',
+})
+# Украинская национальная транслитерация
+TRANSLIT_UA = dict(TRANSLIT_RU, **{
+    'г': 'h', 'и': 'y', 'х': 'kh', 'щ': 'shch',
+})
+# Обратная транслитерация: сначала буквосочетания (длинные первыми), затем одиночные буквы
+TRANSLIT_REVERSE_DIGRAPHS = {
+    'shch': 'щ', 'sch': 'щ', 'zh': 'ж', 'kh': 'х', 'ts': 'ц', 'ch': 'ч', 'sh': 'ш',
+    'yo': 'ё', 'yu': 'ю', 'ya': 'я', 'ju': 'ю', 'ja': 'я',
+    'ay': 'ай', 'ey': 'ей', 'iy': 'ий', 'oy': 'ой', 'uy': 'уй', 'yy': 'ый',
+}
+TRANSLIT_REVERSE = {
+    'a': 'а', 'b': 'б', 'c': 'к', 'd': 'д', 'e': 'е', 'f': 'ф', 'g': 'г', 'h': 'х', 'i': 'и',
+    'j': 'й', 'k': 'к', 'l': 'л', 'm': 'м', 'n': 'н', 'o': 'о', 'p': 'п', 'q': 'к', 'r': 'р',
+    's': 'с', 't': 'т', 'u': 'у', 'v': 'в', 'w': 'в', 'x': 'кс', 'y': 'ы', 'z': 'з',
+}
+
+_CYRILLIC_RE = re.compile(r'[а-яёіїєґ]', re.IGNORECASE)
+_UKRAINIAN_RE = re.compile(r'[іїєґ]', re.IGNORECASE)
+_LATIN_RE = re.compile(r'[a-z]', re.IGNORECASE)
+_REVERSE_DIGRAPHS_RE = re.compile(
+    '|'.join(sorted(TRANSLIT_REVERSE_DIGRAPHS, key=len, reverse=True))
+)
+# Признаки английского текста: буквы и сочетания, которых транслит не дает, и частые слова
+_ENGLISH_RE = re.compile(
+    r'[wqx]|th|ck|ph|wh|gh|ee|oo|ou|ea|\b(?:the|of|you|your|and|to|in|on|my|me|is|it|love)\b', re.IGNORECASE
+)
+# Признаки транслита: сильного хватает одного, слабых нужно TRANSLIT_WEAK_MARKERS
+# («zemfira hochesh»: ch, sh и окончание -ira; «kino gruppa krovi»: три окончания на гласную)
+_TRANSLIT_STRONG_RE = re.compile(r'zh|kh|shch|[iy]y\b', re.IGNORECASE)
+_TRANSLIT_WEAK_RE = re.compile(r'ch|sh|ts|y[aeou]|\w{2}[aiou]\b', re.IGNORECASE)
+TRANSLIT_WEAK_MARKERS = 3
+
+
+def looks_like_translit(query: str) -> bool:
+    """Латинский запрос похож на русский транслит, а не на английское название"""
+    if _CYRILLIC_RE.search(query) or _ENGLISH_RE.search(query):
+        return False
+    if _TRANSLIT_STRONG_RE.search(query):
+        return True
+    return len(_TRANSLIT_WEAK_RE.findall(query)) >= TRANSLIT_WEAK_MARKERS
+
+
+class Transliterator:
+    def __init__(self, max_variants: int = TRANSLIT_MAX_VARIANTS, cache_size: int = TRANSLIT_CACHE_SIZE):
+        self.max_variants = max(1, max_variants)
+        # Таблицы str.translate строятся один раз
+        self.tables = {
+            'ru': str.maketrans(TRANSLIT_RU),
+            'alt': str.maketrans(TRANSLIT_ALT),
+            'ua': str.maketrans(TRANSLIT_UA),
+        }
+        self.reverse_table = str.maketrans(TRANSLIT_REVERSE)
+        self._variants = functools.lru_cache(maxsize=cache_size)(self._build_variants)
+
+    def to_latin(self, text: str, scheme: str = 'ru') -> str:
+        """Транслитерирует кириллицу в латиницу"""
+        return text.lower().translate(self.tables[scheme])
+
+    def to_cyrillic(self, text: str) -> str:
+        """Переводит запрос, набранный транслитом, обратно в кириллицу"""
+        text = _REVERSE_DIGRAPHS_RE.sub(lambda m: TRANSLIT_REVERSE_DIGRAPHS[m.group()], text.lower())
+        return text.translate(self.reverse_table)
+
+    def _build_variants(self, query: str) -> tuple:
+        variants = [query]
+        if _CYRILLIC_RE.search(query):
+            # Кириллица: латинские варианты по нескольким схемам
+            schemes = ('ua', 'ru', 'alt') if _UKRAINIAN_RE.search(query) else ('ru', 'alt')
+            candidates = [self.to_latin(query, scheme) for scheme in schemes]
+        elif looks_like_translit(query):
+            # Латиница с признаками транслита; английские названия ищутся как есть
+            candidates = [self.to_cyrillic(query)]
+        else:
+            candidates = []
+
+        seen = {query.lower()}
+        for candidate in candidates:
+            if len(variants) >= self.max_variants:
+                break
+            if candidate and candidate not in seen:
+                seen.add(candidate)
+                variants.append(candidate)
+        return tuple(variants)
+
+    def generate_search_variants(self, query: str) -> list:
+        """Генерирует варианты поиска с транслитерацией (не больше max_variants)"""
+        return list(self._variants(query))
+
+    def fallback_variant(self, query: str) -> str:
+        """Кириллический вариант латинского запроса без признаков транслита.
+
+        Ищется, только если основные варианты дали слишком мало треков:
+        для «coldplay» или «daft punk» второй поиск был бы лишним.
+        """
+        if _CYRILLIC_RE.search(query) or not _LATIN_RE.search(query):
+            return ''
+        candidate = self.to_cyrillic(query)
+        if candidate == query.lower() or candidate in self._variants(query):
+            return ''
+        return candidate
+
+    def cache_info(self):
+        return self._variants.cache_info()
+
+# ==================== НОРМАЛИЗАЦИЯ ТЕКСТА ====================
+# Теги, которые вырезаются из названий треков (только целыми словами)
+TITLE_TAGS = (
+    'official music video', 'official video', 'official audio', 'lyric video',
+    'hd', '4k', '1080p', '720p', 'audio', 'video', 'clip', 'mv',
+)
+# Слова-паразиты в запросах "найди ..."
+SEARCH_STOP_WORDS = ('пожалуйста', 'мне', 'трек', 'песню', 'музыку', 'плз', 'plz')
+TITLE_CACHE_SIZE = int(os.environ.get('TITLE_CACHE_SIZE', 4096))
+
+
+def _words_pattern(words) -> str:
+    """Альтернация целых слов, длинные варианты первыми"""
+    alternatives = (r'\s+'.join(map(re.escape, word.split())) for word in sorted(words, key=len, reverse=True))
+    return r'\b(?:' + '|'.join(alternatives) + r')\b'
+
+
+# Один проход: лишние символы и теги удаляются одним регулярным выражением
+_TITLE_CLEAN_RE = re.compile(r'[^\w\s\-\.\(\)\[\]]|' + _words_pattern(TITLE_TAGS), re.IGNORECASE)
+_EMPTY_BRACKETS_RE = re.compile(r'\(\s*\)|\[\s*\]')
+_SEARCH_TRIGGER_RE = re.compile(r'^\s*найди', re.IGNORECASE)
+# Текстовые команды бота; остальные сообщения отсекаются фильтром до обработчика
+COMMAND_TRIGGER_RE = re.compile(r'^\s*(?:(?P<find>найди)|(?P<random>рандом))', re.IGNORECASE)
+# Ссылка на плейлист SoundCloud (формат как у SoundcloudSetIE, с приватным токеном)
+SOUNDCLOUD_SET_RE = re.compile(r'https?://(?:(?:www|m)\.)?soundcloud\.com/[\w-]+/sets/[:\w-]+(?:/[^?/\s]+)?')
+# Явный признак пакета: число и слово «треков»/«песен», иначе число - часть запроса
+_BULK_COUNT_RE = re.compile(r'^(\d{1,2})\s+(?:трек(?:а|ов)|песн[июя]|песен)(?:\s+|$)', re.IGNORECASE)
+_STOP_WORDS_RE = re.compile(_words_pattern(SEARCH_STOP_WORDS), re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=TITLE_CACHE_SIZE)
+def normalize_title(title: str) -> str:
+    """Очищает название трека от мусора и тегов вроде «Official Video»"""
+    title = _TITLE_CLEAN_RE.sub('', title)
+    title = _EMPTY_BRACKETS_RE.sub('', title)
+    return ' '.join(title.split())
+
+
+def normalize_search_query(message_text: str) -> str:
+    """Убирает из сообщения команду "найди" и слова-паразиты"""
+    query = _SEARCH_TRIGGER_RE.sub('', message_text, count=1)
+    query = _STOP_WORDS_RE.sub('', query)
+    return ' '.join(query.split())
+
+
+def split_bulk_count(query: str) -> tuple:
+    """'5 треков coldplay' -> (5, 'coldplay'). Без слова «треков»/«песен» или с числом
+    вне 2..BULK_MAX_TRACKS («3 doors down», «50 cent») возвращается (1, query)"""
+    match = _BULK_COUNT_RE.match(query)
+    if match and 2 <= int(match.group(1)) <= BULK_MAX_TRACKS:
+        return int(match.group(1)), query[match.end():]
+    return 1, query
+
+# ==================== РЕЛЕВАНТНОСТЬ ====================
+# Веса оценки; переопределяются через RELEVANCE_WEIGHTS="coverage=6,trigram=3,..."
+RELEVANCE_WEIGHTS = {
+    'coverage': 6.0,   # доля слов запроса, найденных в названии или исполнителе (с опечатками)
+    'trigram': 3.0,    # доля триграмм запроса, встречающихся у кандидата
+    'phrase': 3.0,     # запрос целиком входит в название
+    'artist': 2.0,     # исполнитель упомянут в запросе
+    'extra': -1.5,     # доля слов названия, которых нет в запросе
+    'official': 1.0,
+    'original': 0.5,
+    'cover': -3.0,     # штрафы действуют, только если кавер/ремикс не запрашивали
+    'remix': -3.0,
+}
+RELEVANCE_WEIGHTS.update(
+    (name.strip(), float(value))
+    for name, value in (
+        item.split('=', 1) for item in os.environ.get('RELEVANCE_WEIGHTS', '').split(',') if '=' in item
+    )
+)
+# Слова короче не сравниваются с опечатками
+FUZZY_MIN_TOKEN_LEN = 4
+# Префикс не короче этого засчитывается как недописанное слово
+PREFIX_MIN_LEN = 3
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def _tokenize(text: str) -> list:
+    return _TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+
+
+@functools.lru_cache(maxsize=TITLE_CACHE_SIZE * 4)
+def _word_trigrams(word: str) -> frozenset:
+    """Триграммы слова запроса с пробелами по краям"""
+    padded = f' {word} '
+    return frozenset([padded[i:i + 3] for i in range(len(word))])
+
+
+class TextFeatures:
+    """Разобранный один раз текст: слова, фраза и триграммы"""
+    __slots__ = ('tokens', 'token_set', 'phrase', 'trigrams')
+
+    def __init__(self, text: str):
+        words = _tokenize(text)
+        self.tokens = tuple(dict.fromkeys(words))
+        self.token_set = frozenset(self.tokens)
+        self.phrase = ' '.join(words)
+        # Триграммы внутри слов не зависят от порядка слов, стыков ("k g") нет
+        self.trigrams = frozenset().union(*map(_word_trigrams, self.tokens))
+
+
+@functools.lru_cache(maxsize=TITLE_CACHE_SIZE)
+def text_features(text: str) -> TextFeatures:
+    return TextFeatures(text)
+
+
+@functools.lru_cache(maxsize=TITLE_CACHE_SIZE)
+def _candidate_features(title: str, artist: str) -> tuple:
+    """Признаки пары (название, исполнитель), каждая строка разбирается один раз:
+    слова названия, фраза названия, слова исполнителя, все слова, триграммы и общая фраза.
+
+    Триграммы берутся одним проходом по фразе вместе со стыками слов ("k g"):
+    у запроса таких нет, поэтому на пересечение с ними они не влияют.
+    """
+    title_words = _tokenize(title)
+    artist_words = _tokenize(artist) if artist else []
+    title_set = frozenset(title_words)
+    artist_tokens = tuple(dict.fromkeys(artist_words))
+    title_phrase = ' '.join(title_words)
+    full_phrase = f"{' '.join(artist_words)} {title_phrase}"
+    padded = f' {full_phrase} '
+    return (
+        title_set,
+        title_phrase,
+        artist_tokens,
+        title_set.union(artist_tokens),
+        frozenset(map(''.join, zip(padded, padded[1:], padded[2:]))),
+        full_phrase,
+    )
+
+
+def _one_edit_apart(a: str, b: str) -> bool:
+    """Слова отличаются не больше чем одной правкой (замена, вставка, удаление, перестановка)"""
+    if len(a) > len(b):
+        a, b = b, a
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            if len(a) < len(b):
+                return a[i:] == b[i + 1:]
+            return a[i + 1:] == b[i + 1:] or (
+                a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]
+            )
+    return True
+
+
+@functools.lru_cache(maxsize=TITLE_CACHE_SIZE * 4)
+def _partial_match(token: str, candidates: frozenset, phrase: str) -> float:
+    """Неточное совпадение слова: 0.8 — опечатка, 0.6 — недописанное слово, 0 — нет.
+
+    Точное совпадение проверяется до вызова. Опечатка ищется только среди слов
+    близкой длины с общей первой или последней буквой: одна правка не может
+    изменить обе. Недописанное слово — начало какого-то слова фразы.
+    """
+    size = len(token)
+    if size >= FUZZY_MIN_TOKEN_LEN:
+        first, last = token[0], token[-1]
+        for candidate in candidates:
+            if (-2 < len(candidate) - size < 2 and (candidate[0] == first or candidate[-1] == last)
+                    and _one_edit_apart(token, candidate)):
+                return 0.8
+    if size >= PREFIX_MIN_LEN and f' {token}' in f' {phrase}':
+        return 0.6
+    return 0.0
+
+
+class RelevanceScorer:
+    """Нечеткая оценка релевантности: запрос разбирается один раз, кандидаты сравниваются с ним"""
+    __slots__ = ('weights', 'query', 'token_trigrams')
+
+    def __init__(self, query: str, weights: dict = None):
+        self.weights = weights or RELEVANCE_WEIGHTS
+        self.query = text_features(query or '')
+        self.token_trigrams = tuple((token, _word_trigrams(token)) for token in self.query.tokens)
+
+    def score(self, title: str, artist: str = '') -> float:
+        """Оценка пары (название, исполнитель); выше — релевантнее"""
+        query = self.query
+        if not query.tokens:
+            return 0.0
+        weights = self.weights
+        title_set, title_phrase, artist_tokens, token_set, trigrams, full_phrase = _candidate_features(
+            title or '', artist or ''
+        )
+
+        # Слова запроса: точное совпадение, опечатка или недописанное слово. Слово
+        # без общих с кандидатом триграмм не может быть ни началом его слова, ни
+        # опечаткой (кроме перестановки в середине слова из 4 букв) - перебор не нужен
+        matched = 0.0
+        near = []
+        for token, token_trigrams in self.token_trigrams:
+            if token in token_set:
+                matched += 1.0
+            elif not token_trigrams.isdisjoint(trigrams):
+                near.append(token)
+                matched += _partial_match(token, token_set, full_phrase)
+        score = weights['coverage'] * matched / len(query.tokens)
+        score += weights['trigram'] * len(query.trigrams & trigrams) / len(query.trigrams)
+
+        # Исполнитель, упомянутый в запросе. Неточно сравнивается только с близкими
+        # несовпавшими словами запроса: если все слова совпали точно, исход решен
+        if artist_tokens:
+            artist_hits = 0.0
+            leftover = frozenset(near) if near else None
+            for token in artist_tokens:
+                if token in query.token_set:
+                    artist_hits += 1.0
+                elif leftover:
+                    artist_hits += _partial_match(token, leftover, query.phrase)
+            score += weights['artist'] * artist_hits / len(artist_tokens)
+
+        if query.phrase in title_phrase or query.phrase in full_phrase:
+            score += weights['phrase']
+
+        if title_set:
+            score += weights['extra'] * len(title_set - query.token_set) / len(title_set)
+        if 'official' in title_set:
+            score += weights['official']
+        elif 'original' in title_set:
+            score += weights['original']
+        if 'cover' in title_set and 'cover' not in query.token_set:
+            score += weights['cover']
+        if 'remix' in title_set and 'remix' not in query.token_set:
+            score += weights['remix']
+        return score
+
+    def score_track(self, track: 'TrackInfo') -> float:
+        return self.score(track.title, track.artist)
+
+    def rank(self, tracks: list) -> list:
+        """Сортирует треки по оценке (убывание), при равенстве — по длительности"""
+        scored = [(self.score_track(track), track) for track in tracks]
+        # Оценка не записывается в сам трек: записи разделяются с кэшем поиска
+        scored.sort(key=lambda item: (-item[0], -(item[1].duration or 0)))
+        return [track for _, track in scored]
+
+# ==================== КЭШ С TTL ====================
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш с временем жизни записей и ограничением по памяти"""
+
+    def __init__(self, max_entries: int, max_bytes: int = 0, ttl: float = 0, sizeof=None, on_remove=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof or sys.getsizeof
+        self._on_remove = on_remove  # on_remove(key, value) при любом удалении записи
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires_at, _, value = item
+        if expires_at and expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        if key in self._data:
+            self._remove(key)
+
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else 0
+        size = self._sizeof(value)
+        self._data[key] = (expires_at, size, value)
+        self.total_bytes += size
+
+        # Вытесняем самые старые записи, пока не уложимся в лимиты
+        while self._data and (
+            len(self._data) > self.max_entries
+            or (self.max_bytes and self.total_bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        self._remove(key)
+        return item[2]
+
+    def purge_expired(self) -> int:
+        """Удаляет все просроченные записи, возвращает их количество"""
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _, _) in self._data.items() if expires_at and expires_at <= now]
+        for key in expired:
+            self._remove(key)
+        return len(expired)
+
+    def _remove(self, key):
+        _, size, value = self._data.pop(key)
+        self.total_bytes -= size
+        if self._on_remove:
+            self._on_remove(key, value)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+# ==================== ПОИСКОВЫЕ СЕССИИ ====================
+class TrackInfo:
+    """Компактная запись о найденном треке"""
+    __slots__ = ('title', 'webpage_url', 'duration', 'artist', 'track_id')
+
+    def __init__(self, title: str, webpage_url: str, duration: float = 0, artist: str = '', track_id: str = ''):
+        self.title = title
+        self.webpage_url = webpage_url
+        self.duration = duration
+        self.artist = artist
+        self.track_id = track_id  # id трека SoundCloud из результатов поиска
+
+    def __repr__(self):
+        return f'TrackInfo({self.title!r}, {self.webpage_url!r})'
+
+    def to_row(self) -> list:
+        return [self.title, self.webpage_url, self.duration, self.artist, self.track_id]
+
+    @classmethod
+    def from_row(cls, row: list) -> 'TrackInfo':
+        return cls(*row)
+
+
+class SearchSession:
+    """Результаты одного поиска, привязанные к сообщению с клавиатурой"""
+    __slots__ = ('query', 'tracks', 'user_id', 'prefetched')
+
+    def __init__(self, query: str, tracks: list, user_id: int):
+        self.query = query
+        self.tracks = tracks
+        self.user_id = user_id
+        self.prefetched = ()  # URL, предзагрузку которых держит эта сессия
+
+
+class SearchSessionStore:
+    """Хранит сессии по (chat_id, message_id) с TTL и ограничением количества.
+
+    Локальный TTLCache отвечает на клики по своим клавиатурам; изменения
+    копируются в общее хранилище, откуда load() достает сессии других воркеров.
+    """
+
+    def __init__(self, ttl: int = SEARCH_SESSION_TTL, max_sessions: int = SEARCH_SESSION_MAX,
+                 on_remove=None, backend: 'StateBackend' = None):
+        self.ttl = ttl
+        self._backend = backend or MemoryStateBackend()
+        self._sessions = TTLCache(
+            max_entries=max_sessions,
+            ttl=ttl,
+            sizeof=lambda session: 0,
+            on_remove=(lambda key, session: on_remove(session)) if on_remove else None
+        )
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def put(self, chat_id: int, message_id: int, session: SearchSession):
+        self._sessions.set((chat_id, message_id), session)
+        self._backend.save_session(chat_id, message_id, session, self.ttl)
+
+    def get(self, chat_id: int, message_id: int):
+        return self._sessions.get((chat_id, message_id))
+
+    async def load(self, chat_id: int, message_id: int):
+        """Как get(), но сессию, созданную другим воркером, берет из общего хранилища"""
+        session = self._sessions.get((chat_id, message_id))
+        if session is not None or not self._backend.shared:
+            return session
+
+        session = await self._backend.load_session(chat_id, message_id)
+        if session is None:
+            # Воркер-владелец мог еще не отправить пачку записей
+            await asyncio.sleep(STATE_SYNC_INTERVAL)
+            session = await self._backend.load_session(chat_id, message_id)
+        if session is not None:
+            self._sessions.set((chat_id, message_id), session)
+        return session
+
+    def pop(self, chat_id: int, message_id: int):
+        self._backend.delete_session(chat_id, message_id)
+        return self._sessions.pop((chat_id, message_id))
+
+    def purge_expired(self) -> int:
+        return self._sessions.purge_expired()
+
+    def stats(self) -> dict:
+        return self._sessions.stats()
+
+# ==================== ОБЩЕЕ СОСТОЯНИЕ ВОРКЕРОВ ====================
+class StateBackend(abc.ABC):
+    """Хранилище состояния, общего для воркеров одного токена.
+
+    Общие реализации (shared = True) копят изменения и записывают их пачкой
+    в flush(), а читают только то, чего нет в локальных кэшах.
+    """
+    name = ''
+    shared = True
+
+    def __init__(self):
+        self._sessions = {}  # (chat_id, message_id) -> (SearchSession, ttl) или None для удаления
+        self._searches = {}  # ключ кэша поиска -> (треки, ttl)
+        self.flushes = 0
+        self.written = 0
+        self.loads = 0
+        self.load_hits = 0
+        self.errors = 0
+
+    def save_session(self, chat_id: int, message_id: int, session: SearchSession, ttl: float):
+        if self.shared:
+            self._sessions[(chat_id, message_id)] = (session, ttl)
+
+    def delete_session(self, chat_id: int, message_id: int):
+        if self.shared:
+            self._sessions[(chat_id, message_id)] = None
+
+    def save_search(self, key: tuple, tracks: tuple, ttl: float):
+        if self.shared:
+            self._searches[key] = (tracks, ttl)
+
+    async def load_session(self, chat_id: int, message_id: int):
+        """SearchSession или None"""
+        if not self.shared:
+            return None
+        row = await self._load(self._read_session, chat_id, message_id)
+        if row is None:
+            return None
+        query, user_id, tracks = json.loads(row)
+        return SearchSession(query, [TrackInfo.from_row(track) for track in tracks], user_id)
+
+    async def load_search(self, key: tuple):
+        """(треки, оставшийся TTL) или None"""
+        if not self.shared:
+            return None
+        row = await self._load(self._read_search, key)
+        if row is None:
+            return None
+        payload, ttl = row
+        return tuple(TrackInfo.from_row(track) for track in json.loads(payload)), ttl
+
+    async def _load(self, read, *args):
+        self.loads += 1
+        try:
+            row = await asyncio.to_thread(read, *args)
+        except Exception as e:
+            self.errors += 1
+            logger.warning('Ошибка чтения общего состояния: %s', e)
+            return None
+        if row is not None:
+            self.load_hits += 1
+        return row
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        if not (self._sessions or self._searches):
+            return
+        sessions, self._sessions = self._sessions, {}
+        searches, self._searches = self._searches, {}
+        now = time.time()
+        session_rows, deleted = [], []
+        for (chat_id, message_id), item in sessions.items():
+            if item is None:
+                deleted.append((chat_id, message_id))
+                continue
+            session, ttl = item
+            payload = json.dumps([session.query, session.user_id, [track.to_row() for track in session.tracks]])
+            session_rows.append((chat_id, message_id, payload, now + ttl))
+        search_rows = [
+            (self._search_key(key), json.dumps([track.to_row() for track in tracks]), now + ttl)
+            for key, (tracks, ttl) in searches.items()
+        ]
+        try:
+            await asyncio.to_thread(self._write, session_rows, deleted, search_rows)
+        except Exception:
+            # Более новые изменения, накопленные за время записи, важнее
+            for key, item in sessions.items():
+                self._sessions.setdefault(key, item)
+            for key, item in searches.items():
+                self._searches.setdefault(key, item)
+            self.errors += 1
+            raise
+        self.flushes += 1
+        self.written += len(session_rows) + len(deleted) + len(search_rows)
+
+    async def sync_rate_limits(self, rows: list) -> dict:
+        """rows: (ключ ведра, списано токенов, емкость, токенов в секунду).
+        Возвращает общий остаток токенов по каждому ключу"""
+        if not self.shared or not rows:
+            return {}
+        shared_rows = await asyncio.to_thread(
+            self._sync_buckets, [('%s:%s' % key, spent, capacity, rate) for key, spent, capacity, rate in rows]
+        )
+        by_name = {'%s:%s' % key: key for key, _, _, _ in rows}
+        return {by_name[name]: tokens for name, tokens in shared_rows}
+
+    async def purge_expired(self) -> int:
+        if not self.shared:
+            return 0
+        return await asyncio.to_thread(self._purge, time.time())
+
+    @staticmethod
+    def _search_key(key: tuple) -> str:
+        query, limit = key
+        return f'{limit}:{query}'
+
+    # Операции общих реализаций; выполняются в потоке через asyncio.to_thread
+    @abc.abstractmethod
+    def _read_session(self, chat_id: int, message_id: int):
+        ...
+
+    @abc.abstractmethod
+    def _read_search(self, key: tuple):
+        ...
+
+    @abc.abstractmethod
+    def _write(self, session_rows: list, deleted: list, search_rows: list):
+        ...
+
+    @abc.abstractmethod
+    def _sync_buckets(self, rows: list) -> list:
+        ...
+
+    @abc.abstractmethod
+    def _purge(self, now: float) -> int:
+        ...
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._sessions) + len(self._searches),
+            'flushes': self.flushes,
+            'written': self.written,
+            'loads': self.loads,
+            'load_hits': self.load_hits,
+            'errors': self.errors,
+        }
+
+    def close(self):
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    """Ничего не хранит: одному процессу хватает локальных SearchSessionStore,
+    RateLimiter и кэша поиска. При shared = False операции ниже не вызываются.
+    """
+    name = 'memory'
+    shared = False
+
+    def _read_session(self, chat_id: int, message_id: int):
+        return None
+
+    def _read_search(self, key: tuple):
+        return None
+
+    def _write(self, session_rows: list, deleted: list, search_rows: list):
+        pass
+
+    def _sync_buckets(self, rows: list) -> list:
+        return []
+
+    def _purge(self, now: float) -> int:
+        return 0
+
+
+class PostgresStateBackend(StateBackend):
+    """Общее состояние в PostgreSQL: сессии, ведра лимитов и кэш поиска"""
+    name = 'postgresql'
+    shared = True
+
+    def __init__(self, database_url: str = DATABASE_URL, connections: int = STATE_DB_CONNECTIONS):
+        super().__init__()
+        import psycopg2.extras
+        import psycopg2.pool
+        self._extras = psycopg2.extras
+        self._pool = psycopg2.pool.ThreadedConnectionPool(1, connections, database_url)
+        self._transaction(lambda cursor: cursor.execute(
+            'CREATE TABLE IF NOT EXISTS bot_search_sessions ('
+            'chat_id BIGINT NOT NULL, message_id BIGINT NOT NULL, payload TEXT NOT NULL, '
+            'expires_at DOUBLE PRECISION NOT NULL, PRIMARY KEY (chat_id, message_id)); '
+            'CREATE TABLE IF NOT EXISTS bot_search_cache ('
+            'key TEXT PRIMARY KEY, payload TEXT NOT NULL, expires_at DOUBLE PRECISION NOT NULL); '
+            'CREATE TABLE IF NOT EXISTS bot_rate_buckets ('
+            'key TEXT PRIMARY KEY, tokens DOUBLE PRECISION NOT NULL, updated_at DOUBLE PRECISION NOT NULL, '
+            'capacity DOUBLE PRECISION NOT NULL, rate DOUBLE PRECISION NOT NULL)'
+        ))
+        logger.info('✅ Общее состояние воркеров: PostgreSQL')
+
+    def _transaction(self, func):
+        conn = self._pool.getconn()
+        try:
+            with conn, conn.cursor() as cursor:
+                return func(cursor)
+        finally:
+            self._pool.putconn(conn)
+
+    def _fetchone(self, sql: str, params: tuple):
+        def run(cursor):
+            cursor.execute(sql, params)
+            return cursor.fetchone()
+        return self._transaction(run)
+
+    def _read_session(self, chat_id: int, message_id: int):
+        row = self._fetchone(
+            'SELECT payload FROM bot_search_sessions WHERE chat_id = %s AND message_id = %s AND expires_at > %s',
+            (chat_id, message_id, time.time())
+        )
+        return row[0] if row else None
+
+    def _read_search(self, key: tuple):
+        now = time.time()
+        row = self._fetchone(
+            'SELECT payload, expires_at FROM bot_search_cache WHERE key = %s AND expires_at > %s',
+            (self._search_key(key), now)
+        )
+        return (row[0], row[1] - now) if row else None
+
+    def _write(self, session_rows: list, deleted: list, search_rows: list):
+        execute_values = self._extras.execute_values
+
+        def run(cursor):
+            if session_rows:
+                execute_values(
+                    cursor,
+                    'INSERT INTO bot_search_sessions (chat_id, message_id, payload, expires_at) VALUES %s '
+                    'ON CONFLICT (chat_id, message_id) DO UPDATE '
+                    'SET payload = excluded.payload, expires_at = excluded.expires_at',
+                    session_rows
+                )
+            if deleted:
+                execute_values(
+                    cursor,
+                    'DELETE FROM bot_search_sessions WHERE (chat_id, message_id) IN (VALUES %s)',
+                    deleted
+                )
+            if search_rows:
+                execute_values(
+                    cursor,
+                    'INSERT INTO bot_search_cache (key, payload, expires_at) VALUES %s '
+                    'ON CONFLICT (key) DO UPDATE SET payload = excluded.payload, expires_at = excluded.expires_at',
+                    search_rows
+                )
+        self._transaction(run)
+
+    def _sync_buckets(self, rows: list) -> list:
+        now = time.time()
+        values = [(name, capacity - spent, now, capacity, rate) for name, spent, capacity, rate in rows]
+        # Общее ведро пополняется по времени и теряет токены, списанные воркером
+        # с прошлой синхронизации: excluded.capacity - excluded.tokens
+        return self._transaction(lambda cursor: self._extras.execute_values(
+            cursor,
+            'INSERT INTO bot_rate_buckets AS b (key, tokens, updated_at, capacity, rate) VALUES %s '
+            'ON CONFLICT (key) DO UPDATE SET '
+            'tokens = LEAST(excluded.capacity, b.tokens + GREATEST(0, excluded.updated_at - b.updated_at) * excluded.rate)'
+            ' - (excluded.capacity - excluded.tokens), '
+            'updated_at = GREATEST(b.updated_at, excluded.updated_at), '
+            'capacity = excluded.capacity, rate = excluded.rate '
+            'RETURNING key, tokens',
+            values, fetch=True
+        ))
+
+    def _purge(self, now: float) -> int:
+        def run(cursor):
+            removed = 0
+            for sql in (
+                'DELETE FROM bot_search_sessions WHERE expires_at <= %(now)s',
+                'DELETE FROM bot_search_cache WHERE expires_at <= %(now)s',
+                'DELETE FROM bot_rate_buckets WHERE tokens + (%(now)s - updated_at) * rate >= capacity',
+            ):
+                cursor.execute(sql, {'now': now})
+                removed += cursor.rowcount
+            return removed
+        return self._transaction(run)
+
+    def close(self):
+        try:
+            self._pool.closeall()
+        except Exception:
+            pass
+
+
+def create_state_backend(kind: str = STATE_BACKEND, database_url: str = DATABASE_URL) -> StateBackend:
+    """Хранилище из STATE_BACKEND; при ошибке остается состояние в памяти"""
+    if kind in ('postgres', 'postgresql'):
+        if not database_url:
+            logger.warning('STATE_BACKEND=postgres требует DATABASE_URL, состояние хранится в памяти')
+            return MemoryStateBackend()
+        try:
+            return PostgresStateBackend(database_url)
+        except Exception as e:
+            logger.warning('Не удалось подключить общее состояние: %s, состояние хранится в памяти', e)
+            return MemoryStateBackend()
+    if kind != 'memory':
+        logger.warning('Неизвестный STATE_BACKEND=%s, состояние хранится в памяти', kind)
+    return MemoryStateBackend()
+
+# ==================== ПУЛЫ ВЫПОЛНЕНИЯ ====================
+def _timed_call(func, *args):
+    """Выполняет func в пуле и возвращает результат вместе с временем начала и конца"""
+    started_at = time.monotonic()
+    result = func(*args)
+    return result, started_at, time.monotonic()
+
+
+class InstrumentedExecutor:
+    """Пул потоков или процессов с учетом очереди и загрузки воркеров"""
+
+    def __init__(self, name: str, max_workers: int, processes: bool = False, initializer=None, initargs=()):
+        self.name = name
+        self.max_workers = max_workers
+        self.processes = processes
+        if processes:
+            # spawn, а не fork: родительский процесс уже многопоточный
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=initializer,
+                initargs=initargs
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix=name,
+                initializer=initializer,
+                initargs=initargs
+            )
+
+        self._lock = threading.Lock()
+        self._created_at = time.monotonic()
+        self.in_flight = 0
+        self.completed = 0
+        self.busy_time = 0.0
+        self.queue_time = 0.0
+
+    async def run(self, func, *args):
+        """Выполняет func(*args) в пуле, не блокируя цикл событий"""
+        submitted_at = time.monotonic()
+        with self._lock:
+            self.in_flight += 1
+
+        future = self._executor.submit(_timed_call, func, *args)
+        future.add_done_callback(lambda f: self._account(f, submitted_at))
+        result, _, _ = await asyncio.wrap_future(future)
+        return result
+
+    def _account(self, future, submitted_at: float):
+        # Вызывается из потока пула, поэтому под блокировкой
+        with self._lock:
+            self.in_flight -= 1
+            if future.cancelled() or future.exception() is not None:
+                return
+            _, started_at, finished_at = future.result()
+            self.completed += 1
+            self.busy_time += finished_at - started_at
+            self.queue_time += max(0.0, started_at - submitted_at)
+        metrics.observe('executor_queue_seconds', max(0.0, started_at - submitted_at), executor=self.name)
+
+    async def warm_up(self):
+        """Запускает все воркеры пула заранее, чтобы initializer отработал до первых запросов"""
+        await asyncio.gather(*(self.run(time.sleep, 0.05) for _ in range(self.max_workers)))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            elapsed = max(time.monotonic() - self._created_at, 1e-9)
+            return {
+                'max_workers': self.max_workers,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'utilization': self.busy_time / (elapsed * self.max_workers),
+                'avg_queue_time': self.queue_time / self.completed if self.completed else 0.0,
+            }
+
+
+# Экземпляры YoutubeDL живут по одному на поток воркера: создание экземпляра
+# заново инициализирует экстракторы, HTTP-соединения и client_id SoundCloud
+_ydl_local = threading.local()
+
+
+def _load_yt_dlp():
+    """Импортирует yt-dlp при первом обращении (из любого потока, один раз)"""
+    global yt_dlp
+    if yt_dlp is None:
+        with _yt_dlp_lock:
+            if yt_dlp is None:
+                started_at = time.perf_counter()
+                import yt_dlp as module
+                yt_dlp = module
+                logger.debug('yt-dlp %s загружен за %.2f с',
+                             module.version.__version__, time.perf_counter() - started_at)
+    return yt_dlp
+
+
+def _new_youtube_dl(params: dict):
+    """YoutubeDL только с экстракторами SoundCloud.
+
+    Бот ищет через scsearch, скачивает ссылки soundcloud.com и раскрывает
+    плейлисты (/sets/) для пакетного режима, поэтому остальные
+    ~1900 экстракторов не регистрируются: без auto_init экземпляр создается за
+    миллисекунды, а чужие ссылки сразу получают «Unsupported URL» вместо generic.
+    """
+    _load_yt_dlp()
+    from yt_dlp.extractor.soundcloud import SoundcloudIE, SoundcloudSearchIE, SoundcloudSetIE
+    ydl = yt_dlp.YoutubeDL(params, auto_init=False)
+    for extractor in (SoundcloudSearchIE, SoundcloudIE, SoundcloudSetIE):
+        ydl.add_info_extractor(extractor())
+    return ydl
+
+
+def _get_ydl(kind: str):
+    """Возвращает YoutubeDL текущего потока для 'search' или 'download'"""
+    ydl = getattr(_ydl_local, kind, None)
+    if ydl is None:
+        if kind == 'search':
+            ydl = _new_youtube_dl(dict(SEARCH_YDL_OPTS))
+        else:
+            opts = dict(SOUNDCLOUD_OPTS)
+            # Каталог задается на каждый вызов через params['paths']
+            opts['outtmpl'] = '%(title).100s.%(ext)s'
+            ydl = _new_youtube_dl(opts)
+        setattr(_ydl_local, kind, ydl)
+    return ydl
+
+
+def _warm_up_worker(kind: str):
+    """Инициализатор воркера: создает YoutubeDL и экстрактор SoundCloud заранее"""
+    try:
+        ydl = _get_ydl(kind)
+        ydl.get_info_extractor('SoundcloudSearch' if kind == 'search' else 'Soundcloud').initialize()
+    except Exception as e:
+        logger.warning('⚠️ Не удалось прогреть yt-dlp (%s): %s', kind, e)
+
+
+def _search_in_worker(query: str, limit: int):
+    """Поиск на SoundCloud (выполняется в пуле поиска)"""
+    return _get_ydl('search').extract_info(f"scsearch{limit}:{query}", download=False)
+
+
+def _resolve_set_in_worker(url: str, limit: int):
+    """Первые limit треков плейлиста SoundCloud (пул поиска).
+
+    С extract_flat у треков, которых нет целиком в ответе плейлиста, известны
+    только ссылка и id, поэтому title может быть пустым.
+    """
+    info = _get_ydl('search').extract_info(url, download=False)
+    if not info:
+        return None
+    entries = []
+    for entry in info.get('entries') or []:
+        if entry and (entry.get('webpage_url') or entry.get('url')):
+            entries.append({
+                'id': str(entry.get('id') or ''),
+                'url': entry.get('webpage_url') or entry.get('url'),
+                'title': entry.get('title') or '',
+                'duration': entry.get('duration') or 0,
+                'uploader': entry.get('uploader') or '',
+            })
+            if len(entries) >= limit:
+                break
+    return {'title': info.get('title') or '', 'entries': entries}
+
+
+def _track_info_in_worker(url: str):
+    """Метаданные одного трека без выбора формата и скачивания"""
+    info = _get_ydl('download').extract_info(url, download=False, process=False)
+    if not info:
+        return None
+    return {
+        'id': str(info.get('id') or ''),
+        'url': info.get('webpage_url') or url,
+        'title': info.get('title') or '',
+        'duration': info.get('duration') or 0,
+        'uploader': info.get('uploader') or '',
+    }
+
+
+def _estimate_format_size(fmt: dict, duration: float):
+    """Размер формата в байтах: из filesize/filesize_approx или битрейт x длительность"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size:
+        bitrate = fmt.get('tbr') or fmt.get('abr')  # кбит/с
+        if bitrate and duration:
+            size = bitrate * 1000 / 8 * duration
+    return int(size) if size else None
+
+
+_PREVIEW_URL_RE = re.compile(r'/(?:preview|playlist)/0/30/|/preview/')
+
+
+def _is_preview(fmt: dict) -> bool:
+    """30-секундный фрагмент: yt-dlp помечает его preference -10 и '_preview' в format_id"""
+    return (
+        (fmt.get('preference') or 0) < 0
+        or 'preview' in str(fmt.get('format_id') or '')
+        or bool(_PREVIEW_URL_RE.search(fmt.get('url') or ''))
+    )
+
+
+def _select_audio_format(info: dict, limit: int = MAX_FILE_SIZE_MB * 1024 * 1024, protocols: tuple = None):
+    """Самый компактный формат, который Telegram отправляет без конвертации, в пределах limit.
+
+    Возвращает (формат, оценка размера или None). Если подходящего нет -
+    (None, оценка самого компактного из слишком больших или 0).
+    """
+    duration = info.get('duration') or 0
+    fitting = []
+    oversize = []
+    for fmt in info.get('formats') or [info]:
+        if fmt.get('ext') not in STREAMABLE_EXTENSIONS or fmt.get('vcodec') not in (None, 'none'):
+            continue
+        # Превью всегда самые маленькие, но это не трек
+        if _is_preview(fmt):
+            continue
+        if protocols and fmt.get('protocol') not in protocols:
+            continue
+        size = _estimate_format_size(fmt, duration)
+        if size and size >= limit:
+            oversize.append(size)
+            continue
+        # Сначала форматы с известным размером, затем меньшие, затем прямые http-ссылки
+        fitting.append(((size is None, size or 0, not str(fmt.get('protocol', 'http')).startswith('http')), size, fmt))
+
+    if fitting:
+        _, size, fmt = min(fitting, key=lambda item: item[0])
+        return fmt, size
+    return None, min(oversize, default=0)
+
+
+def _transcode_source(info: dict):
+    """Самый компактный аудиоформат любого типа - вход для перекодирования"""
+    candidates = []
+    for fmt in info.get('formats') or []:
+        if fmt.get('url') and fmt.get('vcodec') in (None, 'none') and not _is_preview(fmt):
+            size = _estimate_format_size(fmt, info.get('duration') or 0)
+            candidates.append((size is None, size or 0, fmt))
+    if not candidates:
+        return None
+    fmt = min(candidates, key=lambda item: item[:2])[2]
+    return {
+        'url': fmt['url'],
+        'headers': dict(fmt.get('http_headers') or info.get('http_headers') or {}),
+    }
+
+
+def _download_in_worker(url: str, tmpdir: str, transcode: bool = False):
+    """Скачивание трека в tmpdir (выполняется в пуле скачивания, возможно в другом процессе).
+
+    Сначала извлекаются только метаданные: формат выбирается по оценке
+    размера, а трек без подходящего формата отклоняется до скачивания
+    (в ответе будет 'rejected' с причиной). С transcode=True к отказу
+    прикладывается 'source' - поток, который можно перекодировать ffmpeg.
+    """
+    ydl = _get_ydl('download')
+    try:
+        info = ydl.extract_info(url, download=False, process=False)
+    except Exception as e:
+        logger.warning('❌ Ошибка в yt-dlp: %s', e, extra={'url': url})
+        return None
+    if not info:
+        return None
+
+    default_selector = ydl.format_selector
+    if info.get('formats'):
+        fmt, size = _select_audio_format(info)
+        if fmt is None:
+            return {
+                'id': info.get('id'),
+                'rejected': 'too_large' if size else 'no_audio_format',
+                'filesize': size,
+                'duration': info.get('duration'),
+                'source': _transcode_source(info) if transcode else None,
+            }
+        format_id = fmt.get('format_id')
+        ydl.format_selector = lambda ctx: (f for f in ctx['formats'] if f.get('format_id') == format_id)
+        logger.debug('🎚️ Выбран формат %s (~%s байт)', format_id, size, extra={'url': url})
+
+    ydl.params['paths'] = {'home': tmpdir}
+    try:
+        result = ydl.process_ie_result(info, download=True)
+        logger.debug('✅ yt-dlp завершил скачивание', extra={'url': url})
+    except Exception as e:
+        logger.warning('❌ Ошибка в yt-dlp: %s', e, extra={'url': url})
+        return None
+    finally:
+        ydl.format_selector = default_selector
+
+    if not result:
+        return None
+    # Из процесса возвращаем только то, что нужно боту, без тяжелого info
+    return {key: result.get(key) for key in ('id', 'title', 'ext', 'duration', 'format_id')}
+
+
+def _resolve_stream_in_worker(url: str):
+    """Находит прямую ссылку на аудио, которое можно отправить без обработки.
+
+    Возвращает None, если есть только форматы, требующие ffmpeg (например, HLS),
+    или все подходящие форматы больше лимита.
+    """
+    try:
+        info = _get_ydl('download').extract_info(url, download=False)
+    except Exception as e:
+        logger.warning('❌ Ошибка в yt-dlp: %s', e, extra={'url': url})
+        return None
+    if not info:
+        return None
+
+    fmt, size = _select_audio_format(info, protocols=('http', 'https'))
+    if fmt is None or not fmt.get('url'):
+        return None
+    return {
+        'id': info.get('id'),
+        'url': fmt['url'],
+        'ext': fmt['ext'],
+        'headers': dict(fmt.get('http_headers') or {}),
+        'filesize': size,
+    }
+
+# ==================== ОЧЕРЕДЬ СКАЧИВАНИЙ ====================
+class DownloadQueueFull(Exception):
+    """Очередь скачиваний переполнена"""
+
+
+class TrackRejected(Exception):
+    """Трек отклонен по метаданным, до скачивания"""
+
+    def __init__(self, reason: str, size: int = 0):
+        super().__init__(reason)
+        self.reason = reason  # too_large | no_audio_format
+        self.size = size
+
+    @property
+    def user_message(self) -> str:
+        if self.reason == 'too_large':
+            return (f"Трек слишком большой: ~{self.size / (1024 * 1024):.0f} MB "
+                    f"при лимите {MAX_FILE_SIZE_MB} MB")
+        return "У трека нет аудиоформата, который можно отправить в Telegram"
+
+
+class DownloadJob:
+    __slots__ = ('chat_id', 'priority', 'func', 'future', 'enqueued_at', 'on_position', 'position', 'on_orphan',
+                 'shown', 'shown_at', 'update_scheduled', 'key')
+
+    def __init__(self, chat_id: int, priority: int, func, on_position=None, on_orphan=None, key=None):
+        self.chat_id = chat_id
+        self.key = key  # По нему promote() находит задачу, к которой присоединился новый вызывающий
+        self.priority = priority
+        self.func = func
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.on_position = on_position
+        self.position = 0
+        self.on_orphan = on_orphan
+        self.shown = 0  # Место, которое пользователь видит сейчас
+        self.shown_at = 0.0
+        self.update_scheduled = False
+
+
+class DownloadScheduler:
+    """Очередь скачиваний с ограниченным числом воркеров.
+
+    Внутри одного приоритета чаты обслуживаются по кругу (по одной задаче
+    за проход), поэтому активная группа не блокирует остальные чаты.
+    """
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_BACKGROUND = 1
+
+    def __init__(self, workers: int = DOWNLOAD_WORKERS, max_queue: int = DOWNLOAD_QUEUE_MAX):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queues = {}  # priority -> OrderedDict(chat_id -> deque[DownloadJob])
+        self._pending = 0
+        self._idle = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._position_tasks = set()  # Правки статусов; ссылки держим, чтобы задачи не собрал GC
+        self.active = 0
+        self.started = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f'download-worker-{i}'))
+        logger.info('✅ Очередь скачиваний запущена: %s воркеров, до %s задач', self.workers, self.max_queue)
+
+    async def drain(self, timeout: float) -> bool:
+        """Ждет, пока воркеры выполнят начатые и уже поставленные задачи.
+
+        Возвращает False, если за timeout секунд очередь не опустела.
+        """
+        deadline = time.monotonic() + timeout
+        while self.active or self._pending:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def stop(self):
+        for task in (*self._tasks, *self._position_tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        for chats in self._queues.values():
+            for queue in chats.values():
+                for job in queue:
+                    job.future.cancel()
+        self._queues.clear()
+        self._pending = 0
+
+    async def submit(self, chat_id: int, func, priority: int = PRIORITY_INTERACTIVE, on_position=None, on_orphan=None,
+                     key=None):
+        """Ставит корутинную функцию func в очередь и ждет ее результата.
+
+        on_position(n) вызывается при изменении места в очереди (n >= 1)
+        и с n = 0, когда задача начала выполняться. on_orphan(result)
+        получает результат задачи, ожидание которой отменили во время работы.
+        """
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise DownloadQueueFull()
+
+        job = DownloadJob(chat_id, priority, func, on_position, on_orphan, key)
+        chats = self._queues.setdefault(priority, OrderedDict())
+        chats.setdefault(chat_id, deque()).append(job)
+        self._pending += 1
+        job.future.add_done_callback(lambda _: self._discard(job))
+
+        self._wakeup.set()
+        self._notify_positions()
+        return await job.future
+
+    def promote(self, key, priority: int, on_position=None) -> bool:
+        """Поднимает ожидающую задачу с ключом key до priority и добавляет ей on_position.
+
+        Нужно, когда пользователь ждет трек, который уже стоит в очереди на
+        предзагрузку: иначе его клик ждал бы фоновую задачу и не видел места в очереди.
+        Возвращает False, если такой задачи в очереди нет (не ставилась или уже идет).
+        """
+        job = next((job for job in self._iter_waiting() if job.key == key), None)
+        if job is None:
+            return False
+        if on_position:
+            job.on_position = self._chain_callbacks(job.on_position, on_position)
+        if job.priority > priority:
+            chats = self._queues[job.priority]
+            queue = chats[job.chat_id]
+            queue.remove(job)
+            if not queue:
+                del chats[job.chat_id]
+            job.priority = priority
+            self._queues.setdefault(priority, OrderedDict()).setdefault(job.chat_id, deque()).append(job)
+        self._notify_positions()
+        return True
+
+    @staticmethod
+    def _chain_callbacks(first, second):
+        if first is None:
+            return second
+
+        async def both(position: int):
+            await asyncio.gather(first(position), second(position), return_exceptions=True)
+        return both
+
+    def _discard(self, job: DownloadJob):
+        """Убирает из очереди задачу, ожидание которой было отменено"""
+        chats = self._queues.get(job.priority)
+        queue = chats.get(job.chat_id) if chats else None
+        if queue and job in queue:
+            queue.remove(job)
+            self._pending -= 1
+            if not queue:
+                del chats[job.chat_id]
+            self._notify_positions()
+
+    def _next_job(self):
+        for priority in sorted(self._queues):
+            chats = self._queues[priority]
+            if not chats:
+                continue
+            chat_id, queue = next(iter(chats.items()))
+            job = queue.popleft()
+            if queue:
+                chats.move_to_end(chat_id)
+            else:
+                del chats[chat_id]
+            self._pending -= 1
+            return job
+        return None
+
+    def _iter_waiting(self):
+        """Ожидающие задачи в порядке, в котором их возьмут воркеры"""
+        for priority in sorted(self._queues):
+            queues = list(self._queues[priority].values())
+            depth = max((len(queue) for queue in queues), default=0)
+            for round_index in range(depth):
+                for queue in queues:
+                    if round_index < len(queue):
+                        yield queue[round_index]
+
+    def _notify_positions(self):
+        """Пересчитывает места в очереди и планирует правки статусов.
+
+        Одна задача получает правку только при смене места и не чаще
+        QUEUE_POSITION_INTERVAL: иначе каждая постановка и выдача задачи
+        правила бы все ожидающие статусы, и очередь упиралась бы в лимиты Telegram.
+        """
+        # Свободный воркер заберет задачу сразу, позиции показывать незачем
+        if self._idle:
+            return
+        now = time.monotonic()
+        for position, job in enumerate(self._iter_waiting(), start=1):
+            job.position = position
+            if not job.on_position or job.update_scheduled or job.shown == position:
+                continue
+            job.update_scheduled = True
+            self._spawn(self._show_position(job, max(0.0, job.shown_at + QUEUE_POSITION_INTERVAL - now)))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._position_tasks.add(task)
+        task.add_done_callback(self._position_tasks.discard)
+
+    async def _show_position(self, job: DownloadJob, delay: float):
+        """Показывает текущее место задачи (после паузы, если статус недавно правился)"""
+        if delay:
+            await asyncio.sleep(delay)
+        job.update_scheduled = False
+        # За время паузы задача могла начаться, отмениться или вернуться на показанное место
+        if job.future.done() or not job.position or job.position == job.shown:
+            return
+        job.shown, job.shown_at = job.position, time.monotonic()
+        await self._call_position(job.on_position, job.position)
+
+    @staticmethod
+    async def _call_position(callback, position: int):
+        try:
+            await callback(position)
+        except Exception as e:
+            logger.debug('Не удалось обновить позицию в очереди: %s', e)
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                self._idle += 1
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    self._idle -= 1
+                continue
+
+            if job.future.done():
+                continue
+
+            wait = time.monotonic() - job.enqueued_at
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            job.position = 0
+            if job.shown and job.on_position:
+                self._spawn(self._call_position(job.on_position, 0))
+            self._notify_positions()
+
+            self.active += 1
+            try:
+                result = await job.func()
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+                elif job.on_orphan:
+                    job.on_orphan(result)
+            finally:
+                self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'queued': self._pending,
+            'started': self.started,
+            'rejected': self.rejected,
+            'avg_wait': self.total_wait / self.started if self.started else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+# ==================== ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАПРОСОВ ====================
+class _Flight:
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self, future):
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые запросы в один.
+
+    Пока выполняется запрос с ключом key, остальные вызывающие ждут его
+    результат вместо запуска собственного. on_share(result, waiters)
+    вызывается при завершении с числом ожидающих, получивших результат;
+    on_abandon(result) - для ожидающего, отмененного уже после раздачи.
+    """
+
+    def __init__(self, on_share=None, on_abandon=None):
+        self._inflight = {}
+        self._on_share = on_share
+        self._on_abandon = on_abandon
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def run(self, key, func):
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(func()))
+            self._inflight[key] = flight
+            flight.future.add_done_callback(lambda _: self._finish(key, flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.future)
+        except asyncio.CancelledError:
+            if not flight.future.done():
+                flight.waiters -= 1
+                # Результат больше никому не нужен - отменяем саму работу
+                if flight.waiters <= 0:
+                    flight.future.cancel()
+            elif self._on_abandon and self._succeeded(flight.future):
+                self._on_abandon(flight.future.result())
+            raise
+
+    def _finish(self, key, flight: _Flight):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        if self._on_share and self._succeeded(flight.future):
+            self._on_share(flight.future.result(), flight.waiters)
+
+    @staticmethod
+    def _succeeded(future) -> bool:
+        return not future.cancelled() and future.exception() is None
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._inflight),
+            'started': self.started,
+            'coalesced': self.coalesced,
+        }
+
+
+class AudioFile:
+    """Скачанный трек, который могут одновременно отправлять несколько запросов.
+
+    Временная директория удаляется, а on_free вызывается, когда последний
+    владелец вызвал release().
+    """
+    __slots__ = ('path', 'tmpdir', 'refs', 'on_free')
+
+    def __init__(self, path: str, tmpdir: str = None, on_free=None):
+        self.path = path
+        self.tmpdir = tmpdir
+        self.on_free = on_free
+        self.refs = 0
+
+    def retain(self, count: int = 1):
+        self.refs += count
+        if self.refs <= 0:
+            self._cleanup()
+
+    def release(self):
+        self.refs -= 1
+        if self.refs <= 0:
+            self._cleanup()
+
+    def _cleanup(self):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            logger.debug('✅ Очищена временная директория: %s', self.tmpdir)
+            self.tmpdir = None
+        if self.on_free:
+            on_free, self.on_free = self.on_free, None
+            on_free()
+
+    @staticmethod
+    def share(audio, waiters: int):
+        if audio is not None:
+            audio.retain(waiters)
+
+    @staticmethod
+    def abandon(audio):
+        if audio is not None:
+            audio.release()
+
+# ==================== ДИСКОВЫЙ КЭШ АУДИО ====================
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.ogg', '.wav', '.flac')
+
 
-# Ускоренные настройки для SoundCloud
-SOUNDCLOUD_OPTS = {
-    'format': 'bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio/best',
-    'outtmpl': os.path.join(tempfile.gettempdir(), '%(id)s.%(ext)s'),
-    'quiet': True,
-    'no_warnings': True,
-    'retries': 2,
-    'fragment_retries': 2,
-    'skip_unavailable_fragments': True,
-    'noprogress': True,
-    'nopart': True,
-    'noplaylist': True,
-    'max_filesize': MAX_FILE_SIZE_MB * 1024 * 1024,
-    'ignoreerrors': True,
-    'socket_timeout': 20,
-    'extractaudio': True,
-    'audioformat': 'best',
-}
+_CACHE_NAME_RE = re.compile(r'[^0-9A-Za-z_-]')
+# Вариант перекодированного файла: кодек, битрейт и лимит размера, под который он считался
+_TRANSCODED_VARIANT_RE = re.compile(r'^ffmpeg-(?P<codec>[a-z0-9]+)-\d+k-(?P<limit>\d+)m$')
 
-# Список для случайных треков
-RANDOM_SEARCHES = [
-    'lo fi beats', 'chillhop', 'deep house', 'synthwave', 'indie rock',
-    'electronic music', 'jazz lounge', 'ambient', 'study music',
-    'focus music', 'relaxing music', 'instrumental', 'acoustic',
-    'piano covers', 'guitar music', 'vocal trance', 'dubstep',
-    'tropical house', 'future bass', 'retro wave', 'city pop',
-    'latin music', 'reggaeton', 'k-pop', 'j-pop', 'classical piano',
-    'orchestral', 'film scores', 'video game music'
-]
 
-# ==================== IMPORT TELEGRAM & YT-DLP ====================
-try:
-    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-    from telegram.ext import (
-        Application, CommandHandler, MessageHandler, 
-        filters, ContextTypes, CallbackQueryHandler
-    )
-    from telegram.error import Conflict, TimedOut, NetworkError
-    import yt_dlp
-    print("✅ Все зависимости загружены")
-except ImportError as exc:
-    print(f"❌ Ошибка импорта: {exc}")
-    os.system("pip install python-telegram-bot yt-dlp")
-    try:
-        from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-        from telegram.ext import (
-            Application, CommandHandler, MessageHandler,
-            filters, ContextTypes, CallbackQueryHandler
+class AudioCacheEntry:
+    __slots__ = ('path', 'size', 'pins', 'variant')
+
+    def __init__(self, path: str, size: int, variant: str):
+        self.path = path
+        self.size = size
+        self.pins = 0  # сколько AudioFile сейчас отправляют этот файл
+        self.variant = variant  # format_id yt-dlp или ffmpeg-<кодек>-<битрейт>k-<лимит>m
+
+
+class AudioCache:
+    """Постоянный кэш скачанных треков: файл <id трека>.<вариант>.<ext> в directory.
+
+    Вариант - формат, который действительно получился: format_id, выбранный
+    _select_audio_format, или кодек и битрейт перекодирования. Файл, который
+    при текущих MAX_FILE_SIZE_MB и TRANSCODE_CODEC получился бы другим,
+    считается устаревшим: трек скачивается заново и заменяет его.
+
+    Трек скачивается во временную директорию внутри кэша и переносится
+    на место одним os.replace, поэтому недокачанных файлов в кэше не бывает.
+    Индекс восстанавливается при старте по содержимому каталога (порядок
+    LRU - по времени изменения, которое обновляется при каждом попадании).
+    При превышении квоты удаляются давно не использованные файлы, кроме
+    тех, что сейчас отправляются.
+    """
+
+    def __init__(self, directory: str = AUDIO_CACHE_DIR, max_bytes: int = AUDIO_CACHE_MAX_MB * 1024 * 1024,
+                 file_limit: int = MAX_FILE_SIZE_MB * 1024 * 1024, codec: str = TRANSCODE_CODEC):
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, 'tmp')
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+        self.file_limit = file_limit
+        self.codec = codec
+        self._entries = OrderedDict()  # key -> AudioCacheEntry, от давно использованных к недавним
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evictions = 0
+        if self.enabled:
+            self._rebuild()
+
+    def key(self, track_id: str, url: str) -> str:
+        if track_id:
+            return _CACHE_NAME_RE.sub('_', track_id)
+        return f"url-{hashlib.sha1(url.encode()).hexdigest()[:16]}"
+
+    def _fresh(self, entry: AudioCacheEntry) -> bool:
+        """Получился бы этот файл и сейчас: помещается в лимит, перекодирован тем же кодеком под тот же лимит"""
+        if entry.size >= self.file_limit:
+            return False
+        transcoded = _TRANSCODED_VARIANT_RE.match(entry.variant)
+        return not transcoded or (
+            transcoded.group('codec') == self.codec
+            and int(transcoded.group('limit')) == self.file_limit // (1024 * 1024)
         )
-        from telegram.error import Conflict, TimedOut, NetworkError
-        import yt_dlp
-        print("✅ Зависимости успешно установлены")
-    except ImportError as exc2:
-        print(f"❌ Ошибка импорта после установки: {exc2}")
-        sys.exit(1)
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
 
-# ==================== RATE LIMITER ====================
-class RateLimiter:
-    def __init__(self):
-        self.user_requests = defaultdict(list)
-    
-    def is_limited(self, user_id: int, limit: int = REQUESTS_PER_MINUTE, period: int = 60):
-        now = datetime.now()
-        user_requests = self.user_requests[user_id]
-        user_requests = [req for req in user_requests if now - req < timedelta(seconds=period)]
-        self.user_requests[user_id] = user_requests
-        
-        if len(user_requests) >= limit:
-            return True
-            
-        user_requests.append(now)
-        return False
+    def _rebuild(self):
+        """Собирает индекс по файлам каталога и удаляет остатки прерванных скачиваний"""
+        os.makedirs(self.directory, exist_ok=True)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+        found = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                name, ext = os.path.splitext(entry.name)
+                if ext.lower() not in AUDIO_EXTENSIONS:
+                    continue
+                key, _, variant = name.partition('.')
+                if not variant:
+                    # Файл без варианта в имени: неизвестно, каким форматом он скачан
+                    self._unlink(entry.path)
+                    continue
+                stat = entry.stat()
+                found.append((stat.st_mtime, key, variant, entry.path, stat.st_size))
+
+        for _, key, variant, path, size in sorted(found):
+            # Из нескольких вариантов одного трека остается самый свежий
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old.size
+                self._unlink(old.path)
+            self._entries[key] = AudioCacheEntry(path, size, variant)
+            self.used_bytes += size
+        self._evict()
+        logger.info('✅ Дисковый кэш аудио: %s файлов, %.1f из %s MB',
+                    len(self._entries), self.used_bytes / (1024 * 1024), self.max_bytes // (1024 * 1024))
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and self._fresh(entry)
+
+    def get(self, key: str):
+        """AudioFile из кэша (вызывающий обязан вызвать release()) или None"""
+        entry = self._entries.get(key)
+        if entry is None or not self._fresh(entry):
+            # Устаревший вариант заменит store() после нового скачивания
+            self.misses += 1
+            return None
+        try:
+            os.utime(entry.path)
+        except OSError:
+            # Файл удалили мимо кэша
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        audio = self._pin(entry)
+        audio.retain()
+        return audio
+
+    def store(self, key: str, path: str, variant: str):
+        """Переносит скачанный файл в кэш и возвращает AudioFile на него.
+
+        None, если кэш выключен или файл не помещается в квоту: тогда
+        вызывающий отправляет файл из своей временной директории.
+        """
+        if not self.enabled:
+            return None
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return None
+
+        variant = _CACHE_NAME_RE.sub('_', variant)
+        target = os.path.join(self.directory, f'{key}.{variant}{os.path.splitext(path)[1].lower()}')
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            logger.warning('Не удалось сохранить трек в кэш: %s', e)
+            return None
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.used_bytes -= old.size
+            if old.path != target:
+                self._unlink(old.path)
+        entry = self._entries[key] = AudioCacheEntry(target, size, variant)
+        self.used_bytes += size
+        self.stored += 1
+        audio = self._pin(entry)
+        self._evict()
+        return audio
+
+    def _pin(self, entry: AudioCacheEntry) -> AudioFile:
+        entry.pins += 1
+        return AudioFile(entry.path, on_free=lambda: self._unpin(entry))
+
+    def _unpin(self, entry: AudioCacheEntry):
+        entry.pins -= 1
+        if self.used_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self.used_bytes <= self.max_bytes:
+                break
+            if self._entries[key].pins:
+                continue
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self.used_bytes -= entry.size
+        self._unlink(entry.path)
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.used_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+# ==================== ПЕРЕКОДИРОВАНИЕ ====================
+class Transcoder:
+    """Перекодирует аудио ffmpeg в подпроцессе с ограниченным параллелизмом.
+
+    ffmpeg читает вход (прямую ссылку или локальный файл) потоком и пишет
+    результат сразу в выходной файл: исходный трек целиком нигде не хранится.
+    Битрейт выбирается так, чтобы трек занял не больше 95% лимита.
+    """
+
+    def __init__(self, ffmpeg: str = FFMPEG_PATH, codec: str = TRANSCODE_CODEC,
+                 concurrency: int = TRANSCODE_CONCURRENCY, threads: int = TRANSCODE_THREADS,
+                 nice: int = TRANSCODE_NICE, limit: int = MAX_FILE_SIZE_MB * 1024 * 1024):
+        self.executable = shutil.which(ffmpeg)
+        self.codec = codec
+        self.threads = threads
+        self.limit = limit
+        self._nice = ['nice', '-n', str(nice)] if nice and shutil.which('nice') else []
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.output_bytes = 0
+
+    @property
+    def available(self) -> bool:
+        return self.executable is not None
+
+    @property
+    def extension(self) -> str:
+        return '.ogg' if self.codec == 'opus' else '.mp3'
+
+    def target_kbps(self, duration: float) -> int:
+        """Битрейт для трека длительностью duration; 0, если даже минимальный не помещается"""
+        if not duration:
+            return 0
+        kbps = min(TRANSCODE_MAX_KBPS, int(self.limit * 8 * 0.95 / duration / 1000))
+        return kbps if kbps >= TRANSCODE_MIN_KBPS else 0
+
+    def variant(self, duration: float) -> str:
+        """Вариант для дискового кэша: кодек, битрейт и лимит, под который он выбран"""
+        return f'ffmpeg-{self.codec}-{self.target_kbps(duration)}k-{self.limit // (1024 * 1024)}m'
+
+    def _command(self, source: str, headers: dict, kbps: int, output: str) -> list:
+        command = self._nice + [self.executable, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y']
+        if headers:
+            command += ['-headers', ''.join(f'{key}: {value}\r\n' for key, value in headers.items())]
+        command += ['-i', source, '-map', '0:a:0', '-vn', '-threads', str(self.threads)]
+        if self.codec == 'opus':
+            command += ['-c:a', 'libopus', '-b:a', f'{kbps}k', '-f', 'ogg']
+        else:
+            command += ['-c:a', 'libmp3lame', '-b:a', f'{kbps}k', '-f', 'mp3']
+        return command + [output]
+
+    async def transcode(self, source: str, duration: float, output_dir: str, headers: dict = None,
+                        timeout: float = TRANSCODE_TIMEOUT):
+        """Перекодирует source в output_dir и возвращает путь к результату или None"""
+        kbps = self.target_kbps(duration)
+        if not kbps:
+            self.skipped += 1
+            return None
+
+        output = os.path.join(output_dir, 'transcoded' + self.extension)
+        async with self._semaphore:
+            with metrics.timer('stage_seconds', stage='transcode'):
+                process = await asyncio.create_subprocess_exec(
+                    *self._command(source, headers, kbps, output),
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                try:
+                    _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+                except BaseException:
+                    # Таймаут или отмена скачивания - ffmpeg больше не нужен
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                    self.failed += 1
+                    raise
+
+        size = os.path.getsize(output) if os.path.exists(output) else 0
+        if process.returncode != 0 or not size or size >= self.limit:
+            self.failed += 1
+            logger.warning('❌ ffmpeg завершился с кодом %s: %s', process.returncode,
+                           stderr.decode(errors='replace')[-300:].strip(), extra={'bytes': size})
+            return None
+
+        self.completed += 1
+        self.output_bytes += size
+        logger.info('🎛️ Трек перекодирован', extra={'bytes': size, 'kbps': kbps})
+        return output
+
+    def stats(self) -> dict:
+        return {
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'output_bytes': self.output_bytes,
+        }
+
+# ==================== ПРЕДЗАГРУЗКА ====================
+class PrefetchEntry:
+    __slots__ = ('task', 'audio', 'size', 'sessions')
 
-# ==================== ТРАНСЛИТЕРАЦИЯ ====================
-class Transliterator:
     def __init__(self):
-        self.translit_map = {
-            'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'zh', 'з': 'z',
-            'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
-            'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
-            'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
-            ' ': ' ', '-': '-', '_': '_', '.': '.', ',': ','
+        self.task = None
+        self.audio = None
+        self.size = 0
+        self.sessions = 0
+
+
+class Prefetcher:
+    """Скачивает лучшие результаты поиска заранее, пока пользователь выбирает трек.
+
+    Готовые файлы держатся, пока жива хотя бы одна сессия, которая их
+    запросила, и в сумме не превышают max_bytes.
+    """
+
+    def __init__(self, download, top_n: int = PREFETCH_TOP_N, max_bytes: int = PREFETCH_MAX_MB * 1024 * 1024,
+                 concurrency: int = PREFETCH_CONCURRENCY):
+        self._download = download  # async download(track, chat_id) -> AudioFile
+        self.top_n = top_n
+        self.max_bytes = max_bytes
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._entries = {}  # url -> PrefetchEntry
+        self.used_bytes = 0
+        self.started = 0
+        self.hits = 0
+        self.wasted = 0
+        self.skipped = 0
+
+    def schedule(self, chat_id: int, tracks: list) -> tuple:
+        """Запускает предзагрузку первых top_n треков и возвращает URL тех, что удалось занять"""
+        claimed = []
+        for track in tracks[:self.top_n]:
+            url = track.webpage_url
+            entry = self._entries.get(url)
+            if entry is None:
+                if self.used_bytes >= self.max_bytes:
+                    self.skipped += 1
+                    continue
+                entry = PrefetchEntry()
+                entry.task = asyncio.create_task(self._fetch(track, chat_id, entry))
+                self._entries[url] = entry
+                self.started += 1
+            entry.sessions += 1
+            claimed.append(url)
+        return tuple(claimed)
+
+    async def _fetch(self, track: TrackInfo, chat_id: int, entry: PrefetchEntry):
+        url = track.webpage_url
+        try:
+            async with self._semaphore:
+                audio = await self._download(track, chat_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug('Предзагрузка не удалась: %s: %s', url, e)
+            audio = None
+
+        if self._entries.get(url) is not entry:
+            # Сессия уже закрыта, файл никому не нужен
+            if audio:
+                audio.release()
+            return
+        if not audio:
+            del self._entries[url]
+            return
+
+        size = os.path.getsize(audio.path)
+        if self.used_bytes + size > self.max_bytes:
+            del self._entries[url]
+            audio.release()
+            self.wasted += 1
+            return
+
+        entry.audio = audio
+        entry.size = size
+        self.used_bytes += size
+        logger.info('📦 Предзагружен трек', extra={'url': url, 'bytes': size})
+
+    def take(self, url: str):
+        """Забирает готовый файл; вызывающий становится владельцем и вызывает release()"""
+        entry = self._entries.get(url)
+        if entry is None or entry.audio is None:
+            return None
+        del self._entries[url]
+        self.used_bytes -= entry.size
+        self.hits += 1
+        return entry.audio
+
+    def release(self, urls):
+        """Сессия больше не нуждается в предзагрузке этих URL"""
+        for url in urls:
+            entry = self._entries.get(url)
+            if entry is None:
+                continue
+            entry.sessions -= 1
+            if entry.sessions > 0:
+                continue
+
+            del self._entries[url]
+            if entry.audio:
+                self.used_bytes -= entry.size
+                entry.audio.release()
+                self.wasted += 1
+            else:
+                entry.task.cancel()
+
+    def close(self):
+        for url in list(self._entries):
+            entry = self._entries[url]
+            entry.sessions = 1
+            self.release((url,))
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.used_bytes,
+            'started': self.started,
+            'hits': self.hits,
+            'wasted': self.wasted,
+            'skipped': self.skipped,
         }
 
-    def to_latin(self, text: str) -> str:
-        """Транслитерирует кириллицу в латиницу"""
-        result = []
-        text = text.lower()
-        for char in text:
-            result.append(self.translit_map.get(char, char))
-        return ''.join(result)
+# ==================== ПАКЕТНАЯ ОТПРАВКА ====================
+class BulkProgress:
+    """Одно сообщение о ходе пакетной отправки вместо статуса на каждый трек.
 
-    def generate_search_variants(self, query: str) -> list:
-        """Генерирует варианты поиска с транслитерацией"""
-        variants = [query]
-        
-        # Проверяем, содержит ли запрос кириллицу
-        has_cyrillic = any('а' <= char <= 'я' or char == 'ё' for char in query.lower())
-        
-        if has_cyrillic:
-            # Если есть кириллица - добавляем латинский вариант
-            latin_version = self.to_latin(query)
-            if latin_version and latin_version != query:
-                variants.append(latin_version)
-        
-        return variants
+    Правки идут не чаще interval секунд: Telegram ограничивает частоту
+    editMessageText, а промежуточные состояния пользователю не важны.
+    """
+
+    def __init__(self, message: Message, title: str, total: int, interval: float = BULK_PROGRESS_INTERVAL):
+        self.message = message
+        self.title = title
+        self.total = total
+        self.interval = interval
+        self.ready = 0
+        self.sent = 0
+        self.failed = []  # Названия треков, которые не удалось отправить
+        self._edited_at = 0.0
+        self._text = ''
+
+    def text(self) -> str:
+        lines = [
+            f"📦 <b>{self.title}</b>",
+            f"⏬ Готово: {self.ready}/{self.total}",
+            f"📤 Отправлено: {self.sent}/{self.total}",
+        ]
+        if self.failed:
+            lines.append(f"⚠️ Не удалось: {len(self.failed)}")
+        return '\n'.join(lines)
+
+    async def update(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._edited_at < self.interval:
+            return
+        text = self.text()
+        if text == self._text:
+            return
+        self._edited_at, self._text = now, text
+        try:
+            await self.message.edit_text(text, parse_mode='HTML')
+        except TelegramError as e:
+            logger.debug('Не удалось обновить ход пакетной отправки: %s', e)
+
+
+# ==================== КЭШ FILE_ID ====================
+class FileIdCache:
+    """Постоянный кэш webpage_url -> Telegram file_id.
+
+    После первой отправки трека повторные запросы отправляются по file_id:
+    без скачивания, временных файлов и повторной загрузки в Telegram.
+    """
+
+    def __init__(self, path: str = FILE_ID_CACHE_PATH, database_url: str = DATABASE_URL):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._database_url = database_url
+        self._reconnect_errors = ()
+
+        if database_url:
+            try:
+                import psycopg2
+                self._conn = self._connect_postgres()
+                self._reconnect_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+                self._placeholder = '%s'
+                self.backend = 'postgresql'
+            except Exception as e:
+                logger.warning('Не удалось подключить кэш file_id к PostgreSQL: %s, используется SQLite', e)
+                database_url = None
+        if not database_url:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._placeholder = '?'
+            self.backend = 'sqlite'
+
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS file_ids ('
+            'url TEXT PRIMARY KEY, '
+            'file_id TEXT NOT NULL, '
+            'updated_at DOUBLE PRECISION NOT NULL)'
+        )
+        logger.info('✅ Кэш file_id подключен (%s)', self.backend)
+
+    def _connect_postgres(self):
+        import psycopg2
+        conn = psycopg2.connect(self._database_url)
+        conn.autocommit = True
+        return conn
+
+    def _execute(self, sql: str, params: tuple = (), fetch: bool = False):
+        sql = sql.replace('?', self._placeholder)
+        with self._lock:
+            try:
+                return self._run(sql, params, fetch)
+            except self._reconnect_errors as e:
+                # Соединение с PostgreSQL оборвалось: открываем новое и повторяем запрос один раз
+                logger.warning('Соединение кэша file_id потеряно: %s, переподключаемся', e)
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = self._connect_postgres()
+                return self._run(sql, params, fetch)
+
+    def _run(self, sql: str, params: tuple, fetch: bool):
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchone() if fetch else None
+        finally:
+            cursor.close()
+
+    def _get(self, url: str):
+        row = self._execute('SELECT file_id FROM file_ids WHERE url = ?', (url,), fetch=True)
+        return row[0] if row else None
+
+    def _put(self, url: str, file_id: str):
+        self._execute(
+            'INSERT INTO file_ids (url, file_id, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (url) DO UPDATE SET file_id = excluded.file_id, updated_at = excluded.updated_at',
+            (url, file_id, time.time())
+        )
+
+    def _delete(self, url: str):
+        self._execute('DELETE FROM file_ids WHERE url = ?', (url,))
+
+    async def get(self, url: str):
+        """Возвращает сохраненный file_id или None"""
+        if not url:
+            return None
+        try:
+            file_id = await asyncio.to_thread(self._get, url)
+        except Exception as e:
+            logger.warning('Ошибка чтения кэша file_id: %s', e)
+            file_id = None
+
+        if file_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return file_id
+
+    async def contains(self, url: str) -> bool:
+        """Проверяет наличие file_id, не затрагивая счетчики попаданий"""
+        try:
+            return bool(url) and await asyncio.to_thread(self._get, url) is not None
+        except Exception:
+            return False
+
+    async def put(self, url: str, file_id: str):
+        """Сохраняет file_id для URL трека"""
+        if not url or not file_id:
+            return
+        try:
+            await asyncio.to_thread(self._put, url, file_id)
+        except Exception as e:
+            logger.warning('Ошибка записи кэша file_id: %s', e)
+
+    async def delete(self, url: str):
+        """Удаляет устаревший file_id"""
+        try:
+            await asyncio.to_thread(self._delete, url)
+        except Exception as e:
+            logger.warning('Ошибка удаления из кэша file_id: %s', e)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
 
 # ==================== UNIVERSAL MUSIC BOT ====================
 class UniversalMusicBot:
     def __init__(self):
-        self.download_semaphore = asyncio.Semaphore(2)
-        self.search_semaphore = asyncio.Semaphore(3)
-        self.rate_limiter = RateLimiter()
+        self.download_scheduler = DownloadScheduler()
+        self.download_flights = SingleFlight(on_share=AudioFile.share, on_abandon=AudioFile.abandon)
+        self.search_flights = SingleFlight()
+        self.prefetcher = Prefetcher(
+            lambda track, chat_id: self.download_track(
+                track.webpage_url, chat_id, priority=DownloadScheduler.PRIORITY_BACKGROUND, track_id=track.track_id
+            )
+        )
+        self.search_semaphore = asyncio.Semaphore(SEARCH_THREADS)
+        self.search_executor = InstrumentedExecutor(
+            'search', SEARCH_THREADS,
+            initializer=_warm_up_worker, initargs=('search',)
+        )
+        self.download_executor = InstrumentedExecutor(
+            'download', DOWNLOAD_WORKERS, processes=DOWNLOAD_PROCESSES,
+            initializer=_warm_up_worker, initargs=('download',)
+        )
+        self.state = create_state_backend()
+        self.rate_limiter = RateLimiter(shared=self.state.shared)
         self.transliterator = Transliterator()
         self.app = None
-        self.active_searches = {}  # Хранит результаты поиска по chat_id
+        self._housekeeping_task = None
+        self._warm_up_task = None
+        self._state_sync_task = None
+        self.http_client = None
+        self.search_sessions = SearchSessionStore(  # По (chat_id, message_id)
+            on_remove=self._on_session_removed, backend=self.state
+        )
+        self.file_id_cache = FileIdCache()
+        self.audio_cache = AudioCache()
+        self.transcoder = Transcoder() if TRANSCODE_ENABLED else None
+        if self.transcoder and not self.transcoder.available:
+            logger.warning('⚠️ %s не найден, перекодирование отключено', FFMPEG_PATH)
+            self.transcoder = None
+        # URL -> (причина, размер): треки, отклоненные по метаданным, не проверяются повторно
+        self.rejected_tracks = TTLCache(max_entries=1000, ttl=SEARCH_CACHE_TTL)
+        self.search_cache = TTLCache(
+            max_entries=SEARCH_CACHE_MAX_ENTRIES,
+            max_bytes=SEARCH_CACHE_MAX_MB * 1024 * 1024,
+            ttl=SEARCH_CACHE_TTL,
+            sizeof=self._estimate_tracks_size
+        )
+        self.metrics_server = None
+        self._register_metrics()
         logger.info('✅ Универсальный бот инициализирован')
 
+    def _register_metrics(self):
+        """Снимки stats() компонентов попадают в метрики как gauges"""
+        metrics.register('search_executor', 'Пул поиска', self.search_executor.stats)
+        metrics.register('download_executor', 'Пул скачивания', self.download_executor.stats)
+        metrics.register('download_queue', 'Очередь скачиваний', self.download_scheduler.stats)
+        metrics.register('download_flights', 'Объединенные скачивания', self.download_flights.stats)
+        metrics.register('search_flights', 'Объединенные поиски', self.search_flights.stats)
+        metrics.register('active_searches', 'Поисковые сессии с кнопками', self.search_sessions.stats)
+        metrics.register('search_cache', 'Кэш поиска', self.search_cache.stats)
+        metrics.register('file_id_cache', 'Кэш file_id', self.file_id_cache.stats)
+        metrics.register('audio_cache', 'Дисковый кэш аудио', self.audio_cache.stats)
+        if self.transcoder:
+            metrics.register('transcoder', 'Перекодирование ffmpeg', self.transcoder.stats)
+        metrics.register('prefetch', 'Предзагрузка', self.prefetcher.stats)
+        metrics.register('rate_limiter', 'Лимиты запросов', self.rate_limiter.stats)
+        metrics.register('state', 'Общее состояние воркеров', self.state.stats)
+
     @staticmethod
     def clean_title(title: str) -> str:
         if not title:
             return 'Неизвестный трек'
-        title = re.sub(r"[^\w\s\-\.\(\)\[\]]", '', title)
-        tags = ['official video', 'official music video', 'lyric video', 'hd', '4k',
-                '1080p', '720p', 'official audio', 'audio', 'video', 'clip', 'mv']
-        for tag in tags:
-            title = re.sub(tag, '', title, flags=re.IGNORECASE)
-        return ' '.join(title.split()).strip()
+        return normalize_title(title)
+
+    @staticmethod
+    def _estimate_tracks_size(tracks) -> int:
+        """Примерный объем памяти, занимаемый списком треков"""
+        size = sys.getsizeof(tracks)
+        for track in tracks:
+            size += sys.getsizeof(track)
+            for name in TrackInfo.__slots__:
+                size += sys.getsizeof(getattr(track, name))
+        return size
+
+    @staticmethod
+    def _search_cache_key(query: str, limit: int) -> tuple:
+        """Ключ кэша поиска: нормализованный вариант запроса и лимит"""
+        return (' '.join(query.lower().split()), limit)
 
     @staticmethod
     def format_duration(seconds) -> str:
@@ -183,11 +2876,24 @@ class UniversalMusicBot:
 
     def _create_application(self):
         """Создает и настраивает приложение Telegram"""
-        self.app = Application.builder().token(BOT_TOKEN).build()
+        builder = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .post_init(self._on_startup)
+            .post_stop(self._on_stop)
+            .post_shutdown(self._on_shutdown)
+        )
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(f'{TELEGRAM_API_URL}/bot').base_file_url(f'{TELEGRAM_API_URL}/file/bot')
+        self.app = builder.build()
 
-        # Обработчик ВСЕХ текстовых сообщений ВО ВСЕХ чатах
+        # Текстовые команды "найди"/"рандом" во всех чатах. Регулярное выражение
+        # проверяется фильтром, поэтому остальные сообщения отбрасываются,
+        # не доходя до обработчика, логов и лимитов запросов. Только новые
+        # сообщения: у правок и постов каналов нет update.message/effective_user
         self.app.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND,
+            filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND & filters.Regex(COMMAND_TRIGGER_RE),
             self.handle_all_messages
         ))
 
@@ -202,102 +2908,205 @@ class UniversalMusicBot:
     async def handle_button_click(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает нажатия на кнопки"""
         query = update.callback_query
+        if await self._reject_if_limited(update, 'download'):
+            return
         await query.answer()
         
         data = query.data
         chat_id = query.message.chat_id
         user_id = query.from_user.id
         
-        # Получаем сохраненные результаты поиска
-        if chat_id not in self.active_searches:
+        # Получаем результаты поиска именно для этой клавиатуры
+        session = await self.search_sessions.load(chat_id, query.message.message_id)
+        if session is None:
             await query.edit_message_text("❌ Результаты поиска устарели. Начни новый поиск.")
             return
         
-        search_data = self.active_searches[chat_id]
-        
         # Проверяем, что пользователь, который нажал кнопку, тот же, что и запускал поиск
-        if user_id != search_data.get('user_id'):
+        if user_id != session.user_id:
             await query.answer("❌ Только пользователь, который запустил поиск, может выбирать трек.", show_alert=True)
             return
         
-        tracks = search_data.get('tracks', [])
-        
         # Обработка скачивания выбранного трека
         track_index = int(data.split('_')[1])
-        await self.download_selected_track(update, context, track_index, chat_id, user_id)
+        await self.download_selected_track(update, context, session, track_index)
 
-    async def download_selected_track(self, update: Update, context: ContextTypes.DEFAULT_TYPE, track_index: int, chat_id: int, user_id: int):
+    async def download_selected_track(self, update: Update, context: ContextTypes.DEFAULT_TYPE, session: SearchSession, track_index: int):
         """Скачивает выбранный трек"""
         query = update.callback_query
-        
-        # Получаем сохраненные результаты поиска
-        if chat_id not in self.active_searches:
-            await query.edit_message_text("❌ Результаты поиска устарели. Начни новый поиск.")
-            return
-        
-        search_data = self.active_searches[chat_id]
-        
-        # Дополнительная проверка на случай, если что-то пошло не так
-        if user_id != search_data.get('user_id'):
-            await query.edit_message_text("❌ Ошибка доступа. Начни новый поиск.")
-            return
-        
-        tracks = search_data.get('tracks', [])
+        chat_id = query.message.chat_id
+        tracks = session.tracks
         
         if track_index < 0 or track_index >= len(tracks):
             await query.edit_message_text("❌ Неверный выбор трека.")
             return
         
         track = tracks[track_index]
+
+        # Трек уже отправлялся - пересылаем по file_id без скачивания
+        if await self.send_cached_track(context, chat_id, track):
+            self.search_sessions.pop(chat_id, query.message.message_id)
+            try:
+                await query.message.delete()
+            except:
+                pass
+            return
         
         # Редактируем сообщение для отображения статуса скачивания
-        await query.edit_message_text(
-            f"⏬ Скачивается: <b>{track['title']}</b>\n"
-            f"⏱️ Длительность: {self.format_duration(track.get('duration'))}\n\n"
-            f"⏳ Пожалуйста, подожди...",
-            parse_mode='HTML'
-        )
+        async def show_status(position: int = 0):
+            waiting = f"🕒 Место в очереди: {position}" if position else "⏳ Пожалуйста, подожди..."
+            await query.edit_message_text(
+                f"⏬ Скачивается: <b>{track.title}</b>\n"
+                f"⏱️ Длительность: {self.format_duration(track.duration)}\n\n"
+                f"{waiting}",
+                parse_mode='HTML'
+            )
+
+        await show_status()
         
-        # Скачиваем трек
-        file_path = await self.download_track(track.get('webpage_url'))
-        if not file_path:
+        # Скачиваем и отправляем трек
+        try:
+            delivered = await self.deliver_track(context, chat_id, track, on_queue_position=show_status)
+        except DownloadQueueFull:
+            await query.edit_message_text(
+                f"⏳ Сейчас слишком много загрузок\n"
+                f"💡 Попробуй еще раз через минуту"
+            )
+            return
+        except TrackRejected as e:
             await query.edit_message_text(
-                f"❌ Не удалось скачать трек: {track['title']}\n"
+                f"🚫 {e.user_message}: {track.title}\n"
                 f"💡 Попробуй выбрать другой трек"
             )
             return
-        
-        # Отправляем аудио
-        try:
-            with open(file_path, 'rb') as audio_file:
-                await context.bot.send_audio(
-                    chat_id=chat_id,
-                    audio=audio_file,
-                    title=(track.get('title') or 'Неизвестный трек')[:64],
-                    performer=(track.get('artist') or 'Неизвестный исполнитель')[:64],
-                    caption=f"🎵 <b>{track.get('title', 'Неизвестный трек')}</b>\n"
-                           f"⏱️ {self.format_duration(track.get('duration'))}",
-                    parse_mode='HTML'
-                )
-            
-            # Удаляем временный файл
-            try:
-                os.remove(file_path)
-            except:
-                pass
-            
-            # Удаляем сообщение с кнопками
-            try:
-                await query.message.delete()
-            except:
-                pass
-            
         except Exception as e:
-            logger.exception(f'Ошибка отправки аудио: {e}')
+            logger.exception('Ошибка отправки аудио: %s', e)
             await query.edit_message_text(
                 f"❌ Ошибка отправки трека\n"
                 f"💡 Попробуй еще раз"
             )
+            return
+        if not delivered:
+            await query.edit_message_text(
+                f"❌ Не удалось скачать трек: {track.title}\n"
+                f"💡 Попробуй выбрать другой трек"
+            )
+            return
+        
+        # Удаляем сообщение с кнопками
+        self.search_sessions.pop(chat_id, query.message.message_id)
+        try:
+            await query.message.delete()
+        except:
+            pass
+
+    async def _start_prefetch(self, chat_id: int, message_id: int, tracks: list):
+        """Запускает предзагрузку для сессии, пропуская треки из кэша file_id и дискового кэша"""
+        session = self.search_sessions.get(chat_id, message_id)
+        if session is None:
+            return
+        pending = []
+        for track in tracks[:self.prefetcher.top_n]:
+            url = track.webpage_url
+            if not self.is_valid_url(url) or self.audio_cache.key(track.track_id, url) in self.audio_cache:
+                continue
+            if not await self.file_id_cache.contains(url):
+                pending.append(track)
+        session.prefetched = self.prefetcher.schedule(chat_id, pending)
+
+    def _on_session_removed(self, session: SearchSession):
+        """Сессия истекла или закрыта - отменяем ее предзагрузку"""
+        if session.prefetched:
+            self.prefetcher.release(session.prefetched)
+
+    async def deliver_track(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, track: TrackInfo, on_queue_position=None) -> bool:
+        """Скачивает и отправляет трек. Возвращает False, если трек не удалось скачать.
+
+        Ошибки отправки пробрасываются вызывающему, при переполненной
+        очереди выбрасывается DownloadQueueFull.
+        """
+        audio = self.prefetcher.take(track.webpage_url)
+        if audio:
+            logger.info('⚡ Трек уже предзагружен', extra={'chat_id': chat_id, 'url': track.webpage_url})
+            return await self._send_audio_file(context, chat_id, track, audio)
+
+        # Файл с диска отправляется быстрее потоковой передачи из SoundCloud
+        audio = self._cached_audio(track.webpage_url, track.track_id)
+        if audio:
+            return await self._send_audio_file(context, chat_id, track, audio)
+
+        if STREAMING_UPLOAD:
+            message = await self.download_scheduler.submit(
+                chat_id,
+                lambda: self.stream_track(context.bot, chat_id, track),
+                on_position=on_queue_position
+            )
+            if message:
+                return True
+
+        audio = await self.download_track(
+            track.webpage_url, chat_id, on_queue_position=on_queue_position, track_id=track.track_id
+        )
+        if not audio:
+            return False
+
+        logger.debug('✅ Трек скачан: %s', audio.path, extra={'chat_id': chat_id, 'url': track.webpage_url})
+        return await self._send_audio_file(context, chat_id, track, audio)
+
+    async def _send_audio_file(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, track: TrackInfo, audio: AudioFile) -> bool:
+        """Отправляет скачанный файл и освобождает его"""
+        try:
+            with open(audio.path, 'rb') as audio_file, metrics.timer('stage_seconds', stage='upload'):
+                await self.send_track_audio(context, chat_id, track, audio_file)
+        finally:
+            # Файл удаляется после последней отправки
+            audio.release()
+        return True
+
+    def _audio_fields(self, track: TrackInfo) -> dict:
+        """Подпись и метаданные для sendAudio"""
+        return {
+            'title': (track.title or 'Неизвестный трек')[:64],
+            'performer': (track.artist or 'Неизвестный исполнитель')[:64],
+            'caption': f"🎵 <b>{track.title or 'Неизвестный трек'}</b>\n"
+                       f"⏱️ {self.format_duration(track.duration)}",
+            'parse_mode': 'HTML',
+        }
+
+    async def send_track_audio(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, track: TrackInfo, audio):
+        """Отправляет аудио и запоминает file_id для повторных отправок"""
+        message = await context.bot.send_audio(chat_id=chat_id, audio=audio, **self._audio_fields(track))
+
+        # Повторная отправка по file_id не требует обновления кэша
+        if not isinstance(audio, str) and message.audio:
+            await self.file_id_cache.put(track.webpage_url, message.audio.file_id)
+
+        return message
+
+    async def send_cached_track(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, track: TrackInfo) -> bool:
+        """Отправляет трек по сохраненному file_id. Возвращает True, если удалось"""
+        url = track.webpage_url
+        file_id = await self.file_id_cache.get(url)
+        if not file_id:
+            return False
+
+        try:
+            with metrics.timer('stage_seconds', stage='upload_file_id'):
+                await self.send_track_audio(context, chat_id, track, file_id)
+        except BadRequest as e:
+            # file_id стал недействительным - забываем его и качаем заново
+            logger.warning('Недействительный file_id для %s: %s', url, e)
+            metrics.inc('failures_total', reason='stale_file_id')
+            await self.file_id_cache.delete(url)
+            return False
+        except NetworkError as e:
+            # TimedOut и обрывы связи: file_id не трогаем, вызывающий уходит на скачивание
+            logger.warning('Не удалось отправить трек по file_id: %s', e, extra={'chat_id': chat_id, 'url': url})
+            metrics.inc('failures_total', reason='file_id_network')
+            return False
+
+        logger.info('⚡ Трек отправлен из кэша file_id', extra={'chat_id': chat_id, 'url': url})
+        return True
 
     def create_tracks_keyboard(self, tracks):
         """Создает клавиатуру только с треками (кнопки на всю ширину)"""
@@ -305,8 +3114,8 @@ class UniversalMusicBot:
         
         # Добавляем кнопки для каждого трека (каждая на всю ширину)
         for i, track in enumerate(tracks):
-            title = track.get('title', 'Неизвестный трек')
-            duration = self.format_duration(track.get('duration'))
+            title = track.title or 'Неизвестный трек'
+            duration = self.format_duration(track.duration)
             
             # Обрезаем длинные названия и добавляем длительность
             button_text = f"{i+1}. {title[:30]}{'...' if len(title) > 30 else ''} ({duration})"
@@ -333,42 +3142,56 @@ class UniversalMusicBot:
         """Обрабатывает команду /random"""
         await self.handle_random_command(update, context)
 
+    async def _reject_if_limited(self, update: Update, kind: str) -> bool:
+        """Проверяет лимит запросов; при превышении отвечает пользователю и возвращает True"""
+        user = update.effective_user
+        wait = self.rate_limiter.retry_after(user.id, kind, update.effective_chat.id)
+        if not wait:
+            return False
+
+        logger.info('⏳ Превышен лимит запросов', extra={
+            'sample': True, 'kind': kind, 'user_id': user.id,
+            'chat_id': update.effective_chat.id, 'retry_after': round(wait, 1),
+        })
+        seconds = int(wait) + 1
+        if update.callback_query:
+            await update.callback_query.answer(
+                f"⏳ Слишком много запросов! Подожди {seconds} сек.", show_alert=True
+            )
+        else:
+            await update.message.reply_text(
+                f"⏳ {user.mention_html()}, слишком много запросов!\n"
+                f"Подожди {seconds} сек. перед следующим запросом.",
+                parse_mode='HTML'
+            )
+        return True
+
     # ==================== ОБРАБОТКА ВСЕХ СООБЩЕНИЙ ====================
 
     async def handle_all_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обрабатывает ВСЕ сообщения из любых чатов"""
+        """Обрабатывает текстовые команды "найди" и "рандом" из любых чатов.
+
+        Сюда попадают только сообщения, прошедшие COMMAND_TRIGGER_RE в фильтре;
+        какая команда сработала, видно по группе совпадения в context.matches.
+        """
         try:
-            if not update.message or not update.message.text:
-                return
-                
             message_text = update.message.text.strip().lower()
-            chat_id = update.effective_chat.id
             user = update.effective_user
+            command = context.matches[0].lastgroup
             
-            print(f"🎯 Сообщение от {user.first_name} (ID: {user.id}): {message_text}")
-
-            # Rate limiting
-            if self.rate_limiter.is_limited(user.id):
-                await update.message.reply_text(
-                    f"⏳ {user.mention_html()}, слишком много запросов!\n"
-                    f"Подожди 1 минуту перед следующим запросом.",
-                    parse_mode='HTML'
-                )
-                return
+            logger.info('🎯 Сообщение от %s', user.first_name, extra={
+                'sample': True, 'command': command, 'user_id': user.id,
+                'chat_id': update.effective_chat.id, 'text': message_text,
+            })
 
-            # Реагируем ТОЛЬКО на команды "найди" и "рандом"
-            if message_text.startswith('найди'):
+            # Лимит запросов проверяется уже в обработчиках команд
+            if command == 'find':
                 await self.handle_find_command(update, context, message_text)
-            
-            elif message_text.startswith('рандом'):
-                await self.handle_random_command(update, context)
-            
-            # Игнорируем все остальные сообщения
             else:
-                return
+                await self.handle_random_command(update, context)
                 
         except Exception as e:
-            logger.exception(f'Ошибка обработки сообщения: {e}')
+            logger.exception('Ошибка обработки сообщения: %s', e)
 
     async def handle_find_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
         """Обрабатывает поиск трека по запросу"""
@@ -389,6 +3212,19 @@ class UniversalMusicBot:
                 )
                 return
 
+            # "найди 5 треков ..." и "найди <ссылка на плейлист>" отправляются пакетом
+            count, bulk_query = split_bulk_count(query)
+            set_match = SOUNDCLOUD_SET_RE.search(original_message.text or '')
+            if set_match or (count > 1 and bulk_query):
+                await self.handle_bulk_command(
+                    update, context, bulk_query, count if count > 1 else BULK_MAX_TRACKS,
+                    set_url=set_match.group(0) if set_match else None
+                )
+                return
+
+            if await self._reject_if_limited(update, 'search'):
+                return
+
             # Отправляем статус
             status_msg = await original_message.reply_text(
                 f"🔍 Ищу: <code>{query}</code>\n⏳ Пожалуйста, подожди...", 
@@ -406,14 +3242,12 @@ class UniversalMusicBot:
                 )
                 return
 
-            print(f"✅ Найдено {len(tracks)} треков по запросу: {query}")
+            logger.info('✅ Найдены треки для выбора', extra={
+                'chat_id': chat_id, 'user_id': user.id, 'query': query, 'tracks': len(tracks),
+            })
 
-            # Сохраняем результаты поиска вместе с ID пользователя
-            self.active_searches[chat_id] = {
-                'query': query,
-                'tracks': tracks,
-                'user_id': user.id  # Сохраняем ID пользователя, который запустил поиск
-            }
+            # Сохраняем результаты поиска вместе с ID пользователя, который запустил поиск
+            self.search_sessions.put(chat_id, status_msg.message_id, SearchSession(query, tracks, user.id))
 
             # Создаем клавиатуру с результатами
             keyboard = self.create_tracks_keyboard(tracks)
@@ -425,9 +3259,12 @@ class UniversalMusicBot:
                 parse_mode='HTML'
             )
 
+            # Пока пользователь выбирает, начинаем качать лучшие результаты
+            if PREFETCH_ENABLED:
+                await self._start_prefetch(chat_id, status_msg.message_id, tracks)
+
         except Exception as e:
-            logger.exception(f'Ошибка при поиске: {e}')
-            print(f"❌ Критическая ошибка в handle_find_command: {e}")
+            logger.exception('Ошибка при поиске: %s', e)
             if status_msg:
                 await status_msg.edit_text(
                     f"❌ Ошибка при поиске\n"
@@ -443,12 +3280,15 @@ class UniversalMusicBot:
             chat_id = update.effective_chat.id
             original_message = update.message
 
+            if await self._reject_if_limited(update, 'random'):
+                return
+
             # Отправляем статус
             status_msg = await original_message.reply_text("🎲 Ищу случайный трек...", parse_mode='HTML')
 
             # Случайный запрос
             random_query = random.choice(RANDOM_SEARCHES)
-            print(f"🎲 Случайный запрос: {random_query}")
+            logger.info('🎲 Случайный запрос', extra={'chat_id': chat_id, 'user_id': user.id, 'query': random_query})
             
             # Ищем треки
             tracks = await self.find_multiple_tracks(random_query, limit=1)
@@ -462,48 +3302,58 @@ class UniversalMusicBot:
                 return
 
             track = tracks[0]
-            print(f"✅ Найден случайный трек: {track['title']}")
+            logger.debug('✅ Найден случайный трек: %s', track.title, extra={'url': track.webpage_url})
 
-            # Скачиваем трек
-            file_path = await self.download_track(track.get('webpage_url'))
-            if not file_path:
-                print(f"❌ Не удалось скачать случайный трек: {track['title']}")
-                await status_msg.edit_text(
-                    f"❌ Не удалось скачать случайный трек\n"
-                    f"🎵 {track.get('title', 'Неизвестный трек')}",
-                    parse_mode='HTML'
-                )
+            # Трек уже отправлялся - пересылаем по file_id без скачивания
+            if await self.send_cached_track(context, chat_id, track):
+                try:
+                    await status_msg.delete()
+                except:
+                    pass
                 return
 
-            print(f"✅ Случайный трек скачан: {file_path}")
+            # Скачиваем и отправляем трек
+            async def show_queue_position(position: int):
+                waiting = f"🕒 Место в очереди: {position}" if position else "⏬ Скачиваю..."
+                await status_msg.edit_text(f"🎲 {track.title}\n{waiting}")
 
-            # Отправляем аудио
             try:
-                with open(file_path, 'rb') as audio_file:
-                    await context.bot.send_audio(
-                        chat_id=chat_id,
-                        audio=audio_file,
-                        title=(track.get('title') or 'Неизвестный трек')[:64],
-                        performer=(track.get('artist') or 'Неизвестный исполнитель')[:64],
-                        caption=f"🎵 <b>{track.get('title', 'Неизвестный трек')}</b>\n"
-                               f"⏱️ {self.format_duration(track.get('duration'))}",
-                        parse_mode='HTML'
-                    )
-                print(f"✅ Случайное аудио отправлено в чат {chat_id}")
+                delivered = await self.deliver_track(
+                    context, chat_id, track, on_queue_position=show_queue_position
+                )
+            except DownloadQueueFull:
+                await status_msg.edit_text(
+                    f"⏳ Сейчас слишком много загрузок\n"
+                    f"💡 Попробуй еще раз через минуту"
+                )
+                return
+            except TrackRejected as e:
+                await status_msg.edit_text(
+                    f"🚫 {e.user_message}\n"
+                    f"🎵 {track.title or 'Неизвестный трек'}\n"
+                    f"💡 Попробуй еще раз"
+                )
+                return
             except Exception as e:
-                print(f"❌ Ошибка отправки случайного аудио: {e}")
+                logger.warning('❌ Ошибка отправки случайного аудио: %s', e,
+                               extra={'chat_id': chat_id, 'url': track.webpage_url})
                 await status_msg.edit_text(
                     f"❌ Ошибка отправки трека\n"
                     f"💡 Попробуй еще раз",
                     parse_mode='HTML'
                 )
                 return
+            if not delivered:
+                logger.warning('❌ Не удалось скачать случайный трек: %s', track.title,
+                               extra={'chat_id': chat_id, 'url': track.webpage_url})
+                await status_msg.edit_text(
+                    f"❌ Не удалось скачать случайный трек\n"
+                    f"🎵 {track.title or 'Неизвестный трек'}",
+                    parse_mode='HTML'
+                )
+                return
 
-            # Удаляем временный файл
-            try:
-                os.remove(file_path)
-            except:
-                pass
+            logger.info('✅ Случайное аудио отправлено', extra={'chat_id': chat_id, 'url': track.webpage_url})
 
             # Удаляем статус-сообщение
             try:
@@ -512,8 +3362,7 @@ class UniversalMusicBot:
                 pass
 
         except Exception as e:
-            logger.exception(f'Ошибка при поиске случайного трека: {e}')
-            print(f"❌ Критическая ошибка в handle_random_command: {e}")
+            logger.exception('Ошибка при поиске случайного трека: %s', e)
             if status_msg:
                 await status_msg.edit_text(
                     f"❌ Ошибка при поиске\n"
@@ -521,87 +3370,354 @@ class UniversalMusicBot:
                     parse_mode='HTML'
                 )
 
+    # ==================== ПАКЕТНЫЙ РЕЖИМ ====================
+
+    async def handle_bulk_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query: str,
+                                  count: int, set_url: str = None):
+        """Находит count треков по запросу (или берет их из плейлиста) и отправляет альбомами"""
+        status_msg = None
+        try:
+            user = update.effective_user
+            chat_id = update.effective_chat.id
+
+            if await self._reject_if_limited(update, 'bulk'):
+                return
+
+            status_msg = await update.message.reply_text(
+                f"📦 Ищу треки ({count}): <code>{set_url or query}</code>\n⏳ Пожалуйста, подожди...",
+                parse_mode='HTML'
+            )
+
+            if set_url:
+                title, tracks = await self._resolve_set(set_url, count)
+            else:
+                title, tracks = query, await self.find_multiple_tracks(query, limit=count)
+
+            if not tracks:
+                await status_msg.edit_text(
+                    f"❌ Не найдено треков по запросу: <code>{set_url or query}</code>\n"
+                    f"💡 Попробуй другой запрос",
+                    parse_mode='HTML'
+                )
+                return
+
+            logger.info('📦 Пакетная отправка', extra={
+                'chat_id': chat_id, 'user_id': user.id, 'query': set_url or query, 'tracks': len(tracks),
+            })
+            progress = BulkProgress(status_msg, title, len(tracks))
+            await progress.update(force=True)
+            with metrics.timer('stage_seconds', stage='bulk'):
+                await self._deliver_bulk(context, chat_id, tracks, progress)
+
+            logger.info('✅ Пакет отправлен', extra={
+                'chat_id': chat_id, 'tracks': len(tracks), 'sent': progress.sent, 'failed': len(progress.failed),
+            })
+            if not progress.failed:
+                try:
+                    await status_msg.delete()
+                except:
+                    pass
+                return
+            failed = '\n'.join(f"• {title}" for title in progress.failed[:5])
+            await status_msg.edit_text(
+                f"{progress.text()}\n\n🚫 Не отправлены:\n{failed}",
+                parse_mode='HTML'
+            )
+
+        except Exception as e:
+            logger.exception('Ошибка пакетной отправки: %s', e)
+            if status_msg:
+                await status_msg.edit_text(
+                    f"❌ Ошибка при поиске\n"
+                    f"💡 Попробуй еще раз",
+                    parse_mode='HTML'
+                )
+
+    async def _resolve_set(self, url: str, limit: int) -> tuple:
+        """Название плейлиста и его первые limit треков"""
+        async with self.search_semaphore:
+            info = await asyncio.wait_for(
+                self.search_executor.run(_resolve_set_in_worker, url, limit),
+                timeout=SEARCH_TIMEOUT
+            )
+        if not info:
+            return '', []
+        tracks = [
+            TrackInfo(entry['title'] and self.clean_title(entry['title']), entry['url'],
+                      entry['duration'], entry['uploader'], entry['id'])
+            for entry in info['entries']
+        ]
+        return self.clean_title(info['title']), tracks
+
+    async def _describe_track(self, track: TrackInfo) -> TrackInfo:
+        """Дополняет трек плейлиста названием, длительностью и постоянной ссылкой"""
+        async with self.search_semaphore:
+            info = await asyncio.wait_for(
+                self.search_executor.run(_track_info_in_worker, track.webpage_url),
+                timeout=SEARCH_TIMEOUT
+            )
+        if not info:
+            return track
+        return TrackInfo(self.clean_title(info['title']), info['url'], info['duration'],
+                         info['uploader'], info['id'] or track.track_id)
+
+    async def _deliver_bulk(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, tracks: list,
+                            progress: BulkProgress):
+        """Готовит треки параллельно и отправляет их альбомами по MEDIA_GROUP_SIZE.
+
+        Одновременно готовится не больше BULK_CONCURRENCY треков, в порядке
+        выдачи; альбом уходит, как только готовы все его треки, пока
+        следующие еще качаются.
+        """
+        semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+        async def prepare(track: TrackInfo):
+            item = None
+            async with semaphore:
+                try:
+                    item = await self._prepare_bulk_track(chat_id, track)
+                except TrackRejected as e:
+                    logger.info('🚫 Трек пакета отклонен: %s', e.user_message,
+                                extra={'chat_id': chat_id, 'url': track.webpage_url})
+                except DownloadQueueFull:
+                    logger.info('⏳ Очередь скачиваний переполнена, трек пакета пропущен',
+                                extra={'chat_id': chat_id, 'url': track.webpage_url})
+                except Exception as e:
+                    logger.warning('❌ Не удалось подготовить трек пакета: %s', e,
+                                   extra={'chat_id': chat_id, 'url': track.webpage_url})
+            if item:
+                progress.ready += 1
+            else:
+                progress.failed.append(track.title or 'Неизвестный трек')
+            await progress.update()
+            return item
+
+        tasks = [asyncio.create_task(prepare(track)) for track in tracks]
+        consumed = 0
+        try:
+            for start in range(0, len(tasks), MEDIA_GROUP_SIZE):
+                items = [item for item in await asyncio.gather(*tasks[start:start + MEDIA_GROUP_SIZE]) if item]
+                consumed = start + MEDIA_GROUP_SIZE
+                if items:
+                    try:
+                        failed = await self._send_media_group(context, chat_id, items)
+                    except Exception as e:
+                        logger.warning('❌ Ошибка отправки альбома: %s', e, extra={'chat_id': chat_id})
+                        failed = [track for track, _ in items]
+                    progress.sent += len(items) - len(failed)
+                    progress.failed.extend(track.title or 'Неизвестный трек' for track in failed)
+                await progress.update(force=True)
+        finally:
+            # Прерванная отправка: отменяем подготовку и освобождаем уже готовые файлы
+            for task in tasks[consumed:]:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.result():
+                    self._release_sources([task.result()])
+
+    async def _prepare_bulk_track(self, chat_id: int, track: TrackInfo):
+        """Пара (трек, file_id или AudioFile) для альбома или None, если трек не скачался"""
+        if not track.title:
+            # У части треков плейлиста известны только ссылка и id
+            track = await self._describe_track(track)
+
+        file_id = await self.file_id_cache.get(track.webpage_url)
+        if file_id:
+            return track, file_id
+
+        audio = self.prefetcher.take(track.webpage_url) or await self.download_track(
+            track.webpage_url, chat_id, track_id=track.track_id
+        )
+        return (track, audio) if audio else None
+
+    async def _send_media_group(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, items: list) -> list:
+        """Отправляет готовые треки одним альбомом и освобождает их файлы.
+
+        items - пары (трек, file_id или AudioFile). Возвращает треки, которые
+        не удалось отправить. Одиночный трек уходит обычным sendAudio; если
+        альбом отклонен (например, устаревший file_id), треки идут по одному.
+        """
+        if len(items) == 1:
+            return [track for track, source in items if not await self._send_bulk_item(context, chat_id, track, source)]
+
+        try:
+            with contextlib.ExitStack() as files:
+                media = [
+                    InputMediaAudio(
+                        source if isinstance(source, str) else files.enter_context(open(source.path, 'rb')),
+                        duration=int(track.duration or 0), **self._audio_fields(track)
+                    )
+                    for track, source in items
+                ]
+                with metrics.timer('stage_seconds', stage='upload_group'):
+                    # До десяти файлов в одном запросе: обычного таймаута записи не хватает
+                    messages = await context.bot.send_media_group(
+                        chat_id=chat_id, media=media, write_timeout=DOWNLOAD_TIMEOUT
+                    )
+        except BadRequest as e:
+            logger.warning('Альбом не принят, отправляем треки по одному: %s', e, extra={'chat_id': chat_id})
+            metrics.inc('failures_total', reason='media_group')
+            return [track for track, source in items if not await self._send_bulk_item(context, chat_id, track, source)]
+        except BaseException:
+            self._release_sources(items)
+            raise
+
+        self._release_sources(items)
+        for (track, source), message in zip(items, messages):
+            if not isinstance(source, str) and message.audio:
+                await self.file_id_cache.put(track.webpage_url, message.audio.file_id)
+        return []
+
+    async def _send_bulk_item(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, track: TrackInfo, source) -> bool:
+        """Отправляет один трек пакета; ошибка не прерывает остальные треки"""
+        try:
+            if isinstance(source, str):
+                # Устаревший file_id send_cached_track забывает, и трек качается заново
+                return await self.send_cached_track(context, chat_id, track) or \
+                    await self.deliver_track(context, chat_id, track)
+            return await self._send_audio_file(context, chat_id, track, source)
+        except Exception as e:
+            logger.warning('❌ Не удалось отправить трек пакета: %s', e,
+                           extra={'chat_id': chat_id, 'url': track.webpage_url})
+            return False
+
+    @staticmethod
+    def _release_sources(items: list):
+        for _, source in items:
+            if isinstance(source, AudioFile):
+                source.release()
+
     def extract_search_query(self, message_text: str) -> str:
         """Извлекает поисковый запрос из сообщения"""
-        query = message_text.replace('найди', '').strip()
-        stop_words = ['пожалуйста', 'мне', 'трек', 'песню', 'музыку', 'плз', 'plz']
-        for word in stop_words:
-            query = query.replace(word, '')
-        return query.strip()
+        return normalize_search_query(message_text)
 
     # ==================== ПОИСК ТРЕКОВ С ТРАНСЛИТЕРАЦИЕЙ ====================
 
     async def find_multiple_tracks(self, query: str, limit: int = 3):
         """Находит несколько треков по запросу с использованием транслитерации"""
-        async with self.search_semaphore:
-            # Генерируем варианты поиска с транслитерацией
+        # Генерируем варианты поиска с транслитерацией
+        with metrics.timer('stage_seconds', stage='translit'):
             search_variants = self.transliterator.generate_search_variants(query)
-            print(f"🔍 Варианты поиска: {search_variants}")
-            
-            all_tracks = []
-            
-            # Пробуем каждый вариант поиска
-            for search_query in search_variants:
-                print(f"🔍 Пробуем поиск: {search_query}")
-                tracks = await self._search_tracks(search_query, limit * 2)
-                
-                if tracks:
-                    print(f"✅ Найдено {len(tracks)} треков по запросу: {search_query}")
-                    all_tracks.extend(tracks)
-            
-            if not all_tracks:
-                print(f"❌ Не найдено треков ни по одному варианту: {search_variants}")
-                return None
-            
-            # Убираем дубликаты по URL
-            unique_tracks = {}
-            for track in all_tracks:
-                url = track.get('webpage_url')
-                if url and url not in unique_tracks:
-                    unique_tracks[url] = track
-            
-            # Сортируем по релевантности
-            sorted_tracks = self._sort_tracks_by_relevance(list(unique_tracks.values()), query)
-            
-            # Возвращаем лучшие треки
-            return sorted_tracks[:limit]
+        logger.debug('🔍 Варианты поиска: %s', search_variants, extra={'query': query})
+        
+        all_tracks = []
+        
+        # Ищем все варианты одновременно с общим дедлайном
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SEARCH_TIMEOUT
+        tasks = {
+            asyncio.create_task(self._search_tracks(search_query, limit * 2)): search_query
+            for search_query in search_variants
+        }
+        pending = set(tasks)
+        
+        try:
+            while pending:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    metrics.inc('timeouts_total', stage='find')
+                    logger.warning('⏱️ Общий таймаут поиска, используем частичные результаты',
+                                   extra={'query': query, 'tracks': len(all_tracks)})
+                    break
+
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tracks = task.result()
+                    if tracks:
+                        logger.debug('✅ Найдено %d треков по варианту: %s', len(tracks), tasks[task],
+                                     extra={'query': query})
+                        all_tracks.extend(tracks)
+
+                if pending and self._has_enough_relevant(all_tracks, query, limit):
+                    logger.debug('⚡ Достаточно релевантных треков, остальные варианты не ждем',
+                                 extra={'query': query, 'skipped_variants': len(pending)})
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+
+        # Мало результатов по латинскому запросу - возможно, это транслит без явных признаков
+        fallback = self.transliterator.fallback_variant(query)
+        if fallback and len({track.webpage_url for track in all_tracks}) < limit and deadline > loop.time():
+            logger.debug('🔍 Запасной вариант поиска: %s', fallback, extra={'query': query})
+            try:
+                all_tracks.extend(await asyncio.wait_for(
+                    self._search_tracks(fallback, limit * 2), timeout=deadline - loop.time()
+                ) or [])
+            except asyncio.TimeoutError:
+                metrics.inc('timeouts_total', stage='find')
+
+        metrics.observe('stage_seconds', SEARCH_TIMEOUT - (deadline - loop.time()), stage='find')
+        if not all_tracks:
+            metrics.inc('failures_total', reason='not_found')
+            logger.info('❌ Не найдено треков ни по одному варианту: %s', search_variants, extra={'query': query})
+            return None
+        
+        # Убираем дубликаты по URL
+        unique_tracks = {}
+        for track in all_tracks:
+            url = track.webpage_url
+            if url and url not in unique_tracks:
+                unique_tracks[url] = track
+        
+        # Сортируем по релевантности
+        sorted_tracks = self._sort_tracks_by_relevance(list(unique_tracks.values()), query)
+        
+        # Возвращаем лучшие треки
+        return sorted_tracks[:limit]
 
     async def _search_tracks(self, query: str, limit: int = 6):
         """Внутренняя функция поиска треков"""
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'ignoreerrors': True,
-            'noplaylist': True,
-            'socket_timeout': 15,
-        }
+        # Повторные запросы отдаем из кэша, не занимая слот поиска
+        cache_key = self._search_cache_key(query, limit)
+        cached = self.search_cache.get(cache_key, _MISSING)
+        if cached is _MISSING and self.state.shared:
+            # Тот же запрос мог недавно выполнить другой воркер
+            shared = await self.state.load_search(cache_key)
+            if shared is not None:
+                cached, ttl = shared
+                self.search_cache.set(cache_key, cached, ttl=ttl)
+        if cached is not _MISSING:
+            logger.debug('⚡ Поиск из кэша', extra={'query': query})
+            return list(cached) or None
 
+        # Одинаковые одновременные запросы ждут один общий поиск
+        return await self.search_flights.run(
+            cache_key,
+            lambda: self._perform_search(query, limit, cache_key)
+        )
+
+    def _cache_search(self, cache_key: tuple, tracks: tuple, ttl: float):
+        """Сохраняет результат поиска локально и в общем хранилище"""
+        self.search_cache.set(cache_key, tracks, ttl=ttl)
+        self.state.save_search(cache_key, tracks, ttl)
+
+    async def _perform_search(self, query: str, limit: int, cache_key: tuple):
+        """Выполняет поиск через yt-dlp и сохраняет результат в кэш"""
+        started_at = time.monotonic()
         try:
-            print(f"🔍 Выполняем поиск: {query}")
-            
-            def perform_search():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    return ydl.extract_info(f"scsearch{limit}:{query}", download=False)
+            logger.debug('🔍 Выполняем поиск', extra={'query': query})
 
-            loop = asyncio.get_event_loop()
-            info = await asyncio.wait_for(
-                loop.run_in_executor(None, perform_search),
-                timeout=SEARCH_TIMEOUT
-            )
+            async with self.search_semaphore:
+                info = await asyncio.wait_for(
+                    self.search_executor.run(_search_in_worker, query, limit),
+                    timeout=SEARCH_TIMEOUT
+                )
 
             if not info:
-                print(f"❌ Поиск не дал результатов: {query}")
+                logger.info('❌ Поиск не дал результатов', extra={'query': query})
                 return None
 
             entries = info.get('entries', [])
             if not entries and info.get('_type') != 'playlist':
                 entries = [info]
 
-            print(f"✅ Найдено {len(entries)} результатов по запросу: {query}")
+            logger.debug('✅ Найдено %d результатов', len(entries), extra={
+                'query': query, 'duration_ms': round((time.monotonic() - started_at) * 1000),
+            })
 
             # Фильтрация и сортировка для лучшей релевантности
+            scorer = RelevanceScorer(query)
             filtered_entries = []
             for entry in entries:
                 if not entry:
@@ -616,21 +3732,7 @@ class UniversalMusicBot:
                 if not title:
                     continue
 
-                # Приоритет для "official" треков
-                priority = 0
-                title_lower = title.lower()
-                query_lower = query.lower()
-                
-                # Повышаем приоритет, если запрос точно совпадает с названием
-                if query_lower in title_lower:
-                    priority += 2
-                
-                if 'official' in title_lower:
-                    priority += 3
-                elif 'original' in title_lower:
-                    priority += 2
-                elif 'cover' not in title_lower and 'remix' not in title_lower:
-                    priority += 1
+                priority = scorer.score(title, entry.get('uploader') or '')
 
                 filtered_entries.append({
                     'entry': entry,
@@ -640,7 +3742,8 @@ class UniversalMusicBot:
                 })
 
             if not filtered_entries:
-                print("❌ Нет подходящих треков после фильтрации")
+                logger.info('❌ Нет подходящих треков после фильтрации', extra={'query': query})
+                self._cache_search(cache_key, (), SEARCH_CACHE_NEGATIVE_TTL)
                 return None
 
             # Сортируем по приоритету и длительности
@@ -650,140 +3753,291 @@ class UniversalMusicBot:
             results = []
             for i in range(min(limit, len(filtered_entries))):
                 best_entry = filtered_entries[i]['entry']
-                title = self.clean_title(best_entry.get('title') or '')
+                title = filtered_entries[i]['title']
                 webpage_url = best_entry.get('webpage_url') or best_entry.get('url') or ''
                 duration = best_entry.get('duration') or 0
                 artist = best_entry.get('uploader') or best_entry.get('uploader_id') or 'Неизвестно'
+                track_id = str(best_entry.get('id') or '')
 
                 if not webpage_url:
                     continue
 
-                results.append({
-                    'title': title,
-                    'webpage_url': webpage_url,
-                    'duration': duration,
-                    'artist': artist
-                })
+                results.append(TrackInfo(title, webpage_url, duration, artist, track_id))
 
-            print(f"🎵 Выбрано {len(results)} лучших треков")
-            return results
+            logger.info('🎵 Выбрано %d лучших треков', len(results), extra={
+                'query': query, 'duration_ms': round((time.monotonic() - started_at) * 1000),
+            })
+            self._cache_search(cache_key, tuple(results), SEARCH_CACHE_TTL if results else SEARCH_CACHE_NEGATIVE_TTL)
+            return results or None
 
         except asyncio.TimeoutError:
-            logger.warning(f"Таймаут поиска: {query}")
-            print(f"❌ Таймаут поиска: {query}")
+            metrics.inc('timeouts_total', stage='search')
+            logger.warning('❌ Таймаут поиска', extra={
+                'query': query, 'duration_ms': round((time.monotonic() - started_at) * 1000),
+            })
             return None
         except Exception as e:
-            logger.warning(f'Ошибка поиска: {e}')
-            print(f"❌ Ошибка поиска: {e}")
+            metrics.inc('failures_total', reason='search_error')
+            logger.warning('❌ Ошибка поиска: %s', e, extra={'query': query})
             return None
+        finally:
+            metrics.observe('stage_seconds', time.monotonic() - started_at, stage='search')
+
+    def _has_enough_relevant(self, tracks: list, original_query: str, limit: int) -> bool:
+        """Есть ли уже limit разных треков с оценкой не ниже EARLY_STOP_SCORE"""
+        scorer = RelevanceScorer(original_query)
+        relevant_urls = {
+            track.webpage_url for track in tracks
+            if scorer.score_track(track) >= EARLY_STOP_SCORE
+        }
+        return len(relevant_urls) >= limit
 
     def _sort_tracks_by_relevance(self, tracks: list, original_query: str) -> list:
         """Сортирует треки по релевантности запросу"""
-        original_query_lower = original_query.lower()
-        
-        for track in tracks:
-            title_lower = track.get('title', '').lower()
-            relevance_score = 0
-            
-            # Высокий приоритет для точного совпадения
-            if original_query_lower in title_lower:
-                relevance_score += 10
-            
-            # Приоритет для официальных релизов
-            if 'official' in title_lower:
-                relevance_score += 5
-            elif 'original' in title_lower:
-                relevance_score += 3
-            
-            # Штраф за каверы и ремиксы (если не запрашивались явно)
-            if 'cover' in title_lower and 'cover' not in original_query_lower:
-                relevance_score -= 2
-            if 'remix' in title_lower and 'remix' not in original_query_lower:
-                relevance_score -= 2
-            
-            track['relevance_score'] = relevance_score
-        
-        # Сортируем по релевантности (убывание) и длительности (убывание)
-        tracks.sort(key=lambda x: (-x.get('relevance_score', 0), -x.get('duration', 0)))
-        
-        return tracks
+        return RelevanceScorer(original_query).rank(tracks)
 
     # ==================== СКАЧИВАНИЕ ====================
 
-    async def download_track(self, url: str) -> str:
-        """Скачивает трек и возвращает путь к файлу"""
-        if not self.is_valid_url(url):
-            print(f"❌ Невалидный URL: {url}")
+    async def stream_track(self, bot, chat_id: int, track: TrackInfo):
+        """Отправляет трек потоком: байты из SoundCloud сразу уходят в sendAudio.
+
+        Возвращает отправленное сообщение или None, если нужно скачать трек
+        обычным способом (нет прямого mp3/m4a, неизвестный размер, ошибка).
+        """
+        if not self.is_valid_url(track.webpage_url):
             return None
 
-        loop = asyncio.get_event_loop()
-        tmpdir = tempfile.mkdtemp()
-        
         try:
-            ydl_opts = SOUNDCLOUD_OPTS.copy()
-            ydl_opts['outtmpl'] = os.path.join(tmpdir, '%(title).100s.%(ext)s')
-
-            print(f"⏬ Начинаем скачивание: {url}")
+            source = await asyncio.wait_for(
+                self.download_executor.run(_resolve_stream_in_worker, track.webpage_url),
+                timeout=SEARCH_TIMEOUT
+            )
+        except Exception as e:
+            logger.warning('Не удалось получить прямую ссылку: %s', e)
+            return None
 
-            def download_track():
-                try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        result = ydl.extract_info(url, download=True)
-                        print(f"✅ yt-dlp завершил скачивание")
-                        return result
-                except Exception as e:
-                    print(f"❌ Ошибка в yt-dlp: {e}")
-                    return None
+        if not source:
+            metrics.inc('failures_total', reason='no_direct_stream')
+            logger.debug('↩️ Нет прямого аудиопотока, скачиваем файлом', extra={'url': track.webpage_url})
+            return None
 
-            info = await asyncio.wait_for(
-                loop.run_in_executor(None, download_track),
+        started_at = time.monotonic()
+        try:
+            message = await asyncio.wait_for(
+                self._stream_upload(bot, chat_id, track, source),
                 timeout=DOWNLOAD_TIMEOUT
             )
+        except Exception as e:
+            metrics.inc('failures_total', reason='stream_error')
+            logger.warning('Ошибка потоковой отправки, скачиваем файлом: %s', e)
+            return None
+        finally:
+            metrics.observe('stage_seconds', time.monotonic() - started_at, stage='stream_upload')
+
+        if message and message.audio:
+            logger.info('✅ Трек отправлен потоком', extra={
+                'chat_id': chat_id, 'url': track.webpage_url,
+                'duration_ms': round((time.monotonic() - started_at) * 1000),
+            })
+            await self.file_id_cache.put(track.webpage_url, message.audio.file_id)
+        return message
+
+    async def _stream_upload(self, bot, chat_id: int, track: TrackInfo, source: dict):
+        """Передает аудио из source['url'] в sendAudio кусками по STREAM_CHUNK_SIZE"""
+        limit = MAX_FILE_SIZE_MB * 1024 * 1024
+
+        async with self.http_client.stream('GET', source['url'], headers=source['headers']) as response:
+            response.raise_for_status()
+            length = int(response.headers.get('Content-Length') or 0)
+            if length >= limit or (not length and (source['filesize'] or 0) >= limit):
+                metrics.inc('failures_total', reason='too_large')
+                logger.warning('❌ Файл слишком большой для потоковой отправки',
+                               extra={'url': track.webpage_url, 'bytes': length or source['filesize']})
+                return None
+
+            boundary = uuid.uuid4().hex
+            fields = {'chat_id': chat_id, 'duration': int(track.duration or 0), **self._audio_fields(track)}
+            head = b''.join(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+                for name, value in fields.items()
+            )
+            head += (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="audio"; '
+                f'filename="{source["id"] or "track"}.{source["ext"]}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'
+            ).encode()
+            tail = f'\r\n--{boundary}--\r\n'.encode()
+
+            async def body():
+                sent = 0
+                yield head
+                async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                    sent += len(chunk)
+                    if sent >= limit:
+                        raise ValueError(f'Файл превышает {MAX_FILE_SIZE_MB} MB')
+                    yield chunk
+                yield tail
+
+            headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+            # С известной длиной обходимся без chunked-передачи
+            if length and 'Content-Encoding' not in response.headers:
+                headers['Content-Length'] = str(len(head) + length + len(tail))
+
+            upload = await self.http_client.post(f'{bot.base_url}/sendAudio', content=body(), headers=headers)
+
+        data = upload.json()
+        if not data.get('ok'):
+            raise TelegramError(data.get('description') or 'sendAudio failed')
+        return Message.de_json(data['result'], bot)
+
+    def _cached_audio(self, url: str, track_id: str = ''):
+        """AudioFile из дискового кэша или None"""
+        audio = self.audio_cache.get(self.audio_cache.key(track_id, url)) if self.audio_cache.enabled else None
+        if audio:
+            logger.info('⚡ Трек из дискового кэша', extra={'url': url})
+        return audio
+
+    async def download_track(self, url: str, chat_id: int = 0, on_queue_position=None,
+                             priority: int = DownloadScheduler.PRIORITY_INTERACTIVE, track_id: str = ''):
+        """Скачивает трек через очередь скачиваний и возвращает AudioFile.
+
+        Сначала проверяется дисковый кэш по id трека SoundCloud (или по URL).
+        Одновременные запросы одного URL получают один и тот же файл;
+        после отправки каждый вызывающий обязан вызвать release().
+        Если очередь переполнена, выбрасывает DownloadQueueFull, если трек
+        не проходит по размеру или формату - TrackRejected.
+        """
+        if not self.is_valid_url(url):
+            metrics.inc('failures_total', reason='invalid_url')
+            logger.warning('❌ Невалидный URL', extra={'url': url})
+            return None
+
+        audio = self._cached_audio(url, track_id)
+        if audio:
+            return audio
+        rejection = self.rejected_tracks.get(url)
+        if rejection:
+            raise TrackRejected(*rejection)
+
+        cache_key = self.audio_cache.key(track_id, url)
+        if priority == DownloadScheduler.PRIORITY_INTERACTIVE:
+            # Трек может уже ждать в очереди на предзагрузку: пользователь присоединится
+            # к этой задаче, поэтому она поднимается до интерактивной и показывает ему место
+            self.download_scheduler.promote(url, priority, on_queue_position)
+        return await self.download_flights.run(
+            url,
+            lambda: self.download_scheduler.submit(
+                chat_id,
+                lambda: self._download_now(url, cache_key),
+                priority=priority,
+                on_position=on_queue_position,
+                on_orphan=AudioFile.abandon,
+                key=url
+            )
+        )
+
+    def _audio_from_file(self, path: str, tmpdir: str, cache_key: str = None, variant: str = '') -> AudioFile:
+        """Переносит готовый файл в дисковый кэш под вариантом формата, а если не
+        вышло - отдает его вместе с tmpdir: директорию удалит AudioFile после последней отправки"""
+        audio = self.audio_cache.store(cache_key, path, variant) if cache_key and variant else None
+        return audio or AudioFile(path, tmpdir)
+
+    async def _download_now(self, url: str, cache_key: str = None):
+        """Скачивает трек сразу, минуя очередь, и сохраняет его в дисковый кэш"""
+        # Временная директория на том же диске, что и кэш: файл переносится в него одним rename
+        tmpdir = tempfile.mkdtemp(dir=self.audio_cache.tmp_dir if self.audio_cache.enabled else None)
+        started_at = time.monotonic()
+        
+        try:
+            logger.info('⏬ Начинаем скачивание', extra={'url': url})
+
+            with metrics.timer('stage_seconds', stage='download'):
+                info = await asyncio.wait_for(
+                    self.download_executor.run(_download_in_worker, url, tmpdir, self.transcoder is not None),
+                    timeout=DOWNLOAD_TIMEOUT
+                )
 
             if not info:
-                print("❌ yt-dlp не вернул информацию")
+                metrics.inc('failures_total', reason='download_error')
+                logger.warning('❌ yt-dlp не вернул информацию', extra={'url': url})
                 return None
+            if info.get('rejected') and info.get('source'):
+                # Ни один формат не подходит как есть - перекодируем прямо из потока
+                path = await self.transcoder.transcode(
+                    info['source']['url'], info.get('duration'), tmpdir, headers=info['source']['headers']
+                )
+                if path:
+                    variant = self.transcoder.variant(info.get('duration'))
+                    audio = self._audio_from_file(path, tmpdir, cache_key, variant)
+                    if audio.tmpdir:
+                        tmpdir = None
+                    return audio
+            if info.get('rejected'):
+                metrics.inc('failures_total', reason=info['rejected'])
+                logger.info('🚫 Трек отклонен до скачивания', extra={
+                    'url': url, 'reason': info['rejected'], 'bytes': info.get('filesize'),
+                })
+                self.rejected_tracks.set(url, (info['rejected'], info.get('filesize') or 0))
+                raise TrackRejected(info['rejected'], info.get('filesize') or 0)
+            scan_started_at = time.monotonic()
 
             # Ищем Telegram-совместимые файлы
-            telegram_audio_extensions = ['.mp3', '.m4a', '.ogg', '.wav', '.flac']
-            
             for file in os.listdir(tmpdir):
                 file_ext = os.path.splitext(file)[1].lower()
-                if file_ext in telegram_audio_extensions:
+                if file_ext in AUDIO_EXTENSIONS:
                     file_path = os.path.join(tmpdir, file)
                     
                     # Проверяем размер файла
-                    file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-                    print(f"📁 Найден файл: {file} ({file_size_mb:.2f} MB)")
+                    variant = info.get('format_id') or file_ext.lstrip('.')
+                    file_size = os.path.getsize(file_path)
+                    file_size_mb = file_size / (1024 * 1024)
+                    metrics.observe('file_size_bytes', file_size)
+                    logger.debug('📁 Найден файл: %s (%.2f MB)', file, file_size_mb, extra={'url': url})
                     
                     if file_size_mb >= MAX_FILE_SIZE_MB:
-                        print(f"❌ Файл слишком большой: {file_size_mb} MB")
-                        continue
+                        # Размер по метаданным оказался неточным - перекодируем уже скачанный файл
+                        transcoded = None
+                        if self.transcoder:
+                            transcoded = await self.transcoder.transcode(file_path, info.get('duration'), tmpdir)
+                        if not transcoded:
+                            metrics.inc('failures_total', reason='too_large')
+                            logger.warning('❌ Файл слишком большой: %.2f MB', file_size_mb, extra={'url': url})
+                            continue
+                        os.remove(file_path)
+                        file_path, file_size = transcoded, os.path.getsize(transcoded)
+                        variant = self.transcoder.variant(info.get('duration'))
                     
-                    print(f"✅ Файл подходит: {file_path}")
-                    return file_path
+                    metrics.observe('stage_seconds', time.monotonic() - scan_started_at, stage='file_scan')
+                    logger.info('✅ Трек скачан', extra={
+                        'url': url, 'bytes': file_size,
+                        'duration_ms': round((time.monotonic() - started_at) * 1000),
+                    })
+                    audio = self._audio_from_file(file_path, tmpdir, cache_key, variant)
+                    if audio.tmpdir:
+                        tmpdir = None
+                    return audio
 
-            print(f"❌ Не найдено подходящих файлов в {tmpdir}")
+            metrics.observe('stage_seconds', time.monotonic() - scan_started_at, stage='file_scan')
+            metrics.inc('failures_total', reason='no_audio_file')
+            logger.warning('❌ Не найдено подходящих файлов в %s', tmpdir, extra={'url': url})
             return None
 
+        except TrackRejected:
+            raise
         except asyncio.TimeoutError:
-            print(f"❌ Таймаут скачивания: {url}")
+            metrics.inc('timeouts_total', stage='download')
+            logger.warning('❌ Таймаут скачивания', extra={
+                'url': url, 'duration_ms': round((time.monotonic() - started_at) * 1000),
+            })
             return None
         except Exception as e:
-            logger.exception(f'Ошибка скачивания: {e}')
-            print(f"❌ Ошибка скачивания: {e}")
+            metrics.inc('failures_total', reason='download_error')
+            logger.exception('Ошибка скачивания: %s', e)
             return None
         finally:
-            # Очищаем временную директорию
-            async def cleanup():
-                await asyncio.sleep(2)
-                try:
-                    shutil.rmtree(tmpdir, ignore_errors=True)
-                    print(f"✅ Очищена временная директория: {tmpdir}")
-                except Exception as e:
-                    print(f"⚠️ Не удалось очистить временную директорию: {e}")
-            
-            asyncio.create_task(cleanup())
+            # Очищаем временную директорию, если файл не был отдан
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
 
     # ==================== КОМАНДЫ ====================
 
@@ -796,6 +4050,8 @@ class UniversalMusicBot:
             f"📢 <b>Доступные команды:</b>\n"
             f"• <code>найди [запрос]</code> - найти треки (показывает 3 варианта)\n"
             f"• <code>/find [запрос]</code> - найти треки (команда)\n"
+            f"• <code>найди 5 треков [запрос]</code> - сразу несколько треков альбомом (до {BULK_MAX_TRACKS})\n"
+            f"• <code>найди [ссылка на плейлист SoundCloud]</code> - треки плейлиста альбомами\n"
             f"• <code>рандом</code> - случайный трек\n"
             f"• <code>/random</code> - случайный трек (команда)\n\n"
             f"🚀 <b>Начни поиск музыки!</b>",
@@ -804,19 +4060,165 @@ class UniversalMusicBot:
 
     # ==================== ЗАПУСК БОТА ====================
 
+    async def _on_startup(self, application: Application):
+        """Запускает фоновые задачи после инициализации приложения"""
+        self.download_scheduler.start()
+        self.http_client = httpx.AsyncClient(timeout=httpx.Timeout(DOWNLOAD_TIMEOUT, connect=20))
+        self._housekeeping_task = asyncio.create_task(self._housekeeping())
+        self._warm_up_task = asyncio.create_task(self._warm_up_executors())
+        if self.state.shared:
+            self._state_sync_task = asyncio.create_task(self._sync_state())
+        if METRICS_PORT:
+            try:
+                self.metrics_server = await start_metrics_server(metrics, METRICS_HOST, METRICS_PORT)
+                logger.info('📈 Метрики: http://%s:%s/metrics', METRICS_HOST, METRICS_PORT)
+            except OSError as e:
+                logger.warning('Не удалось запустить сервер метрик: %s', e)
+        try:
+            # kill -USR1 <pid> включает/выключает DEBUG без перезапуска
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_debug_logging)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass
+
+    async def _warm_up_executors(self):
+        """Импортирует yt-dlp и создает его экземпляры во всех воркерах до первых запросов.
+
+        Начинается после запуска приложения, чтобы импорт не задерживал
+        инициализацию и первый getUpdates.
+        """
+        while self.app is not None and not self.app.running:
+            await asyncio.sleep(0.05)
+        started_at = time.monotonic()
+        try:
+            await asyncio.gather(self.search_executor.warm_up(), self.download_executor.warm_up())
+            logger.info('🔥 Пулы yt-dlp прогреты за %.2f с', time.monotonic() - started_at)
+        except Exception as e:
+            logger.warning('Ошибка прогрева пулов yt-dlp: %s', e)
+
+    async def _sync_state(self):
+        """Пачкой отправляет изменения в общее хранилище и сводит лимиты запросов"""
+        while True:
+            await asyncio.sleep(STATE_SYNC_INTERVAL)
+            try:
+                with metrics.timer('stage_seconds', stage='state_sync'):
+                    await self.state.flush()
+                    await self.rate_limiter.sync(self.state)
+            except Exception as e:
+                logger.warning('Ошибка синхронизации общего состояния: %s', e)
+
+    async def _housekeeping(self):
+        """Периодически удаляет просроченные записи из кэшей и хранилищ"""
+        while True:
+            await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+            try:
+                # Истекшие сессии освобождают свою предзагрузку через on_remove
+                expired_sessions = self.search_sessions.purge_expired()
+                expired_searches = self.search_cache.purge_expired()
+                idle_buckets = self.rate_limiter.sweep()
+                shared_expired = await self.state.purge_expired()
+                if expired_sessions or expired_searches or idle_buckets or shared_expired:
+                    logger.info(
+                        '🧹 Удалено сессий: %s, записей кэша поиска: %s, ведер лимитов: %s, записей общего состояния: %s',
+                        expired_sessions, expired_searches, idle_buckets, shared_expired
+                    )
+            except Exception as e:
+                logger.warning('Ошибка фоновой очистки: %s', e)
+
+    async def _on_stop(self, application: Application):
+        """Дожидается начатых скачиваний, пока бот еще может отправить их результат.
+
+        Application.stop() уже дождался обработчиков обновлений, так что здесь
+        остаются задачи, от которых отказались вызывающие (on_orphan), и
+        фоновые; shutdown() закрывает бота, поэтому ждать нужно до него.
+        """
+        logger.info('📊 Предзагрузка: %s', self.prefetcher.stats())
+        self.prefetcher.close()
+        scheduler_stats = self.download_scheduler.stats()
+        if scheduler_stats['active'] or scheduler_stats['queued']:
+            logger.info('⏳ Ждем скачивания: %d активных, %d в очереди',
+                        scheduler_stats['active'], scheduler_stats['queued'])
+            if not await self.download_scheduler.drain(SHUTDOWN_DRAIN_TIMEOUT):
+                logger.warning('Скачивания не завершились за %d с, прерываем', SHUTDOWN_DRAIN_TIMEOUT)
+
+    async def _on_shutdown(self, application: Application):
+        """Освобождает ресурсы при остановке приложения"""
+        if self._housekeeping_task:
+            self._housekeeping_task.cancel()
+        if self._state_sync_task:
+            self._state_sync_task.cancel()
+        if self._warm_up_task:
+            self._warm_up_task.cancel()
+        if self.metrics_server:
+            self.metrics_server.close()
+        await self.download_scheduler.stop()
+        if self.http_client:
+            await self.http_client.aclose()
+        logger.info('📊 Очередь скачиваний: %s', self.download_scheduler.stats())
+        for executor in (self.search_executor, self.download_executor):
+            logger.info('📊 Пул %s: %s', executor.name, executor.stats())
+            executor.shutdown()
+        logger.info('📊 Кэш file_id: %s', self.file_id_cache.stats())
+        logger.info('📊 Дисковый кэш аудио: %s', self.audio_cache.stats())
+        if self.transcoder:
+            logger.info('📊 Перекодирование: %s', self.transcoder.stats())
+        logger.info('📊 Кэш поиска: %s', self.search_cache.stats())
+        logger.info('📊 Лимиты запросов: %s', self.rate_limiter.stats())
+        if self.state.shared:
+            try:
+                await self.state.flush()
+                await self.rate_limiter.sync(self.state)
+            except Exception as e:
+                logger.warning('Не удалось сохранить общее состояние: %s', e)
+        logger.info('📊 Общее состояние (%s): %s', self.state.name, self.state.stats())
+        self.state.close()
+        if log_handler.dropped:
+            logger.warning('📊 Отброшено записей лога при переполнении очереди: %s', log_handler.dropped)
+        self.file_id_cache.close()
+
+    def _webhook_options(self) -> dict:
+        """Параметры webhook-сервера PTB (run_webhook/start_webhook)"""
+        return {
+            'listen': WEBHOOK_LISTEN,
+            'port': WEBHOOK_PORT,
+            'url_path': WEBHOOK_PATH,
+            'webhook_url': f'{WEBHOOK_URL}/{WEBHOOK_PATH}',
+            'secret_token': WEBHOOK_SECRET,
+            'max_connections': WEBHOOK_MAX_CONNECTIONS,
+            'bootstrap_retries': 3,
+            # Перезапуск одного воркера не должен стирать обновления,
+            # которые Telegram еще не доставил остальным
+            'drop_pending_updates': False,
+        }
+
+    def _run_webhook(self):
+        """Принимает обновления по HTTP. SIGTERM/SIGINT останавливают прием,
+        после чего обрабатываются уже полученные обновления и скачивания"""
+        print(f'🌐 Режим webhook: {WEBHOOK_URL}/{WEBHOOK_PATH} <- {WEBHOOK_LISTEN}:{WEBHOOK_PORT}')
+        try:
+            self.app.run_webhook(**self._webhook_options())
+        except Exception as e:
+            print(f'❌ Не удалось запустить webhook: {e}')
+            raise
+
     def run(self):
         print('🚀 Запуск улучшенного Music Bot...')
         print('💡 Бот работает ВО ВСЕХ чатах (ЛС и группы)')
         print('🎯 Реагирует на: "найди", "/find", "рандом", "/random"')
-        print('🛡️  Rate limiting: {} запросов/минуту'.format(REQUESTS_PER_MINUTE))
+        print(f'📦 Пакетный режим: "найди N треков ..." и ссылки на плейлисты, до {BULK_MAX_TRACKS} треков, {BULK_CONCURRENCY} скачивания параллельно')
+        print('🛡️  Rate limiting: поиск {} / рандом {} / скачивание {} в минуту, чат {} в минуту'.format(
+            REQUESTS_PER_MINUTE, RANDOM_PER_MINUTE, DOWNLOAD_CLICKS_PER_MINUTE, CHAT_REQUESTS_PER_MINUTE))
         print('🎵 Показывает 3 трека на кнопках для выбора')
         print('🔍 Улучшенный поиск: 8 результатов + интеллектуальная фильтрация')
-        print('⚡ Ускоренное скачивание: 2 одновременных загрузки')
+        print(f'⚡ Ускоренное скачивание: {DOWNLOAD_WORKERS} одновременных загрузки, очередь до {DOWNLOAD_QUEUE_MAX}')
         print('🔤 ТРАНСЛИТЕРАЦИЯ: Поиск работает как по кириллице, так и по латинице')
         print('🔒 БЕЗОПАСНОСТЬ: Только пользователь, запустивший поиск, может выбирать треки')
 
         self._create_application()
 
+        if WEBHOOK_URL:
+            self._run_webhook()
+            return
+
         max_retries = 3
         for attempt in range(max_retries):
             try: